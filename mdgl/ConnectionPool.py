@@ -0,0 +1,271 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: ConnectionPool
+-- Description: This module provides a pool of connections to the Mimic database that
+-- is shared by every stage of a run.  The number of connections is limited separately
+-- from the number of virtual cores, so that database concurrency can be tuned to what
+-- the server can handle.
+--
+-- Connections are only opened when they are needed, up to the maximum size.  A
+-- connection that has been idle is checked before it is handed out again, and broken
+-- connections are replaced.  Opening a connection is retried before giving up.
+--
+-- The pool also keeps the asynchronous connections of async_access, which count towards
+-- the same maximum size and are kept open between uses in the same way.  When the pool
+-- is full, idle connections of the other kind are closed to make room, so that a stage
+-- of one kind does not wait on the connections left idle by a stage of the other.
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import time
+import threading
+from multiprocessing import cpu_count
+
+# Related 3rd party imports
+import psycopg2
+
+# Local application imports
+import async_access
+
+# The number of seconds a connection may be idle before it is checked when handed out.
+HEALTH_CHECK_IDLE = 60
+
+class ConnectionPool:
+
+    # Initialize the class data and information
+    # conn_info:    The (username, password, host, port) of the Mimic database
+    # minconn:      The number of connections opened up front and kept open
+    # maxconn:      The largest number of connections open at once, or 0 for one per
+    #               virtual core (at least two)
+    # retries:      The number of times opening a connection is retried
+    def __init__ (self, conn_info, minconn=1, maxconn=0, retries=3):
+        self.conn_info = conn_info
+        self.retries = retries
+        self.idle = []              # (connection, time returned) of unused connections
+        self.idleasync = []         # unused asynchronous connections
+        self.size = 0               # Number of open connections, idle or in use
+        self.condition = threading.Condition()
+
+        if(maxconn <= 0):
+            try:
+                maxconn = max(2, cpu_count())
+            except:
+                maxconn = 2
+        self.maxconn = maxconn
+        self.minconn = min(minconn, maxconn)
+
+        # Open the minimum number of connections now, so that connection problems are
+        # reported before any work starts.
+        for i in range(self.minconn):
+            self.idle.append((self.connect(), time.time()))
+            self.size += 1
+        return
+
+
+    # This function hands out a connection, waiting for one to be returned if the pool is
+    # at its maximum size.
+    def getconn(self):
+        self.condition.acquire()
+        try:
+            while(True):
+                # Reuse an idle connection if it is still healthy.
+                while(len(self.idle) > 0):
+                    conn, since = self.idle.pop()
+                    if(self.isHealthy(conn, since)):
+                        return conn
+                    self.discard(conn)
+
+                # Otherwise open a new connection, making room by closing an idle
+                # asynchronous connection if the pool is full.
+                if(self.size >= self.maxconn and len(self.idleasync) > 0):
+                    self.discard(self.idleasync.pop())
+                if(self.size < self.maxconn):
+                    self.size += 1
+                    break
+                self.condition.wait()
+        finally:
+            self.condition.release()
+
+        # Connect without holding the lock, giving the place back if it fails.
+        try:
+            return self.connect()
+        except:
+            self.condition.acquire()
+            try:
+                self.size -= 1
+                self.condition.notify()
+            finally:
+                self.condition.release()
+            raise
+
+
+    # This function hands out up to 'count' asynchronous connections, and at least one,
+    # waiting only if none can be handed out.  Idle connections are reused first, and idle
+    # blocking connections are closed to make room if the pool is full.
+    # count:        The number of connections wanted
+    def getasync(self, count):
+        conns = []
+        opening = 0
+        self.condition.acquire()
+        try:
+            while(True):
+                while(len(self.idleasync) > 0 and len(conns) < count):
+                    conn = self.idleasync.pop()
+                    if(conn.closed):
+                        self.discard(conn)
+                    else:
+                        conns.append(conn)
+                while(len(conns) + opening < count and self.size < self.maxconn + len(self.idle)):
+                    if(self.size >= self.maxconn):
+                        self.discard(self.idle.pop()[0])
+                    self.size += 1
+                    opening += 1
+                if(len(conns) + opening > 0):
+                    break
+                self.condition.wait()
+        finally:
+            self.condition.release()
+
+        # Connect without holding the lock, giving the places back if it fails.
+        try:
+            for i in range(opening):
+                conns.append(self.connect(async_=1))
+                opening -= 1
+        except:
+            self.putasync(conns)
+            self.condition.acquire()
+            try:
+                self.size -= opening
+                self.condition.notify_all()
+            finally:
+                self.condition.release()
+            raise
+        return conns
+
+
+    # This function returns asynchronous connections to the pool.
+    # conns:        The connections
+    # broken:       True if the connections failed and should be closed
+    def putasync(self, conns, broken=False):
+        self.condition.acquire()
+        try:
+            for conn in conns:
+                if(broken or conn.closed):
+                    self.discard(conn)
+                else:
+                    self.idleasync.append(conn)
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        return
+
+
+    # This function returns a connection to the pool.  Its transaction is ended so that
+    # the next user starts cleanly.
+    # conn:         The connection
+    # broken:       True if the connection failed and should be closed
+    def putconn(self, conn, broken=False):
+        if(not broken and not conn.closed):
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+
+        self.condition.acquire()
+        try:
+            if(broken or conn.closed):
+                self.discard(conn)
+            else:
+                self.idle.append((conn, time.time()))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return
+
+
+    # This function returns the number of connections of either kind that can be handed
+    # out without waiting: the places of the pool not taken by a connection in use.  An
+    # idle connection of the other kind counts, as it is closed to make room.
+    def available(self):
+        self.condition.acquire()
+        try:
+            inuse = self.size - len(self.idle) - len(self.idleasync)
+            return self.maxconn - inuse
+        finally:
+            self.condition.release()
+
+
+    # This function returns the number of worker threads that can each be given a
+    # connection at once.  The caller holds a connection of its own for the whole run,
+    # so it is left out.
+    def workers(self):
+        return max(1, min(self.available(), self.maxconn - 1))
+
+
+    # This function closes every idle connection.
+    def closeall(self):
+        self.condition.acquire()
+        try:
+            while(len(self.idle) > 0):
+                self.discard(self.idle.pop()[0])
+            while(len(self.idleasync) > 0):
+                self.discard(self.idleasync.pop())
+        finally:
+            self.condition.release()
+        return
+
+
+    # This function opens a new connection to the Mimic database, retrying with an
+    # increasing delay if the database cannot be reached.
+    # async_:       1 to open an asynchronous connection, and wait until it is ready
+    def connect(self, async_=0):
+        for attempt in range(self.retries + 1):
+            try:
+                conn = psycopg2.connect(database= 'mimic',
+                    user = self.conn_info[0],
+                    password = self.conn_info[1],
+                    host = self.conn_info[2],
+                    port = self.conn_info[3],
+                    async_ = async_)
+                if(async_):
+                    async_access.wait(conn)
+                return conn
+            except psycopg2.OperationalError:
+                if(attempt == self.retries):
+                    raise
+                print("Could not connect to Mimic III, retrying...")
+                time.sleep(2 ** attempt)
+
+
+    # This function checks that a connection is open and, if it has been idle for a while,
+    # that the database still answers on it.
+    # conn:         The connection
+    # since:        The time the connection was returned to the pool
+    def isHealthy(self, conn, since):
+        if(conn.closed):
+            return False
+        if(time.time() - since < HEALTH_CHECK_IDLE):
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.fetchall()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+    # This function closes a connection and removes it from the pool's count.  The pool's
+    # lock must be held.
+    # conn:         The connection
+    def discard(self, conn):
+        self.size -= 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        return
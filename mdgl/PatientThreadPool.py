@@ -4,17 +4,29 @@ from __future__ import division
 -- ------------------------------------------------------------------------------------
 -- Title: PatientThreadPool
 -- Description: This module provides multithreaded processing specialized to the number
--- of virtual cores that the current machine's architecture supports.  
+-- of virtual cores that the current machine's architecture supports.  Functions that
+-- access the database are instead run on as many threads as the connection pool allows,
+-- each with a connection from the pool.
 --
 -- The functions that are called using this method need to be written such that they
 -- take a list of arguments rather than individual arguments, and they are responsible
 -- for interpreting those correctly.
+--
+-- With the 'static' scheduler the split-arguments are divided into one equal slice per
+-- thread up front.  With the 'dynamic' scheduler the threads repeatedly take the next
+-- chunk of the split-arguments until none are left, calling the function once per 
+-- chunk.  Chunks start large and shrink as the work runs out (guided scheduling), so 
+-- threads that receive expensive patients do not hold up the others.
+--
+-- CPU-bound functions can instead be run in a pool of processes with executeProcessFunc.
 -- ------------------------------------------------------------------------------------
 '''
 
 # Standard library imports
 import copy
+import time
 import threading
+import multiprocessing
 from multiprocessing import cpu_count
 
 # Related 3rd party imports
@@ -28,34 +40,25 @@ import psycopg2.extras
 class PatientThreadPool:
 
     # Initialize the class data and information
-    def __init__ (self, conn_info):
+    # connpool:     The ConnectionPool that threads obtain database connections from, or
+    #               None if the threads do not need database connections.
+    # scheduler:    'static' or 'dynamic', the way work is divided among the threads
+    # minchunk:     The smallest number of items given to a thread at a time by the 
+    #               dynamic scheduler
+    def __init__ (self, connpool, scheduler='static', minchunk=16):
         self.pool = []
         self.results = []
         self.lock = threading.Lock()
-        self.connections = []
+        self.connpool = connpool
+        self.scheduler = scheduler
+        self.minchunk = max(minchunk, 1)
+        self.timings = []
 
         # Get CPU count for current architecture
         try:
             self.cpus = cpu_count()
         except:
             self.cpus = 2
-
-        # Create a database connection for use by threads.
-        for i in range(self.cpus):
-            # Connect to mimic database.
-            try:
-                con = psycopg2.connect(database= 'mimic',
-                    user = conn_info[0],
-                    password = conn_info[1],
-                    host = conn_info[2],
-                    port = conn_info[3])
-            except:
-                print("Could not connect to Mimic III. Please try again.\n")
-                exit(0)
-
-            # Use a dictionary cursor to interact with database.
-            curr = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            self.connections.append(curr)
         return
 
 
@@ -68,38 +71,47 @@ class PatientThreadPool:
     # func:         The function the arguments will be passed into.
     # args:         The arguments that will be passed into all threads
     # splitargs:    The arguments that will be split among each thread
-    def executeFunc(self, func, args, splitargs):
+    # database:     True if the function accesses the database.  Such functions are run
+    #               on as many threads as the connection pool can serve, and the others
+    #               on one thread per virtual core with no connection.
+    def executeFunc(self, func, args, splitargs, database=True):
         self.results = []
+        database = database and self.connpool is not None
+        workers = self.connpool.workers() if database else self.cpus
+        if(self.scheduler == 'dynamic'):
+            self.executeDynamic(func, args, splitargs, database, workers)
+            return
 
         # Split the split-arguments up and add to full argument
         # list for each thread.
-        new_args = [copy.deepcopy(args) for i in range(self.cpus)]
+        new_args = [copy.deepcopy(args) for i in range(workers)]
         for arg in splitargs:
 
             # Split the args into evenly sized chunks.
             chunks = []
-            val = int(len(arg) / self.cpus)
+            val = int(len(arg) / workers)
             prev = 0
             end = val
-            for i in range(self.cpus):
-                if i == self.cpus-1:
+            for i in range(workers):
+                if i == workers-1:
                     new_args[i].append(arg[prev:])
                 else:
                     new_args[i].append(arg[prev:end])
                     prev = end
                     end += val
 
-        # Add a pointer to this class and a database connection to each 
-        # thread's argument list
-        for i in range(self.cpus):
-            new_args[i] += [self, self.connections[i]]
+        # Add a pointer to this class to each thread's argument list
+        for i in range(workers):
+            new_args[i] += [self]
 
         # Create worker threads to evaluate given function
         print("Beginning thread processing...")
-        for i in range(self.cpus):
+        self.timings = [[0.0, 0, 0] for i in range(workers)]
+        for i in range(workers):
             t = threading.Thread(
-                    target=func, 
-                    args=( (new_args[i],) ))
+                    target=self.runTimed, 
+                    args=(i, func, new_args[i], len(new_args[i][len(args)]) if len(splitargs) > 0 else 0,
+                        database))
             self.pool.append(t)
             t.setDaemon(False)
             t.start()
@@ -109,4 +121,135 @@ class PatientThreadPool:
             thread.join()
         
         print("Completed thread processing.")
+        self.reportTimings()
+        return
+
+
+    # This function implements the dynamic scheduler.  Each thread takes chunks of the
+    # split-arguments from a shared position until all of them have been processed.
+    # func:         The function the arguments will be passed into.
+    # args:         The arguments that will be passed into all threads
+    # splitargs:    The arguments that will be split among each thread
+    # database:     True if the function is given a database connection
+    # workers:      The number of threads to use
+    def executeDynamic(self, func, args, splitargs, database, workers):
+        self.timings = [[0.0, 0, 0] for i in range(workers)]
+        total = len(splitargs[0]) if len(splitargs) > 0 else 0
+        position = [0]
+        queuelock = threading.Lock()
+
+        # Each worker copies the shared arguments once and then takes chunks until none
+        # are left.  A chunk is a share of the remaining items, but at least minchunk.
+        def worker(i):
+            thread_args = copy.deepcopy(args)
+            while(True):
+                queuelock.acquire()
+                try:
+                    start = position[0]
+                    size = max(self.minchunk, (total - start) // (2 * workers))
+                    end = min(total, start + size)
+                    position[0] = end
+                finally:
+                    queuelock.release()
+                if(start >= total):
+                    break
+                self.runTimed(i, func, 
+                    thread_args + [arg[start:end] for arg in splitargs] + [self],
+                    end - start, database)
+            return
+
+        # Create worker threads to evaluate given function
+        print("Beginning thread processing...")
+        pool = []
+        for i in range(workers):
+            t = threading.Thread(target=worker, args=(i,))
+            pool.append(t)
+            t.daemon = False
+            t.start()
+
+        # Wait for all threads to complete before returning
+        for thread in pool:
+            thread.join()
+
+        print("Completed thread processing.")
+        self.reportTimings()
+        return
+
+
+    # This function runs a CPU-bound function in a pool of worker processes, one per virtual
+    # core, so that it is not limited by the global interpreter lock.  Each process is 
+    # initialized once; the items are then packed and sent to the processes in chunks, and
+    # the lists returned for the chunks are collected as the results.
+    # func:         The module-level function called with each packed chunk.
+    # initializer:  The module-level function called once in each process.
+    # initargs:     The arguments of the initializer.
+    # items:        The items to process.
+    # pack:         The function used to convert a chunk of items into the form sent to
+    #               the processes.
+    def executeProcessFunc(self, func, initializer, initargs, items, pack):
+        self.results = []
+        chunksize = max(self.minchunk, len(items) // (4 * self.cpus))
+        chunks = (pack(items[i:i+chunksize]) for i in range(0, len(items), chunksize))
+
+        # Create worker processes to evaluate given function
+        print("Beginning process pool processing...")
+        atime = time.time()
+        processes = multiprocessing.Pool(self.cpus, initializer, initargs)
+        try:
+            for result in processes.imap_unordered(func, chunks):
+                self.results += result
+        finally:
+            processes.close()
+            processes.join()
+
+        print("Completed process pool processing: {:10.2f} seconds.".format(time.time() - atime))
+        return
+
+
+    # This function calls the function on a thread's arguments, followed by a database 
+    # cursor, and records the time taken, the number of calls and the number of items 
+    # processed for the thread.  Database functions are given a connection from the pool
+    # and are retried on a new connection if the connection fails; functions only add to
+    # the results once all of their items are processed, so a retry repeats no results.
+    # i:            The thread number
+    # func:         The function the arguments will be passed into.
+    # thread_args:  The arguments of the call
+    # items:        The number of split-argument items in the call
+    # database:     True if the function is given a database connection
+    def runTimed(self, i, func, thread_args, items, database):
+        atime = time.time()
+        if(not database):
+            func(thread_args + [None])
+        else:
+            attempt = 0
+            while(True):
+                conn = self.connpool.getconn()
+                try:
+                    func(thread_args + [conn.cursor(cursor_factory=psycopg2.extras.DictCursor)])
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    self.connpool.putconn(conn, broken=True)
+                    attempt += 1
+                    if(attempt > self.connpool.retries):
+                        raise
+                    print("Lost the connection to Mimic III, retrying on a new connection...")
+                    continue
+                except:
+                    self.connpool.putconn(conn)
+                    raise
+                self.connpool.putconn(conn)
+                break
+        self.timings[i][0] += time.time() - atime
+        self.timings[i][1] += 1
+        self.timings[i][2] += items
+        return
+
+
+    # This function prints the time each thread spent working in the last call to 
+    # executeFunc, and how evenly the work was balanced among them.
+    def reportTimings(self):
+        busy = [timing[0] for timing in self.timings]
+        for i, timing in enumerate(self.timings):
+            print("Thread {:3}: {:10.2f} seconds, {:5} chunks, {:7} items".format(i, timing[0], timing[1], timing[2]))
+        if(sum(busy) > 0):
+            print("Load balance (slowest / mean thread time): {:.2f}".format(max(busy) / np.mean(busy)))
         return
\ No newline at end of file
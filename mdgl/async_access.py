@@ -0,0 +1,105 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: Asynchronous Database Accessor
+-- Description: This module runs many queries against the Mimic database from a single
+-- thread, using psycopg2's asynchronous connections.  A connection runs one query at a
+-- time, so the number of queries in flight is the number of connections used.  While
+-- the server works on the queries, the thread waits on all of the connections at once
+-- and starts the next query on whichever connection finishes first.
+--
+-- The connections are taken from the run's ConnectionPool, so together with the other
+-- connections of the run there are never more than 'PoolMax' open, and they are kept
+-- open from one call to the next.
+--
+-- Each query is given as a (query, params) tuple and the rows of every query are
+-- returned in the order the queries were given.
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import select
+
+# Related 3rd party imports
+import psycopg2
+import psycopg2.extensions
+
+# Local application imports
+# ...
+
+
+# This function runs the given queries with at most 'inflight' of them running at once,
+# and returns the rows of each query.
+# connpool:     The ConnectionPool to take the connections from
+# queries:      A list of (query, params) tuples; params may be None
+# inflight:     The largest number of queries running at once
+def runQueries(connpool, queries, inflight):
+    results = [None] * len(queries)
+    if(len(queries) == 0):
+        return results
+
+    # Take the connections and start a query on each.
+    conns = connpool.getasync(min(inflight, len(queries)))
+    broken = True
+    active = {}                 # file descriptor -> (connection, cursor, query index)
+    waiting = {}                # file descriptor -> psycopg2 poll state
+    nextquery = 0
+    try:
+        for conn in conns:
+            startQuery(conn, queries, nextquery, active, waiting)
+            nextquery += 1
+
+        # Wait for any connection to be ready, then advance its query.
+        while(len(active) > 0):
+            rlist = [fd for fd in waiting.keys() if waiting[fd] == psycopg2.extensions.POLL_READ]
+            wlist = [fd for fd in waiting.keys() if waiting[fd] == psycopg2.extensions.POLL_WRITE]
+            rready, wready, xready = select.select(rlist, wlist, [])
+
+            for fd in rready + wready:
+                conn, cur, i = active[fd]
+                state = conn.poll()
+                if(state != psycopg2.extensions.POLL_OK):
+                    waiting[fd] = state
+                    continue
+
+                # The query is finished; start the next one on the same connection.
+                results[i] = cur.fetchall()
+                cur.close()
+                del active[fd]
+                del waiting[fd]
+                if(nextquery < len(queries)):
+                    startQuery(conn, queries, nextquery, active, waiting)
+                    nextquery += 1
+        broken = False
+    finally:
+        connpool.putasync(conns, broken)
+    return results
+
+
+# This function starts a query on an idle connection.
+# conn:         The asynchronous connection
+# queries:      The list of (query, params) tuples
+# i:            The index of the query to start
+# active:       The queries running on each connection, updated with the new query
+# waiting:      The poll state of each connection, updated with the new query
+def startQuery(conn, queries, i, active, waiting):
+    cur = conn.cursor()
+    cur.execute(queries[i][0], queries[i][1])
+    active[conn.fileno()] = (conn, cur, i)
+    waiting[conn.fileno()] = psycopg2.extensions.POLL_WRITE
+    return
+
+
+# This function blocks until an asynchronous connection has finished its current
+# operation.
+# conn:         The asynchronous connection
+def wait(conn):
+    while(True):
+        state = conn.poll()
+        if(state == psycopg2.extensions.POLL_OK):
+            return
+        elif(state == psycopg2.extensions.POLL_WRITE):
+            select.select([], [conn.fileno()], [])
+        elif(state == psycopg2.extensions.POLL_READ):
+            select.select([conn.fileno()], [], [])
@@ -0,0 +1,161 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: Extraction Benchmarks
+-- Description: This module times the different extraction modes of data_access against
+-- each other on a sample of the cohort described by a specifications file, and checks
+-- that the modes return the same data.  The thread and async extraction engines are
+-- compared at several levels of concurrency.
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import sys
+import time
+import getpass
+try:
+    input = raw_input
+except NameError:
+    pass
+
+# Related 3rd party imports
+import psycopg2
+import psycopg2.extras
+
+# Local application imports
+import spec_parser
+import data_access
+import PatientThreadPool
+import ConnectionPool
+
+# The numbers of queries running at once that the thread and async extraction are compared at.
+CONCURRENCY_LEVELS = (1, 2, 4, 8, 16, 32)
+
+
+# This function times a thread pool function over the given patients.
+# ptp:          an instance of PatientThreadPool for parallel functions
+# func:         the worker function to time
+# args:         the arguments passed into all threads
+# patients:     the patients to split among the threads
+def timeFunc(ptp, func, args, patients):
+    atime = time.time()
+    ptp.executeFunc(func=func, args=args, splitargs=[patients])
+    return time.time() - atime, ptp.getResults()
+
+
+# This function compares the per-patient and the bulk weight and height lookups.
+# ptp:          an instance of PatientThreadPool for parallel functions
+# patients:     the patients to obtain the weight and height for
+# batchsize:    the number of patients per bulk query
+def benchWeightandHeight(ptp, patients, batchsize):
+    ptime, presults = timeFunc(ptp, data_access.obtainWeightandHeight, [], patients)
+    btime, bresults = timeFunc(ptp, data_access.obtainWeightandHeightBulk, [batchsize], patients)
+
+    # The results come back in thread completion order, so compare them by patient.
+    pvals = sorted((p[0], p[9], p[10]) for p in presults)
+    bvals = sorted((p[0], p[9], p[10]) for p in bresults)
+
+    print("\nWeight and height for {} patients:".format(len(patients)))
+    print("Per-patient queries: {:10.2f} seconds".format(ptime))
+    print("Bulk queries       : {:10.2f} seconds (batch size {})".format(btime, batchsize))
+    print("Results identical  : {}\n".format(pvals == bvals))
+    return
+
+
+# This function compares the per-patient and the batched measurement extraction.
+# ptp:          an instance of PatientThreadPool for parallel functions
+# patients:     the patients to obtain measurements for, with weight and height
+# patient_info: the patient information gathered from Specifications.txt
+# routes:       the measurement IDs to search for in each table
+# measurementquery: the per-patient measurement query from makeQueries
+# batchsize:    the number of patients per batched query
+def benchMeasurements(ptp, patients, patient_info, routes, measurementquery, batchsize):
+    ptime, presults = timeFunc(ptp, data_access.obtainMeasurements, 
+        [data_access.makeRouteStrings(routes), measurementquery], patients)
+    btime, bresults = timeFunc(ptp, data_access.obtainMeasurementsBatched, 
+        [data_access.makeRouteParams(routes), data_access.makeBatchQuery(patient_info, routes), batchsize], 
+        patients)
+
+    # Rows with equal chart times may be returned in either order, so compare the 
+    # sorted rows of each patient.
+    pvals = sorted((p[0], sorted(tuple(m[:5]) for m in mlist)) for p, mlist in presults)
+    bvals = sorted((p[0], sorted(tuple(m[:5]) for m in mlist)) for p, mlist in bresults)
+
+    print("\nMeasurements for {} patients:".format(len(patients)))
+    print("Per-patient queries: {:10.2f} seconds".format(ptime))
+    print("Batched queries    : {:10.2f} seconds (batch size {})".format(btime, batchsize))
+    print("Results identical  : {}\n".format(pvals == bvals))
+    return
+
+
+# This function compares the thread and the async measurement extraction at each of the
+# given numbers of queries running at once.  The thread path runs one query per thread,
+# with a connection pool of one more than that, as in a run the caller holds one.  Each
+# engine is given a fresh pool, so that neither starts with the connections of the other.
+# conn_info:    the (username, password, host, port) of the Mimic database
+# patients:     the patients to obtain measurements for, with weight and height
+# icu_info:     the ICU information gathered from Specifications.txt
+# patient_info: the patient information gathered from Specifications.txt
+# setting_info: the run settings gathered from Specifications.txt
+# routes:       the measurement IDs to search for in each table
+# levels:       the numbers of queries to run at once
+def benchEngines(conn_info, patients, icu_info, patient_info, setting_info, routes, levels):
+    print("\nMeasurements for {} patients ({} queries):".format(len(patients), setting_info['Extraction']))
+    print("Concurrency   Thread (s)    Async (s)   Identical")
+    for level in levels:
+        connpool = ConnectionPool.ConnectionPool(conn_info, 1, level + 1, setting_info['PoolRetries'])
+        ptp = PatientThreadPool.PatientThreadPool(connpool, setting_info['Scheduler'], setting_info['MinChunk'])
+        settings = dict(setting_info, Engine='thread')
+        atime = time.time()
+        tresults = data_access.obtainMeasurementsFor(icu_info, patient_info, settings, routes, patients, ptp)
+        ttime = time.time() - atime
+        connpool.closeall()
+
+        connpool = ConnectionPool.ConnectionPool(conn_info, 0, level, setting_info['PoolRetries'])
+        ptp = PatientThreadPool.PatientThreadPool(connpool, setting_info['Scheduler'], setting_info['MinChunk'])
+        settings = dict(setting_info, Engine='async', InFlight=level)
+        atime = time.time()
+        aresults = data_access.obtainMeasurementsFor(icu_info, patient_info, settings, routes, patients, ptp)
+        asynctime = time.time() - atime
+        connpool.closeall()
+
+        tvals = sorted((p[0], sorted(tuple(m[:5]) for m in mlist)) for p, mlist in tresults)
+        avals = sorted((p[0], sorted(tuple(m[:5]) for m in mlist)) for p, mlist in aresults)
+        print("{:11} {:12.2f} {:12.2f}   {}".format(level, ttime, asynctime, tvals == avals))
+    print("")
+    return
+
+
+if __name__ == '__main__':
+
+    # Ensure that we have the correct number of commandline arguments and access them
+    if(len(sys.argv) != 5):
+        print("Insufficient command line arguments given.  Expected: 'python benchmark.py [host] [port] [specfile] [numpatients]'")
+        exit(0)
+    conn_info = (input('Enter in your username for accessing Mimic III: '),
+        getpass.getpass('Enter in your password for accessing Mimic III: '),
+        sys.argv[1], int(sys.argv[2]))
+    spec_file = sys.argv[3]
+    numpatients = int(sys.argv[4])
+
+    # Obtain the specifications and the cohort sample to run the benchmarks with.
+    icu_info, param_info, patient_info, registry = spec_parser.getSpecifications(spec_file)
+    setting_info = spec_parser.getSettings(spec_file)
+    connpool = ConnectionPool.ConnectionPool(conn_info, setting_info['PoolMin'], 
+        setting_info['PoolMax'], setting_info['PoolRetries'])
+    ptp = PatientThreadPool.PatientThreadPool(connpool, setting_info['Scheduler'], setting_info['MinChunk'])
+    cur = connpool.getconn().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    routes = data_access.obtainRoutes(param_info, setting_info, cur)
+    patientquery, measurementquery = data_access.makeQueries(icu_info, patient_info, routes)
+    cur.execute(patientquery)
+    patients = cur.fetchall()[:numpatients]
+
+    benchWeightandHeight(ptp, patients, setting_info['BatchSize'])
+
+    ptp.executeFunc(func=data_access.obtainWeightandHeightBulk,
+        args=[setting_info['BatchSize']], splitargs=[patients])
+    patients = ptp.getResults()
+    benchMeasurements(ptp, patients, patient_info, routes, measurementquery, 
+        setting_info['BatchSize'])
+    benchEngines(conn_info, patients, icu_info, patient_info, setting_info, routes, CONCURRENCY_LEVELS)
@@ -0,0 +1,127 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: Run Checkpoints
+-- Description: This module keeps the checkpoints of a resumable run.  A resumable run
+-- writes to a directory named after the hash of its specifications file, and saves the
+-- processed patients there as it goes, one chunk of patients at a time:
+--
+--   manifest.json:               the specification hash and the number of chunks saved
+--   checkpoint/chunk-NNNNN.npz:  the static measurements and joined measurement columns
+--                                of the patients of a chunk (see columnar_output)
+--
+-- A chunk file is written under a temporary name and renamed once complete, so a run
+-- that dies while saving leaves no partial chunk behind.  Running again with the same
+-- specifications finds the directory, and only the patients that are not in a chunk yet
+-- are obtained and processed.
+--
+-- The '#Settings' section is left out of the hash, so settings that only change how a
+-- run is carried out (threads, connections, batch sizes) can be changed before resuming.
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import os
+import sys
+import json
+import hashlib
+
+# Related 3rd party imports
+import numpy as np
+
+# Local application imports
+import columnar_output
+
+
+# This function returns the hash of the specifications file, leaving out its '#Settings'
+# section.
+# spec_file:    The name of the specifications file
+def specHash(spec_file):
+    digest = hashlib.sha256()
+    section = None
+    with open(spec_file, 'r') as f:
+        for line in f:
+            if(line.startswith('#')):
+                section = line.strip()
+            if(section != '#Settings'):
+                digest.update(line.strip().encode('utf-8'))
+    return digest.hexdigest()
+
+
+
+class Checkpoint:
+
+    # This function opens the checkpoints of the run in the directory, creating them if the
+    # run has not been started before.
+    # directory:    The output directory of the run
+    # spechash:     The hash of the specifications file, from specHash
+    def __init__ (self, directory, spechash):
+        self.directory = os.path.join(directory, 'checkpoint')
+        self.manifest = os.path.join(directory, 'manifest.json')
+        self.chunks = 0
+
+        if(os.path.isfile(self.manifest)):
+            with open(self.manifest, 'r') as f:
+                manifest = json.load(f)
+            if(manifest['spec'] != spechash):
+                sys.stderr.write("Checkpoint Error: '{}' was made from different specifications\n".format(directory))
+                exit(0)
+            self.chunks = manifest['chunks']
+        if(not os.path.isdir(self.directory)):
+            os.makedirs(self.directory)
+        self.spechash = spechash
+        self.writeManifest()
+        return
+
+
+    # This function returns the path of a chunk file.
+    # chunk:        The chunk number
+    def chunkPath(self, chunk):
+        return os.path.join(self.directory, 'chunk-{:05}.npz'.format(chunk))
+
+
+    # This function writes the manifest, replacing the previous one in a single rename.
+    def writeManifest(self):
+        with open(self.manifest + '.tmp', 'w') as f:
+            json.dump({'spec': self.spechash, 'chunks': self.chunks}, f, indent=4)
+        os.rename(self.manifest + '.tmp', self.manifest)
+        return
+
+
+    # This function returns the RecordIDs of the patients that have been saved.
+    def completed(self):
+        recordids = set()
+        for chunk in range(self.chunks):
+            with np.load(self.chunkPath(chunk)) as saved:
+                recordids.update(int(r) for r in saved['statics'][:, 0].tolist())
+        return recordids
+
+
+    # This function saves a chunk of processed patients.
+    # patients:     The PatientSeries of the patients
+    def save(self, patients):
+        if(len(patients) == 0):
+            return
+        path = self.chunkPath(self.chunks)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez_compressed(f,
+                statics=np.array([patient.getStatics() for patient in patients], dtype=np.float64),
+                counts=np.array([len(patient) for patient in patients], dtype=np.int64),
+                **columnar_output.packColumns(patients))
+        os.rename(path + '.tmp', path)
+        self.chunks += 1
+        self.writeManifest()
+        return
+
+
+    # This function loads every saved patient, in the order they were saved.
+    def load(self):
+        patients = []
+        for chunk in range(self.chunks):
+            with np.load(self.chunkPath(chunk)) as saved:
+                counts = saved['counts']
+                offsets = np.cumsum(counts) - counts
+                columns = dict((name, saved[name]) for name in columnar_output.COLUMNS)
+                patients += columnar_output.unpackColumns(saved['statics'], offsets, counts, columns)
+        return patients
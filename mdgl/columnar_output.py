@@ -0,0 +1,151 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: Columnar Output
+-- Description: This module writes the processed patients of a dataset as a few
+-- compressed, columnar partition files instead of one CSV file per patient, and reads
+-- them back.  The files are written in the 'data' directory of the dataset:
+--
+--   part-NNNNN.npz:  the measurements of up to 'PartitionSize' patients, with one
+--                    array per column (minutes, codes, itemids, values) holding the
+--                    measurements of all of its patients one after another
+--   index.npz:       the patient index: the static measurements of every patient, and
+--                    the partition, first row and number of rows of its measurements,
+--                    along with the parameter labels of the codes
+--
+-- Each partition is written with one bulk write of its arrays.
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import os
+
+# Related 3rd party imports
+import numpy as np
+
+# Local application imports
+import patient_series
+
+# The columns of the measurements, in the order of the PatientSeries arguments.
+COLUMNS = ('minutes', 'codes', 'itemids', 'values')
+
+class ColumnarWriter:
+
+    # This function initializes the writer.
+    # directory:    The directory of the dataset; the files are written in its 'data'
+    #               directory
+    # labels:       The parameter labels, by parameter code
+    # partsize:     The number of patients per partition file
+    def __init__ (self, directory, labels, partsize):
+        self.directory = os.path.join(directory, 'data')
+        self.labels = labels
+        self.partsize = max(partsize, 1)
+        self.pending = []
+        self.statics = []
+        self.partitions = []
+        self.offsets = []
+        self.counts = []
+
+        if(not os.path.isdir(self.directory)):
+            os.makedirs(self.directory)
+        return
+
+
+    # This function adds a patient to the dataset, writing out a partition once it is full.
+    # patient:      The PatientSeries of the patient
+    def add(self, patient):
+        self.pending.append(patient)
+        if(len(self.pending) >= self.partsize):
+            self.flush()
+        return
+
+
+    # This function writes the pending patients as the next partition.
+    def flush(self):
+        if(len(self.pending) == 0):
+            return
+        part = len(set(self.partitions))
+        counts = [len(patient) for patient in self.pending]
+        self.statics += [patient.getStatics() for patient in self.pending]
+        self.partitions += [part] * len(self.pending)
+        self.offsets += list(np.cumsum([0] + counts[:-1]))
+        self.counts += counts
+
+        np.savez_compressed(os.path.join(self.directory, 'part-{:05}.npz'.format(part)),
+            **packColumns(self.pending))
+        self.pending = []
+        return
+
+
+    # This function writes the last partition and the patient index.
+    def close(self):
+        self.flush()
+        np.savez(os.path.join(self.directory, 'index.npz'),
+            statics=np.array(self.statics, dtype=np.float64).reshape(-1, len(patient_series.STATIC_PARAMS)),
+            partitions=np.array(self.partitions, dtype=np.int32),
+            offsets=np.array(self.offsets, dtype=np.int64),
+            counts=np.array(self.counts, dtype=np.int64),
+            labels=np.array(self.labels))
+        return
+
+
+
+# This function joins the measurements of the patients into one array per column, the
+# measurements of each patient following those of the one before.
+# patients:     The PatientSeries of the patients
+def packColumns(patients):
+    columns = {}
+    for name in COLUMNS:
+        columns[name] = np.concatenate([getattr(patient, name) for patient in patients])
+    return columns
+
+
+
+# This function splits joined columns back into the PatientSeries of the patients.
+# statics:      The static measurement values of each patient
+# offsets:      The first row of each patient's measurements in the columns
+# counts:       The number of measurements of each patient
+# columns:      The joined columns, as returned by packColumns
+def unpackColumns(statics, offsets, counts, columns):
+    patients = []
+    for row, start, count in zip(np.asarray(statics).tolist(), np.asarray(offsets).tolist(),
+            np.asarray(counts).tolist()):
+        row[0] = int(row[0])
+        patients.append(patient_series.PatientSeries(row,
+            *[columns[name][start:start+count] for name in COLUMNS]))
+    return patients
+
+
+
+# This function returns True if the directory holds a dataset written by ColumnarWriter.
+# directory:    The directory of the dataset
+def isColumnar(directory):
+    return os.path.isfile(os.path.join(directory, 'data', 'index.npz'))
+
+
+
+# This function reads back the patients of a dataset written by ColumnarWriter, one
+# partition at a time, and returns the labels of the parameter codes and a generator of
+# the PatientSeries of the patients.
+# directory:    The directory of the dataset
+def readDataset(directory):
+    index = np.load(os.path.join(directory, 'data', 'index.npz'))
+    labels = index['labels'].tolist()
+    return labels, readPatients(directory, index)
+
+
+# This function yields the patients of each partition in turn, loading the columns of
+# one partition at a time.
+# directory:    The directory of the dataset
+# index:        The patient index loaded from index.npz
+def readPatients(directory, index):
+    partitions = index['partitions']
+    for part in np.unique(partitions).tolist():
+        with np.load(os.path.join(directory, 'data', 'part-{:05}.npz'.format(part))) as columns:
+            columns = dict((name, columns[name]) for name in COLUMNS)
+        rows = partitions == part
+        for patient in unpackColumns(index['statics'][rows], index['offsets'][rows], 
+                index['counts'][rows], columns):
+            yield patient
+    return
@@ -0,0 +1,174 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: Parameter Coverage
+-- Description: This module records which patients have which parameters as bitsets,
+-- one bit per patient and parameter, packed eight to a byte.  When 'CoverageHours' is
+-- set, a second bitset records the parameters of each patient in each band of that many
+-- hours since the ICU intime.  The bitsets are saved next to the dataset in
+-- coverage/coverage.npz, so the coverage of the parameters can be asked about later
+-- without reading the patients again:
+--
+--   python coverage.py [directory]                  the patients with each parameter
+--   python coverage.py [directory] [label ...]      the patients with all of the labels
+--
+-- The co-occurrence of every pair of parameters is also written to reports/Coverage.csv
+-- in the dataset directory: row X, column Y holds the number of patients with both X and
+-- Y, and the diagonal the number of patients with each parameter.
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import os
+import sys
+
+# Related 3rd party imports
+import numpy as np
+
+# Local application imports
+# ...
+
+class CoverageMatrix:
+
+    # Initialize the coverage of the patients
+    # recordids:    The RecordID of each patient
+    # labels:       The parameter labels, by parameter code
+    # params:       The packed [patients, parameters] bitset
+    # binned:       The packed [patients, parameters * bins] bitset, in which the bit of
+    #               parameter c in band b is c * numbins + b, or None
+    # binhours:     The width of the bands in hours, or 0 without a binned bitset
+    # numbins:      The number of bands
+    def __init__ (self, recordids, labels, params, binned=None, binhours=0, numbins=0):
+        self.recordids = recordids
+        self.labels = labels
+        self.params = params
+        self.binned = binned
+        self.binhours = binhours
+        self.numbins = numbins
+        return
+
+
+    # This function saves the bitsets in the 'coverage' directory of the dataset.
+    # directory:    The directory of the dataset
+    def save(self, directory):
+        path = os.path.join(directory, 'coverage')
+        if(not os.path.isdir(path)):
+            os.makedirs(path)
+        arrays = {'recordids': self.recordids, 'labels': np.array(self.labels), 'params': self.params,
+            'binhours': self.binhours, 'numbins': self.numbins}
+        if(self.binned is not None):
+            arrays['binned'] = self.binned
+        np.savez_compressed(os.path.join(path, 'coverage.npz'), **arrays)
+        return
+
+
+    # This function returns the [patients, parameters] matrix of True/False values.
+    def matrix(self):
+        return np.unpackbits(self.params, axis=1)[:, :len(self.labels)].astype(bool)
+
+
+    # This function returns the number of patients with each parameter.
+    def counts(self):
+        return self.matrix().sum(axis=0)
+
+
+    # This function returns the [parameters, parameters] matrix of the number of patients
+    # with both parameters.
+    def cooccurrence(self):
+        m = self.matrix().astype(np.int64)
+        return m.T.dot(m)
+
+
+    # This function returns which patients have all of the given parameters, testing
+    # only the bits of those parameters.
+    # labels:       The parameter labels
+    def hasAll(self, labels):
+        codes = np.array([self.labels.index(label) for label in labels], dtype=np.int64)
+        masks = (1 << (7 - codes % 8)).astype(np.uint8)
+        return np.all((self.params[:, codes // 8] & masks) != 0, axis=1)
+
+
+    # This function returns the [parameters, bins] matrix of the number of patients with
+    # each parameter in each band of hours.
+    def binCounts(self):
+        bits = np.unpackbits(self.binned, axis=1)[:, :len(self.labels) * self.numbins]
+        return bits.sum(axis=0).reshape(len(self.labels), self.numbins)
+
+
+    # This function writes the co-occurrence of the parameters to reports/Coverage.csv,
+    # kept apart from the patient files of the dataset.
+    # directory:    The directory of the dataset
+    def writeReport(self, directory):
+        counts = self.cooccurrence()
+        path = os.path.join(directory, 'reports')
+        if(not os.path.isdir(path)):
+            os.makedirs(path)
+        with open(os.path.join(path, 'Coverage.csv'), 'w') as f:
+            f.write("Parameter,{}\n".format(','.join(self.labels)))
+            for label, row in zip(self.labels, counts.tolist()):
+                f.write("{},{}\n".format(label, ','.join(str(c) for c in row)))
+        return
+
+
+
+# This function builds the coverage bitsets of the patients.
+# patientdata:  The PatientSeries of the patients
+# labels:       The parameter labels, by parameter code
+# hours:        The total number of hours from an ICU stay that are desired.
+# binhours:     The width of the bands of the binned bitset in hours, or 0 to leave it out
+def makeCoverage(patientdata, labels, hours, binhours):
+    numpatients = len(patientdata)
+    patient = np.repeat(np.arange(numpatients), [len(p) for p in patientdata])
+    codes = np.concatenate([p.codes for p in patientdata] + [np.empty(0, dtype=np.uint16)]).astype(np.int64)
+
+    params = np.zeros((numpatients, len(labels)), dtype=bool)
+    params[patient, codes] = True
+    binned = None
+    numbins = 0
+    if(binhours > 0):
+        numbins = -(-hours // binhours)
+        minutes = np.concatenate([p.minutes for p in patientdata] + [np.empty(0, dtype=np.int32)])
+        bins = np.minimum(minutes // (60 * binhours), numbins - 1).astype(np.int64)
+        binned = np.zeros((numpatients, len(labels) * numbins), dtype=bool)
+        binned[patient, codes * numbins + bins] = True
+        binned = np.packbits(binned, axis=1)
+
+    recordids = np.array([p.recordid for p in patientdata], dtype=np.int64)
+    return CoverageMatrix(recordids, labels, np.packbits(params, axis=1), binned, binhours, numbins)
+
+
+
+# This function loads the coverage bitsets saved with the dataset.
+# directory:    The directory of the dataset
+def loadCoverage(directory):
+    with np.load(os.path.join(directory, 'coverage', 'coverage.npz')) as saved:
+        return CoverageMatrix(saved['recordids'], saved['labels'].tolist(), saved['params'],
+            saved['binned'] if 'binned' in saved.files else None, int(saved['binhours']), int(saved['numbins']))
+
+
+
+if __name__ == '__main__':
+
+    # Ensure that we have the correct number of commandline arguments.
+    if(len(sys.argv) < 2):
+        print("Insufficient command line arguments given.  Expected: 'python coverage.py [directory] [label ...]'.")
+        exit(0)
+    if(not os.path.isfile(os.path.join(sys.argv[1], 'coverage', 'coverage.npz'))):
+        print("The directory \'{}\' has no saved coverage; run data_gen.py with 'Coverage; 1'.".format(sys.argv[1]))
+        exit(0)
+    cov = loadCoverage(sys.argv[1])
+
+    # Without labels, list the coverage of each parameter.
+    if(len(sys.argv) == 2):
+        for label, count in zip(cov.labels, cov.counts().tolist()):
+            print("{:>20}: {:8} of {} patients ({:.1%})".format(label, count, len(cov.recordids),
+                count / max(len(cov.recordids), 1)))
+        exit(0)
+
+    unknown = [label for label in sys.argv[2:] if label not in cov.labels]
+    if(len(unknown) > 0):
+        print("Unknown parameters: {}".format(', '.join(unknown)))
+        exit(0)
+    count = int(cov.hasAll(sys.argv[2:]).sum())
+    print("Patients with all of {}: {} of {}".format(', '.join(sys.argv[2:]), count, len(cov.recordids)))
@@ -10,62 +10,259 @@ from __future__ import division
 '''
 
 # Standard library imports
+import os
 import sys
 import time
 import pickle
+import itertools
+import functools
 
 # Related 3rd party imports
 import numpy as np
 
 # Local application imports
-# ...
+import extraction_cache
+import async_access
+import patient_processing
+
+# The tables that measurements are obtained from, and the alias used for each in the queries.
+MEASUREMENT_TABLES = (('labevents', 'lab'), ('chartevents', 'cha'), ('outputevents', 'oe'))
 
 # The function below takes the specification information and uses the functions in this file
 # data_access.py to access and return the dataset from the database.
 # ICUInfo:     a list of True/False values that determine which ICUs to use.
 # ParamInfo:   a dictionary of measurement parameters to obtain from the database
 # PatientInfo: a dictionary of patient information specifying the types of patients to analyze
-def obtainData(icu_info, param_info, patient_info, cur, ptp):
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+def obtainData(icu_info, param_info, patient_info, setting_info, cur, ptp):
 
     #####################################
     # Create and perform database queries
     #####################################
 
     # Obtain the patient and measurement queries
-    patientquery, measurementquery = makeQueries(icu_info, patient_info)
+    routes = obtainRoutes(param_info, setting_info, cur)
+    patientquery, measurementquery = makeQueries(icu_info, patient_info, routes)
 
     # Access patient information from database
+    patients = obtainPatients(patientquery, setting_info, cur, ptp)
+
+    # Access measurement information from databcase
     atime = time.time()
-    cur.execute(patientquery)
-    patients = cur.fetchall()
+    if(setting_info['CacheDir'] != ''):
+        patientlist = obtainCachedMeasurements(icu_info, patient_info, setting_info, routes, patients, ptp)
+    else:
+        patientlist = obtainMeasurementsFor(icu_info, patient_info, setting_info, routes, patients, ptp)
+    print('Obtained measurements from database: {:10.2f} seconds.\n'.format(time.time() - atime))
 
-    ptp.executeFunc(
-        func=obtainWeightandHeight,
-        args=[],
-        splitargs=[patients])
-    patients = ptp.getResults()
-    print('Obtained patient info from database: {:10.2f} seconds.\n'.format(time.time() - atime))
+    # Return the patient measurement information gathered.
+    return patientlist
 
-    # Get a string list of measurement IDs
-    m_ids = '\''+"','".join(
-        "','".join("%s" % m for m in param_info[key]['ids'])
-        for key in param_info.keys()
-        )+'\''
 
-    # Access measurement information from databcase
+
+# The function below obtains the patients from the database in the same way as obtainData,
+# leaving out the patients in 'exclude', and yields the (patient, measurements) tuples of
+# 'chunksize' patients at a time.  The measurements of a chunk are only obtained once the
+# previous chunk has been taken.
+# ICUInfo:     a list of True/False values that determine which ICUs to use.
+# ParamInfo:   a dictionary of measurement parameters to obtain from the database
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+# exclude:     the subject IDs of the patients to leave out
+# chunksize:   the number of patients per chunk
+def obtainChunks(icu_info, param_info, patient_info, setting_info, cur, ptp, exclude, chunksize):
+    routes = obtainRoutes(param_info, setting_info, cur)
+    patientquery, measurementquery = makeQueries(icu_info, patient_info, routes)
+    patients = obtainPatients(patientquery, setting_info, cur, ptp, exclude)
+    print('Patients left to obtain: {} ({} done before)\n'.format(len(patients), len(exclude)))
+
+    for start in range(0, len(patients), chunksize):
+        chunk = patients[start:start+chunksize]
+        if(setting_info['CacheDir'] != ''):
+            yield obtainCachedMeasurements(icu_info, patient_info, setting_info, routes, chunk, ptp)
+        else:
+            yield obtainMeasurementsFor(icu_info, patient_info, setting_info, routes, chunk, ptp)
+    return
+
+
+
+# The function below obtains the patients from the database in the same way as obtainData,
+# but streams each thread's measurements through server-side cursors directly into the 
+# consumer function instead of returning them.  Only 'IterSize' rows per thread are held
+# in memory at a time.
+# ICUInfo:     a list of True/False values that determine which ICUs to use.
+# ParamInfo:   a dictionary of measurement parameters to obtain from the database
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+# consumer:    The thread pool function that processes the (patient, measurements) tuples.
+# consumer_args: The arguments passed into the consumer before the tuples.
+def streamData(icu_info, param_info, patient_info, setting_info, cur, ptp, consumer, consumer_args):
+
+    # Access patient information from database
+    routes = obtainRoutes(param_info, setting_info, cur)
+    patientquery, measurementquery = makeQueries(icu_info, patient_info, routes)
+    patients = obtainPatients(patientquery, setting_info, cur, ptp)
+
+    # Stream measurement information from the database into the consumer
     atime = time.time()
     ptp.executeFunc(
-        func=obtainMeasurements, 
-        args=[m_ids, measurementquery], 
+        func=obtainMeasurementsStreaming,
+        args=[makeRouteParams(routes), makeBatchQuery(patient_info, routes), setting_info['BatchSize'],
+            setting_info['IterSize'], consumer, consumer_args],
         splitargs=[patients])
-    patientlist = ptp.getResults()
-    print('Obtained measurements from database: {:10.2f} seconds.\n'.format(time.time() - atime))
+    print('Streamed and processed measurements from database: {:10.2f} seconds.\n'.format(time.time() - atime))
 
-    # Return the patient measurement information gathered.
+    # Return the results of the consumer.
+    return ptp.getResults()
+
+
+
+# This function obtains the measurements of the given patients with the per-patient or the
+# batched measurement queries, and returns the (patient, measurements) tuples.
+# ICUInfo:     a list of True/False values that determine which ICUs to use.
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+# routes:      a dictionary of the measurement IDs to search for in each table
+# patients:    the patients to obtain the measurements of
+def obtainMeasurementsFor(icu_info, patient_info, setting_info, routes, patients, ptp):
+    if(setting_info['Engine'] == 'async'):
+        return obtainMeasurementsAsync(icu_info, patient_info, setting_info, routes, patients, 
+            ptp.connpool)
+    if(setting_info['Extraction'] == 'batch'):
+        ptp.executeFunc(
+            func=obtainMeasurementsBatched,
+            args=[makeRouteParams(routes), makeBatchQuery(patient_info, routes), setting_info['BatchSize']],
+            splitargs=[patients])
+    else:
+        patientquery, measurementquery = makeQueries(icu_info, patient_info, routes)
+        ptp.executeFunc(
+            func=obtainMeasurements, 
+            args=[makeRouteStrings(routes), measurementquery], 
+            splitargs=[patients])
+    return ptp.getResults()
+
+
+
+# This function obtains the measurements of the given patients from a single thread with
+# async_access, keeping 'InFlight' per-patient or batched queries running at once.
+# ICUInfo:     a list of True/False values that determine which ICUs to use.
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+# routes:      a dictionary of the measurement IDs to search for in each table
+# patients:    the patients to obtain the measurements of
+# connpool:    The ConnectionPool to take the asynchronous connections from
+def obtainMeasurementsAsync(icu_info, patient_info, setting_info, routes, patients, connpool):
+    batches = []
+    queries = []
+    if(setting_info['Extraction'] == 'batch'):
+        batchsize = setting_info['BatchSize']
+        batchquery = makeBatchQuery(patient_info, routes)
+        for start in range(0, len(patients), batchsize):
+            batch = patients[start:start+batchsize]
+            params = makeCohortParams(batch)
+            params.update(makeRouteParams(routes))
+            batches.append(batch)
+            queries.append((batchquery, params))
+    else:
+        patientquery, measurementquery = makeQueries(icu_info, patient_info, routes)
+        for patient in patients:
+            params = {'subject_id': patient[0], 'hadm_id': patient[2], 'intime': patient[5]}
+            params.update(makeRouteStrings(routes))
+            batches.append([patient])
+            queries.append((measurementquery % params, None))
+
+    # Split the rows of each query by the patient they belong to.
+    patientlist = []
+    for batch, rows in zip(batches, async_access.runQueries(connpool, queries, setting_info['InFlight'])):
+        if(len(batch) == 1 and setting_info['Extraction'] != 'batch'):
+            patientlist.append((batch[0], rows))
+            continue
+        mlists = [[] for patient in batch]
+        for row in rows:
+            mlists[row[5]].append(row)
+        patientlist += zip(batch, mlists)
+    return patientlist
+
+
+
+# This function obtains the measurements of the given patients through the extraction cache.
+# Only the measurement IDs that are not cached for a patient are obtained from the database,
+# in one pass for each distinct set of missing IDs, and the cache is updated with them.
+# ICUInfo:     a list of True/False values that determine which ICUs to use.
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+# routes:      a dictionary of the measurement IDs to search for in each table
+# patients:    the patients to obtain the measurements of
+def obtainCachedMeasurements(icu_info, patient_info, setting_info, routes, patients, ptp):
+    cache = extraction_cache.ExtractionCache(setting_info['CacheDir'], setting_info['CacheSize'])
+    hours = patient_info['Hours']['limit']
+    m_ids = set(m for table in routes.keys() for m in routes[table])
+
+    # Look up the cached rows of every patient and group the patients by the missing IDs.
+    cached = {}
+    groups = {}
+    for patient in patients:
+        rows, missing = cache.lookup(patient, m_ids, hours)
+        cached[(patient[0], patient[2])] = rows
+        groups.setdefault(frozenset(missing), []).append(patient)
+    print('Patients found in the extraction cache: {} of {}'.format(cache.hits, len(patients)))
+
+    patientlist = []
+    for missing, group in groups.items():
+        if(len(missing) == 0):
+            patientlist += [(patient, sorted(cached[(patient[0], patient[2])], key=lambda row: row[1]))
+                for patient in group]
+            continue
+
+        # Obtain the missing IDs from the tables they are routed to.
+        missingroutes = dict((table, [m for m in routes[table] if m in missing]) for table in routes.keys())
+        for patient, mlist in obtainMeasurementsFor(icu_info, patient_info, setting_info, missingroutes, group, ptp):
+            mlist = sorted(cached[(patient[0], patient[2])] + [tuple(row[:5]) for row in mlist], 
+                key=lambda row: row[1])
+            cache.store(patient, m_ids, hours, mlist)
+            patientlist.append((patient, mlist))
+
+    cache.evict()
     return patientlist
 
 
 
+# This function returns the measurement IDs to search for in each table, either sorted by
+# table with planRoutes or, if routing is disabled, all IDs for every table.
+# ParamInfo:   a dictionary of measurement parameters to obtain from the database
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+def obtainRoutes(param_info, setting_info, cur):
+    if(setting_info['Routing'] == 1):
+        return planRoutes(param_info, cur, setting_info['RouteCache'])
+    return makeFullRoutes(param_info)
+
+
+
+# This function obtains the patients and adds their weight and height.
+# patientquery: The query used to obtain the patients
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+# exclude:      The subject IDs of patients to leave out
+def obtainPatients(patientquery, setting_info, cur, ptp, exclude=()):
+    atime = time.time()
+    cur.execute(patientquery)
+    patients = [patient for patient in cur.fetchall() if patient[0] not in exclude]
+
+    if(setting_info['Extraction'] == 'patient'):
+        ptp.executeFunc(
+            func=obtainWeightandHeight,
+            args=[],
+            splitargs=[patients])
+    else:
+        ptp.executeFunc(
+            func=obtainWeightandHeightBulk,
+            args=[setting_info['BatchSize']],
+            splitargs=[patients])
+    patients = ptp.getResults()
+    print('Obtained patient info from database: {:10.2f} seconds.\n'.format(time.time() - atime))
+    return patients
+
+
+
 # The worker thread to be used for accessing patients' measurements.
 # patients:         The list of patients to extract measurements for
 # ptp:              The thread pool class instance.  Used to synchronize returned results.
@@ -136,8 +333,94 @@ def obtainWeightandHeight(args):
     print("Thread finishing...")
     return
 
+# The worker thread to be used for accessing patients' weight and height in bulk.
+# Each query obtains the weight and height of a whole batch of patients, giving the 
+# same values as obtainWeightandHeight with one round trip per batch.
+# batchsize:        The number of patients to include in a single query
+# patients:         The list of patients to extract measurements for
+# ptp:              The thread pool class instance.  Used to synchronize returned results.
+# cur:              A connection to the Mimic database.
+def obtainWeightandHeightBulk(args):
+    batchsize           = args[0]
+    patients            = args[1]
+    ptp                 = args[2]
+    cur                 = args[3]
+
+    print("Thread starting - {} patients to process...".format(len(patients)))
+
+    # The most recent weight before and the first height since the start of the
+    # hospital admission up to the ICU intime, for every patient of the batch.
+    bulkQuery =     "SELECT v.pidx, COALESCE(h.value, -1), COALESCE(w.value, -1)\
+                    FROM unnest(%(pidx)s::int[], %(subject_ids)s::int[],\
+                                %(hadm_ids)s::int[], %(intimes)s::timestamp[])\
+                        AS v(pidx, subject_id, hadm_id, intime)\
+                    LEFT JOIN LATERAL (SELECT\
+                        CASE\
+                            WHEN c.itemid IN (3581)\
+                            THEN c.valuenum * 0.45359\
+                            WHEN c.itemid IN (3582)\
+                            THEN c.valuenum * 0.028349\
+                            ELSE c.valuenum\
+                        END AS value\
+                        FROM mimiciii.chartevents c\
+                        WHERE c.subject_id = v.subject_id\
+                        AND c.hadm_id = v.hadm_id\
+                        AND c.charttime <= v.intime\
+                        AND c.valuenum IS NOT NULL\
+                        AND c.itemid IN (762, 763, 3723, 3580,\
+                                        3581, 3582)\
+                        ORDER BY c.charttime DESC\
+                        LIMIT 1) w ON TRUE\
+                    LEFT JOIN LATERAL (SELECT\
+                        CASE\
+                            WHEN c.itemid IN (920, 1394, 4187, 3486, 226707)\
+                            THEN c.valuenum * 2.54\
+                            ELSE c.valuenum\
+                        END AS value\
+                        FROM mimiciii.chartevents c\
+                        WHERE c.subject_id = v.subject_id\
+                        AND c.hadm_id = v.hadm_id\
+                        AND c.charttime <= v.intime\
+                        AND c.valuenum IS NOT NULL\
+                        AND c.itemid IN (920, 1394, 4187, 3486,\
+                                        3485, 4188, 226707, 226730)\
+                        ORDER BY c.charttime\
+                        LIMIT 1) h ON TRUE\
+                    ORDER BY v.pidx;"
+
+    # Access measurement information from database one batch at a time
+    patientlist = []
+    for start in range(0, len(patients), batchsize):
+        batch = patients[start:start+batchsize]
+        cur.execute(bulkQuery, makeCohortParams(batch))
+
+        # Store each patient's weight and height.
+        for row in cur.fetchall():
+            patientlist.append( np.append(batch[row[0]],[row[1],row[2]]) )
+
+    # Update the patient results before returning 
+    ptp.lock.acquire()
+    try:
+        ptp.results += patientlist
+    finally:
+        ptp.lock.release()
+    print("Thread finishing...")
+    return
+
+# This function creates the query parameters describing a batch of patients.  The
+# position of a patient in the batch is passed as 'pidx' so that returned rows can 
+# be matched back to the patient.
+# patients:         The batch of patients
+def makeCohortParams(patients):
+    return {
+        'pidx':         list(range(len(patients))),
+        'subject_ids':  [int(patient[0]) for patient in patients],
+        'hadm_ids':     [int(patient[2]) for patient in patients],
+        'intimes':      [patient[5] for patient in patients],
+    }
+
 # The worker thread to be used for accessing patients' measurements.
-# m_ids:            The list of measurement IDs to extract from Mimic
+# m_ids:            The measurement IDs to extract from each table (see makeRouteStrings)
 # measurementquery: The query used to extract measurements for a patient
 # patients:         The list of patients to extract measurements for
 # ptp:              The thread pool class instance.  Used to synchronize returned results.
@@ -154,9 +437,9 @@ def obtainMeasurements(args):
     # Access measurement information from database
     patientlist = []
     for patient in patients:
-        cur.execute(measurementquery % (patient[0], patient[2], m_ids, patient[5],
-                                        patient[0], patient[2], m_ids, patient[5], 
-                                        patient[0], patient[2], m_ids, patient[5]))
+        params = {'subject_id': patient[0], 'hadm_id': patient[2], 'intime': patient[5]}
+        params.update(m_ids)
+        cur.execute(measurementquery % params)
         mlist = cur.fetchall()
         patientlist.append((patient,mlist))
 
@@ -169,12 +452,190 @@ def obtainMeasurements(args):
     print("Thread finishing...")
     return 
 
+# The worker thread to be used for accessing the measurements of batches of patients.
+# Each query obtains the measurements of a whole batch of patients; every row is tagged
+# with the position of its patient in the batch so that the rows can be split by 
+# patient in a single pass.
+# m_ids:            The measurement IDs to extract from each table (see makeRouteParams)
+# batchquery:       The query used to extract measurements for a batch of patients
+# batchsize:        The number of patients to include in a single query
+# patients:         The list of patients to extract measurements for
+# ptp:              The thread pool class instance.  Used to synchronize returned results.
+# cur:              A connection to the Mimic database.
+def obtainMeasurementsBatched(args):
+    m_ids               = args[0]
+    batchquery          = args[1]
+    batchsize           = args[2]
+    patients            = args[3]
+    ptp                 = args[4]
+    cur                 = args[5]
+
+    print("Thread starting - {} patients to process...".format(len(patients)))
+
+    # Access measurement information from database one batch at a time
+    patientlist = []
+    for start in range(0, len(patients), batchsize):
+        batch = patients[start:start+batchsize]
+        params = makeCohortParams(batch)
+        params.update(m_ids)
+        cur.execute(batchquery, params)
+
+        # Split the rows by the patient they belong to.
+        mlists = [[] for patient in batch]
+        for row in cur.fetchall():
+            mlists[row[5]].append(row)
+        patientlist += zip(batch, mlists)
+
+    # Update the patient results before returning 
+    ptp.lock.acquire()
+    try:
+        ptp.results += patientlist
+    finally:
+        ptp.lock.release()
+    print("Thread finishing...")
+    return 
+
+# The worker thread to be used for streaming the measurements of batches of patients.
+# The (patient, measurements) tuples are handed to the consumer as a generator, which 
+# obtains the rows of each batch through a server-side cursor.
+# m_ids:            The measurement IDs to extract from each table (see makeRouteParams)
+# batchquery:       The query used to extract measurements for a batch of patients
+# batchsize:        The number of patients to include in a single query
+# itersize:         The number of rows to transfer from the server at a time
+# consumer:         The thread pool function that processes the tuples.
+# consumer_args:    The arguments passed into the consumer before the tuples.
+# patients:         The list of patients to extract measurements for
+# ptp:              The thread pool class instance.  Used to synchronize returned results.
+# cur:              A connection to the Mimic database.
+def obtainMeasurementsStreaming(args):
+    m_ids               = args[0]
+    batchquery          = args[1]
+    batchsize           = args[2]
+    itersize            = args[3]
+    consumer            = args[4]
+    consumer_args       = args[5]
+    patients            = args[6]
+    ptp                 = args[7]
+    cur                 = args[8]
+
+    print("Thread starting - {} patients to stream...".format(len(patients)))
+    consumer(consumer_args + [
+        streamMeasurements(m_ids, batchquery, batchsize, itersize, patients, cur.connection), 
+        ptp])
+    return
+
+# This generator yields a (patient, measurements) tuple for each patient, in the order of
+# the given patients.  The rows of a batch are read from a named (server-side) cursor, 
+# 'itersize' rows at a time, and only the rows of the current patient are kept.
+# m_ids:            The measurement IDs to extract from each table (see makeRouteParams)
+# batchquery:       The query used to extract measurements for a batch of patients
+# batchsize:        The number of patients to include in a single query
+# itersize:         The number of rows to transfer from the server at a time
+# patients:         The list of patients to extract measurements for
+# conn:             A connection to the Mimic database.
+def streamMeasurements(m_ids, batchquery, batchsize, itersize, patients, conn):
+    for start in range(0, len(patients), batchsize):
+        batch = patients[start:start+batchsize]
+        params = makeCohortParams(batch)
+        params.update(m_ids)
+
+        cur = conn.cursor('mdgl_measurements')
+        cur.itersize = itersize
+        try:
+            cur.execute(batchquery, params)
+
+            # Rows are ordered by patient, so group them as they arrive.  Patients
+            # without rows still produce a tuple.
+            pidx = 0
+            for key, rows in itertools.groupby(cur, key=lambda row: row[5]):
+                while(pidx < key):
+                    yield (batch[pidx], [])
+                    pidx += 1
+                yield (batch[pidx], list(rows))
+                pidx += 1
+            while(pidx < len(batch)):
+                yield (batch[pidx], [])
+                pidx += 1
+        finally:
+            cur.close()
+    return
+
+# This function returns the measurement IDs of all parameters as a list of integers.
+# ParamInfo:   a dictionary of measurement parameters to obtain from the database
+def getMeasurementIds(param_info):
+    return [m for key in param_info.keys() for m in param_info[key]['ids']]
+
+# This function returns routes that search every measurement table for every measurement ID.
+# ParamInfo:   a dictionary of measurement parameters to obtain from the database
+def makeFullRoutes(param_info):
+    m_ids = getMeasurementIds(param_info)
+    return dict((table, list(m_ids)) for table, alias in MEASUREMENT_TABLES)
+
+# This function sorts the measurement IDs of the parameters by the table that can contain
+# them, using the d_labitems and d_items dictionaries.  The table of each ID is cached in
+# 'cache_file' so that only IDs that have not been seen before are looked up.  IDs that are
+# found in neither dictionary are searched for in every table.
+# ParamInfo:   a dictionary of measurement parameters to obtain from the database
+# cur:         A connection to the Mimic database.
+# cache_file:  The file used to cache the table of each measurement ID.
+def planRoutes(param_info, cur, cache_file):
+    m_ids = getMeasurementIds(param_info)
+
+    # Load the tables of the IDs that have already been looked up.
+    tables = {}
+    if(os.path.isfile(cache_file)):
+        with open(cache_file, 'rb') as f:
+            tables = pickle.load(f)
+
+    # Look up the remaining IDs and update the cache.
+    missing = sorted(set(m for m in m_ids if m not in tables))
+    if(len(missing) > 0):
+        cur.execute("SELECT itemid, 'labevents' FROM mimiciii.d_labitems \
+                    WHERE itemid = ANY(%(m_ids)s::int[]) \
+                    UNION ALL \
+                    SELECT itemid, lower(linksto) FROM mimiciii.d_items \
+                    WHERE itemid = ANY(%(m_ids)s::int[]) \
+                    AND linksto IS NOT NULL;", {'m_ids': missing})
+        for m in missing:
+            tables[m] = None
+        for row in cur.fetchall():
+            tables[row[0]] = row[1]
+        with open(cache_file, 'wb') as f:
+            pickle.dump(tables, f)
+
+    # Route each ID to its table, or to every table if it is unknown.
+    routes = dict((table, []) for table, alias in MEASUREMENT_TABLES)
+    for m in m_ids:
+        if(tables[m] is None):
+            for table in routes.keys():
+                routes[table].append(m)
+        elif(tables[m] in routes):
+            routes[tables[m]].append(m)
+
+    print('Measurement IDs searched per table: {}'.format(
+        ', '.join('{} {}'.format(table, len(routes[table])) for table, alias in MEASUREMENT_TABLES)))
+    return routes
+
+# This function returns the measurement IDs of each table as the '<table>_ids' parameters 
+# of the batched measurement query.
+# routes:      a dictionary of the measurement IDs to search for in each table
+def makeRouteParams(routes):
+    return dict((alias+'_ids', routes[table]) for table, alias in MEASUREMENT_TABLES)
+
+# This function returns the measurement IDs of each table as the '<table>_ids' strings 
+# pasted into the per-patient measurement query.
+# routes:      a dictionary of the measurement IDs to search for in each table
+def makeRouteStrings(routes):
+    return dict((alias+'_ids', '\''+"','".join("%s" % m for m in routes[table])+'\'')
+        for table, alias in MEASUREMENT_TABLES)
+
 # The function below takes the specification information and generates SQL queries to gather
 # the desired information from Mimic.
 # ICUInfo:     a list of True/False values that determine which ICUs to use.
 # ParamInfo:   a dictionary of measurement parameters to obtain from the database
 # PatientInfo: a dictionary of patient information specifying the types of patients to analyze
-def makeQueries(icu_info, patient_info):
+# routes:      a dictionary of the measurement IDs to search for in each table
+def makeQueries(icu_info, patient_info, routes):
 
     # String ICU types together.
     icutypes = '\''+"','".join(icu_info)+'\''
@@ -208,16 +669,20 @@ def makeQueries(icu_info, patient_info):
                         icutypes,
                         )
 
-    # Create the query to obtain measurements
-    measurementquery = "SELECT lab.subject_id, lab.charttime, lab.itemid, lab.value \
+    # Create the query to obtain measurements.  Each row holds the subject id, chart time,
+    # item id, value and the number of minutes elapsed since the ICU intime.  Each table
+    # is searched for the ids in its '<table>_ids' parameter.
+    branches = {}
+    branches['labevents'] = "SELECT lab.subject_id, lab.charttime, lab.itemid, lab.value, \
+                        {lab_minutes} \
                         FROM mimiciii.labevents lab \
-                        WHERE subject_id = (%s) \
-                        AND lab.hadm_id = (%s) \
-                        AND lab.itemid IN (%s) \
-                        AND lab.charttime >= '%s' \
-                        AND lab.value != '' \
-                        UNION ALL \
-                        SELECT cha.subject_id, cha.charttime, cha.itemid, \
+                        WHERE subject_id = (%(subject_id)s) \
+                        AND lab.hadm_id = (%(hadm_id)s) \
+                        AND lab.itemid IN (%(lab_ids)s) \
+                        AND lab.charttime >= '%(intime)s' \
+                        {lab_window} \
+                        AND lab.value != '' "
+    branches['chartevents'] = "SELECT cha.subject_id, cha.charttime, cha.itemid, \
                         CASE \
                             WHEN (cha.itemid IN (467,468) AND cha.value = 'None') \
                             OR   (cha.itemid IN (720, 722) AND cha.stopped = 'D/C''d') \
@@ -226,21 +691,221 @@ def makeQueries(icu_info, patient_info):
                             THEN '1.0' \
                             WHEN cha.itemid NOT IN (467,468,720,722) \
                             THEN cha.value \
-                        END \
+                        END, \
+                        {cha_minutes} \
                         FROM mimiciii.chartevents cha \
-                        WHERE subject_id = (%s) \
-                        AND cha.hadm_id = (%s) \
-                        AND cha.itemid IN (%s) \
-                        AND cha.charttime >= '%s' \
-                        AND cha.value != '' \
-                        UNION ALL \
-                        SELECT oe.subject_id, oe.charttime, oe.itemid, CAST(oe.value AS VARCHAR) \
+                        WHERE subject_id = (%(subject_id)s) \
+                        AND cha.hadm_id = (%(hadm_id)s) \
+                        AND cha.itemid IN (%(cha_ids)s) \
+                        AND cha.charttime >= '%(intime)s' \
+                        {cha_window} \
+                        AND cha.value != '' "
+    branches['outputevents'] = "SELECT oe.subject_id, oe.charttime, oe.itemid, CAST(oe.value AS VARCHAR), \
+                        {oe_minutes} \
                         FROM mimiciii.outputevents oe \
-                        WHERE subject_id = (%s) \
-                        AND oe.hadm_id = (%s) \
-                        AND oe.itemid IN (%s) \
-                        AND oe.charttime >= '%s' \
-                        AND oe.value IS NOT NULL \
-                        ORDER BY subject_id, charttime;"
+                        WHERE subject_id = (%(subject_id)s) \
+                        AND oe.hadm_id = (%(hadm_id)s) \
+                        AND oe.itemid IN (%(oe_ids)s) \
+                        AND oe.charttime >= '%(intime)s' \
+                        {oe_window} \
+                        AND oe.value IS NOT NULL "
+    measurementquery = (joinBranches(branches, routes) + "ORDER BY subject_id, charttime;").format(
+                            **makeTimeColumns(patient_info, "'%(intime)s'::timestamp"))
 
     return patientquery, measurementquery
+
+
+# The function below generates the query used to obtain the measurements of a batch of
+# patients at once.  The batch is passed as arrays (see makeCohortParams) and the 
+# measurement IDs of each table as the array parameters '<table>_ids' (see makeRouteParams),
+# so the same query is used for every batch.  Rows are returned in the same form as the 
+# per-patient measurement query, followed by the position of the patient in the batch.
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# routes:      a dictionary of the measurement IDs to search for in each table
+def makeBatchQuery(patient_info, routes):
+    batchquery = BATCH_COHORT + makeCohortBranches(patient_info, routes) + "ORDER BY pidx, charttime;"
+
+    return batchquery
+
+
+# The 'cohort' table of a batch of patients passed as arrays (see makeCohortParams).
+BATCH_COHORT = "WITH cohort AS( \
+                    SELECT * \
+                    FROM unnest(%(pidx)s::int[], %(subject_ids)s::int[], \
+                                %(hadm_ids)s::int[], %(intimes)s::timestamp[]) \
+                        AS v(pidx, subject_id, hadm_id, intime) \
+                  ) "
+
+
+# The function below turns the patient query of makeQueries into the 'cohort' table of
+# every patient it selects, numbered by their subject_id, for makeCohortBranches.
+# patientquery: the patient query from makeQueries
+def makeQueryCohort(patientquery):
+    return "WITH cohort AS( \
+                SELECT p.subject_id AS pidx, p.subject_id, p.hadm_id, p.intime \
+                FROM (" + patientquery[:patientquery.rindex('ORDER BY')] + ") p \
+            ) "
+
+
+# The function below generates the measurement query of the patients of a 'cohort' table
+# with the columns pidx, subject_id, hadm_id and intime, for the query to define.  Rows
+# are returned in the same form as the per-patient measurement query, followed by pidx.
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# routes:      a dictionary of the measurement IDs to search for in each table
+def makeCohortBranches(patient_info, routes):
+    branches = {}
+    branches['labevents'] = "SELECT lab.subject_id, lab.charttime, lab.itemid, lab.value, \
+                  {lab_minutes}, v.pidx \
+                  FROM cohort v \
+                  INNER JOIN mimiciii.labevents lab \
+                  ON lab.subject_id = v.subject_id \
+                  AND lab.hadm_id = v.hadm_id \
+                  AND lab.charttime >= v.intime \
+                  {lab_window} \
+                  WHERE lab.itemid = ANY(%(lab_ids)s::int[]) \
+                  AND lab.value != '' "
+    branches['chartevents'] = "SELECT cha.subject_id, cha.charttime, cha.itemid, \
+                  CASE \
+                      WHEN (cha.itemid IN (467,468) AND cha.value = 'None') \
+                      OR   (cha.itemid IN (720, 722) AND cha.stopped = 'D/C''d') \
+                      THEN '2.0' \
+                      WHEN cha.itemid IN (467,468,720,722) \
+                      THEN '1.0' \
+                      WHEN cha.itemid NOT IN (467,468,720,722) \
+                      THEN cha.value \
+                  END, {cha_minutes}, v.pidx \
+                  FROM cohort v \
+                  INNER JOIN mimiciii.chartevents cha \
+                  ON cha.subject_id = v.subject_id \
+                  AND cha.hadm_id = v.hadm_id \
+                  AND cha.charttime >= v.intime \
+                  {cha_window} \
+                  WHERE cha.itemid = ANY(%(cha_ids)s::int[]) \
+                  AND cha.value != '' "
+    branches['outputevents'] = "SELECT oe.subject_id, oe.charttime, oe.itemid, CAST(oe.value AS VARCHAR), \
+                  {oe_minutes}, v.pidx \
+                  FROM cohort v \
+                  INNER JOIN mimiciii.outputevents oe \
+                  ON oe.subject_id = v.subject_id \
+                  AND oe.hadm_id = v.hadm_id \
+                  AND oe.charttime >= v.intime \
+                  {oe_window} \
+                  WHERE oe.itemid = ANY(%(oe_ids)s::int[]) \
+                  AND oe.value IS NOT NULL "
+
+    return joinBranches(branches, routes).format(**makeTimeColumns(patient_info, "v.intime"))
+
+
+# The function below generates the query used to summarize the measurements of the whole
+# cohort on the server, for the statistics report.  The cohort is the patient query of
+# makeQueries and the measurements are those of the batched measurement query, so only the
+# parameters' values within the hours window are summarized.  Each itemid counts towards
+# the parameter given by the '%(labels)s' array at the same position as in '%(itemids)s'.
+# Values that read as numbers are summarized as they are, and censored values ('<0.01')
+# are given the values of the '%(below)s' and '%(above)s' arrays, as handleCensored of
+# patient_processing does; other values are left out.  One row is returned per parameter
+# with its label, the number of patients with it, the number of values and their minimum,
+# quartiles, mean and maximum.
+# patientquery: the patient query from makeQueries
+# PatientInfo:  a dictionary of patient information specifying the types of patients to analyze
+# routes:       a dictionary of the measurement IDs to search for in each table
+def makeStatsQuery(patientquery, patient_info, routes):
+    return makeQueryCohort(patientquery) + ", measured(subject_id, charttime, itemid, value, minutes, pidx) AS( \
+            " + makeCohortBranches(patient_info, routes) + " \
+            ), params AS( \
+                SELECT * FROM unnest(%(itemids)s::int[], %(labels)s::text[], \
+                                     %(below)s::double precision[], %(above)s::double precision[]) \
+                    AS x(itemid, label, below, above) \
+            ), parsed AS( \
+                SELECT x.label, m.subject_id, \
+                    CASE \
+                        WHEN m.value ~ '^\\s*[-+]?([0-9]+\\.?[0-9]*|\\.[0-9]+)\\s*$' \
+                        THEN CAST(m.value AS DOUBLE PRECISION) \
+                        WHEN m.value ~ %(below_pattern)s \
+                        THEN x.below \
+                        WHEN m.value ~ %(above_pattern)s \
+                        THEN x.above \
+                    END AS val \
+                FROM measured m \
+                INNER JOIN params x ON x.itemid = m.itemid \
+            ), vals AS( \
+                SELECT * FROM parsed WHERE val IS NOT NULL \
+            ) \
+            SELECT label, count(DISTINCT subject_id), count(*), min(val), \
+                percentile_cont(0.25) WITHIN GROUP (ORDER BY val), \
+                percentile_cont(0.5) WITHIN GROUP (ORDER BY val), \
+                avg(val), \
+                percentile_cont(0.75) WITHIN GROUP (ORDER BY val), \
+                max(val) \
+            FROM vals \
+            GROUP BY label \
+            ORDER BY label;"
+
+
+# This function summarizes the measurements of the cohort on the server with the query
+# of makeStatsQuery, and returns the number of patients in the cohort and the row of
+# each parameter that has values, along with the labels of the parameters left out.  The
+# measurement IDs whose values are interpreted in order for each patient (the
+# STATEFUL_HANDLERS of patient_processing, such as mechanical ventilation) cannot be
+# summarized in one pass on the server, and are left out.
+# ICUInfo:     a list of True/False values that determine which ICUs to use.
+# ParamInfo:   a dictionary of measurement parameters to obtain from the database
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+# registry:    the parameter registry from spec_parser.getSpecifications
+def obtainStats(icu_info, param_info, patient_info, setting_info, registry, cur):
+    routes = obtainRoutes(param_info, setting_info, cur)
+    patientquery, measurementquery = makeQueries(icu_info, patient_info, routes)
+    cur.execute(makeQueryCohort(patientquery) + "SELECT count(*) FROM cohort;")
+    numpatients = cur.fetchone()[0]
+
+    params = makeRouteParams(routes)
+    itemids = [m for m in sorted(registry.keys()) if registry[m][2] not in patient_processing.STATEFUL_HANDLERS]
+    rules = [getCensorRules(registry[m][2]) for m in itemids]
+    params['itemids'] = itemids
+    params['labels'] = [registry[m][0] for m in itemids]
+    params['below'] = [rule.get('<') for rule in rules]
+    params['above'] = [rule.get('>') for rule in rules]
+    params['below_pattern'] = patient_processing.CENSORED_BELOW.pattern
+    params['above_pattern'] = patient_processing.CENSORED_ABOVE.pattern
+    cur.execute(makeStatsQuery(patientquery, patient_info, routes), params)
+    leftout = sorted(set(registry[m][0] for m in registry.keys()) - set(params['labels']))
+    return numpatients, cur.fetchall(), leftout
+
+
+# This function returns the censoring rules of a measurement ID's handler, or no rules
+# if its values are not censored.
+# handler:     the handler of the measurement ID, from the parameter registry
+def getCensorRules(handler):
+    if(isinstance(handler, functools.partial) and handler.func is patient_processing.handleCensored):
+        return handler.args[0]
+    return {}
+
+
+# The function below joins the queries of the measurement tables that have measurement IDs
+# routed to them.  The lab events query is kept if no table has any IDs, so that the query
+# remains valid.
+# branches:    a dictionary of the query for each measurement table
+# routes:      a dictionary of the measurement IDs to search for in each table
+def joinBranches(branches, routes):
+    tables = [table for table, alias in MEASUREMENT_TABLES if len(routes[table]) > 0]
+    if(len(tables) == 0):
+        tables = ['labevents']
+    return "UNION ALL ".join(branches[table] for table in tables)
+
+
+# The function below generates the SQL used by the measurement queries to compute the minutes
+# elapsed since the ICU intime and to keep only the measurements within the desired number
+# of hours.  The returned dictionary holds the '<table>_minutes' and '<table>_window' 
+# pieces for each of the lab, chart and output event tables.
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# intime:      the SQL expression for the patient's ICU intime
+def makeTimeColumns(patient_info, intime):
+    hours = patient_info['Hours']['limit']
+    columns = {}
+    for table in ('lab', 'cha', 'oe'):
+        columns[table+'_minutes'] = "CAST(FLOOR(EXTRACT(EPOCH FROM {}.charttime - {}) / 60) AS INTEGER)".format(
+            table, intime)
+        columns[table+'_window'] = "" if hours == -1 else "AND {}.charttime < {} + interval '{} hours'".format(
+            table, intime, hours)
+    return columns
@@ -22,53 +22,122 @@ import psycopg2.extras
 # Local application imports
 import spec_parser 
 import data_access
+import file_access
 import stat_report
 import patient_processing
+import patient_series
+import pipeline
+import tensor_export
+import columnar_output
+import checkpoint
+import coverage
+import run_plan
 import PatientThreadPool
+import ConnectionPool
+
+# The flags data_gen.py accepts on the command line.
+FLAGS = ('--stats', '--plan')
 
 
 # This function unifies the dataset generation function calls to generate a
 # patient dataset representative of the settings provided in the file
 # "Specifications.txt".
-# cur:      a connection to the MimicIII database
+# cur:      a connection to the MimicIII database, or None when reading the CSV files
 # ptp:      an instance of PatientThreadPool for parallel functions
 def dataGen(cur, ptp, spec_file):
 
     starttime = time.time()
 
     # Obtain the entry specifications from Specifications.txt
-    icu_info, param_info, patient_info = spec_parser.getSpecifications(spec_file)
+    icu_info, param_info, patient_info, registry = spec_parser.getSpecifications(spec_file)
+    setting_info = spec_parser.getSettings(spec_file)
+    labels = spec_parser.getLabels(param_info)
 
-    # Obtain the patient datasets based on the specifications.
-    patientlist = data_access.obtainData(icu_info, param_info, patient_info, cur, ptp)
+    # A resumable run writes to the same directory every time it is run with the specifications.
+    resumed = setting_info['Resume'] == 1 and setting_info['Source'] == 'database'
+    pipelined = setting_info['Pipeline'] == 1 and setting_info['Source'] == 'database' and not resumed
+    if(resumed):
+        spechash = checkpoint.specHash(spec_file)
+        dirname = "patientfiles " + spechash[:12]
+    else:
+        dirname = "patientfiles " + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    if(not os.path.isdir(dirname)):
+        os.makedirs(dirname)
 
-    # Process patient dataset information in parallel
-    atime = time.time()
-    print("Processing patient data...")
-    ptp.executeFunc(
-        func=patient_processing.evaluatePatients,
-        args=[patient_info['Hours']['limit'], param_info], 
-        splitargs=[patientlist])
-    patientdata = ptp.getResults()
-    print("Finished processing patient data: {:10.2f} seconds.\n".format(time.time() - atime))
+    # Open the column files if the patients are written as a columnar dataset.
+    columnar = None
+    if(setting_info['Output'] != 'csv'):
+        columnar = columnar_output.ColumnarWriter(dirname, labels, setting_info['PartitionSize'])
+    writer = lambda patient: writeOutput(patient, labels, dirname, setting_info['Output'], columnar)
+
+    if(resumed):
+        # Obtain, process and checkpoint the patients that are not done yet, a chunk at a
+        # time, writing the CSV files of each chunk before it is checkpointed.
+        print("Resuming the run in '{}'...".format(dirname))
+        patientdata = resumeData(icu_info, param_info, patient_info, setting_info, registry, cur, ptp,
+            checkpoint.Checkpoint(dirname, spechash),
+            writer=lambda patient: writeOutput(patient, labels, dirname, setting_info['Output'], None))
+    elif(pipelined):
+        # Fetch, process and write out the patients with the stages running together.
+        patientdata = pipeline.runPipeline(icu_info, param_info, patient_info, setting_info, registry, cur, ptp,
+            writer=writer)
+    elif(setting_info['Extraction'] == 'stream' and setting_info['Source'] == 'database'):
+        # Stream the patient datasets directly into processing.
+        print("Streaming and processing patient data...")
+        patientdata = data_access.streamData(icu_info, param_info, patient_info, setting_info, cur, ptp,
+            consumer=patient_processing.evaluatePatients,
+            consumer_args=[patient_info['Hours']['limit'], registry, setting_info['Evaluation']])
+    else:
+        # Obtain the patient datasets based on the specifications.
+        if(setting_info['Source'] == 'files'):
+            patientlist = file_access.obtainData(icu_info, param_info, patient_info, setting_info, ptp)
+        else:
+            patientlist = data_access.obtainData(icu_info, param_info, patient_info, setting_info, cur, ptp)
+
+        # Process patient dataset information in parallel
+        atime = time.time()
+        print("Processing patient data...")
+        patientdata = processPatients(patientlist, patient_info, setting_info, registry, ptp)
+        print("Finished processing patient data: {:10.2f} seconds.\n".format(time.time() - atime))
 
     # Perform any postprocessing
+    patient_processing.reportInvalid(registry)
     print("Number of patients collected: {}".format(len(patientdata)))
 
-    # Write out patient data to files
-    dirname = "patientfiles " + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-    os.makedirs(dirname)
-    os.chdir(dirname)
-    for patient in patientdata:
-        with open('{}.csv'.format(patient[0][3]), 'w') as f:
-            f.write("Time,Parameter,Id,Value\n")
-            for m in patient:
-                f.write("{},{},{},{:.3f}\n".format(m[0],m[1],m[2],float(m[3])))
-    os.chdir('..')
+    # Write out patient data to files.  The pipeline writes the patients as it goes, and a
+    # resumable run writes the CSV files of each chunk before checkpointing it.
+    atime = time.time()
+    if(not pipelined):
+        output = 'columnar' if resumed else setting_info['Output']
+        for patient in patientdata:
+            writeOutput(patient, labels, dirname, output, columnar)
+    if(columnar is not None):
+        columnar.close()
+        print("Wrote the columnar dataset: {:10.2f} seconds.".format(time.time() - atime))
+
+    # Write out the binned tensor of the patients
+    if(setting_info['Tensor'] == 1):
+        atime = time.time()
+        tensor = tensor_export.TensorWriter(dirname, labels, len(patientdata), 
+            patient_info['Hours']['limit'], setting_info['BinWidth'], setting_info['BinAgg'])
+        for patient in patientdata:
+            tensor.add(patient)
+        tensor.close()
+        print("Wrote the patient tensor: {:10.2f} seconds.".format(time.time() - atime))
+
+    # Save the parameter coverage of the patients
+    if(setting_info['Coverage'] == 1):
+        cov = coverage.makeCoverage(patientdata, labels, patient_info['Hours']['limit'], setting_info['CoverageHours'])
+        cov.save(dirname)
+        cov.writeReport(dirname)
 
     # Create a statistical report
-    reportgen = stat_report.StatReportGenerator(param_info)
-    reportgen.createReport(patientdata, dirname)
+    reportgen = stat_report.StatReportGenerator(param_info, setting_info['Stats'], setting_info['StatsError'])
+    reportgen.createReport(patientdata, dirname, ptp)
+    if(setting_info['Groups'] != ''):
+        groupgen = stat_report.GroupedReportGenerator(param_info, stat_report.parseGroupings(setting_info['Groups']),
+            setting_info['AgeBand'], setting_info['HourBand'])
+        groupgen.createReport(patientdata, dirname)
 
     # Move a copy of the Spec file used into the patient directory.
     copyfile(spec_file, "./"+dirname+"/"+spec_file)
@@ -79,38 +148,158 @@ def dataGen(cur, ptp, spec_file):
     return
 
 
+# This function writes the statistics report of the specifications without extracting
+# the patients: the statistics of each parameter are computed on the database server and
+# only they are returned (see data_access.obtainStats).  The report is written to a new
+# 'patientstats' directory along with a copy of the specifications.
+# cur:      a connection to the MimicIII database
+def statsGen(cur, spec_file):
+
+    starttime = time.time()
+    icu_info, param_info, patient_info, registry = spec_parser.getSpecifications(spec_file)
+    setting_info = spec_parser.getSettings(spec_file)
+
+    dirname = "patientstats " + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    os.makedirs(dirname)
+
+    print("Summarizing the measurements on the database server...")
+    numpatients, rows, leftout = data_access.obtainStats(icu_info, param_info, patient_info, setting_info, registry, cur)
+    print("Number of patients in the cohort: {}".format(numpatients))
+    if(len(leftout) > 0):
+        print("Left out, as their values are interpreted in order for each patient: {}".format(', '.join(leftout)))
+
+    reportgen = stat_report.StatReportGenerator(param_info)
+    reportgen.addAggregates(numpatients, rows, leftout)
+    reportgen.writeReport(dirname)
+    copyfile(spec_file, "./"+dirname+"/"+spec_file)
+
+    print("Total time taken (sec): {:.2f}".format(time.time() - starttime))
+    return
+
+
+
+# This function evaluates the measurements of the patients in parallel, on threads or in
+# worker processes depending on the 'Executor' setting, and returns their PatientSeries.
+# patientlist: the (patient, measurements) tuples of the patients
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+# registry:    the parameter registry from spec_parser.getSpecifications
+# ptp:         an instance of PatientThreadPool for parallel functions
+def processPatients(patientlist, patient_info, setting_info, registry, ptp):
+    if(setting_info['Executor'] == 'process'):
+        ptp.executeProcessFunc(
+            func=patient_processing.evaluatePacked,
+            initializer=patient_processing.initProcess,
+            initargs=(patient_info['Hours']['limit'], registry, setting_info['Evaluation']),
+            items=patientlist,
+            pack=patient_processing.packPatients)
+        return patient_processing.unpackPatients(ptp.getResults())
+    else:
+        ptp.executeFunc(
+            func=patient_processing.evaluatePatients,
+            args=[patient_info['Hours']['limit'], registry, setting_info['Evaluation']], 
+            splitargs=[patientlist],
+            database=False)
+        return ptp.getResults()
+
+
+
+# This function obtains and processes the patients that have not been checkpointed yet,
+# 'CheckpointSize' patients at a time.  Each chunk is written out and then checkpointed,
+# and every checkpointed patient, including those of earlier runs, is returned.
+# ICUInfo:     a list of True/False values that determine which ICUs to use.
+# ParamInfo:   a dictionary of measurement parameters to obtain from the database
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+# registry:    the parameter registry from spec_parser.getSpecifications
+# saved:       the Checkpoint of the run
+# writer:      the function that writes out one patient's measurements
+def resumeData(icu_info, param_info, patient_info, setting_info, registry, cur, ptp, saved, writer):
+    chunks = data_access.obtainChunks(icu_info, param_info, patient_info, setting_info, cur, ptp,
+        saved.completed(), setting_info['CheckpointSize'])
+    for patientlist in chunks:
+        atime = time.time()
+        patients = processPatients(patientlist, patient_info, setting_info, registry, ptp)
+        for patient in patients:
+            writer(patient)
+        saved.save(patients)
+        print("Checkpointed {} patients: {:10.2f} seconds.".format(len(patients), time.time() - atime))
+    return saved.load()
+
+
+# This function writes out the measurements of a patient in the chosen output format.
+# patient:  the PatientSeries of the patient
+# labels:   the parameter labels, by parameter code
+# dirname:  the directory of the patient files
+# output:   'csv', 'columnar' or 'both', from the 'Output' setting
+# columnar: the ColumnarWriter of the dataset, or None when only CSV files are written
+def writeOutput(patient, labels, dirname, output, columnar):
+    if(output != 'columnar'):
+        writePatient(patient, labels, dirname)
+    if(columnar is not None):
+        columnar.add(patient)
+    return
+
+
+# This function writes out the measurements of a patient to its file in the directory.
+# patient:  the PatientSeries of the patient
+# labels:   the parameter labels, by parameter code
+# dirname:  the directory of the patient files
+def writePatient(patient, labels, dirname):
+    with open(os.path.join(dirname, '{}.csv'.format(patient.recordid)), 'w') as f:
+        f.write(patient_series.FILE_HEADER + "\n")
+        for m in patient.getRows(labels):
+            f.write("{},{},{},{:.3f}\n".format(m[0],m[1],m[2],float(m[3])))
+    return
+
+
 if __name__ == '__main__':
 
     print("\nSTARTING PROGRAM\n")
     print("This program will generate a dataset of patients from the Mimic III\n"
         "database based on Specifications.txt.\n")
 
-    # Ensure that we have the correct number of commandline arguments and access them
-    if(len(sys.argv) != 4):
-        print("Insufficient command line arguments given.  Expected: 'python data_gen.py [host] [port] [specfile]'")
+    # Ensure that we have the correct number of commandline arguments and access them.
+    # The host and port may be left out when the data is read from the CSV files.  The
+    # '--stats' flag writes only the statistics report, computed on the database server, and
+    # the '--plan' flag only estimates the size and duration of the run (see run_plan).
+    flags = [a for a in sys.argv[1:] if a.startswith('--')]
+    args = [a for a in sys.argv if not a.startswith('--')]
+    if(len(args) not in (2, 4) or any(flag not in FLAGS for flag in flags)):
+        print("Insufficient command line arguments given.  Expected: 'python data_gen.py [--stats|--plan] [host] [port] [specfile]'"
+            " or, with 'Source; files', 'python data_gen.py [specfile]'")
         exit(0)
-    localhost = sys.argv[1]
-    port = int(sys.argv[2])
 
     # Obtain the specifications file name and make sure that it exists.
-    spec_file = sys.argv[3]
+    spec_file = args[-1]
     if(not os.path.isfile(spec_file)):
         print("Provided specifications file \'"+spec_file+"\' does not exist in the current directory.")
         exit(0)
 
+    # Read the CSV files without a database connection if the specifications ask for it.
+    setting_info = spec_parser.getSettings(spec_file)
+    if(setting_info['Source'] == 'files' and len(flags) == 0):
+        print('\nBeginning patient dataset generation\n')
+        dataGen(None, PatientThreadPool.PatientThreadPool(None, 
+            setting_info['Scheduler'], setting_info['MinChunk']), spec_file)
+        exit(0)
+    if(len(args) != 4):
+        print("Insufficient command line arguments given.  Expected: 'python data_gen.py [--stats|--plan] [host] [port] [specfile]'")
+        exit(0)
+    localhost = args[1]
+    port = int(args[2])
+
     # Prompt the user for access to the database.
     username = raw_input('Enter in your username for accessing Mimic III: ')
     password = getpass.getpass('Enter in your password for accessing Mimic III: ')
 
     conn_info = (username, password, localhost, port)
 
-    # Connect to mimic database.
+    # Connect to mimic database.  The connections are shared by every stage of the run.
     try:
-        con = psycopg2.connect(database= 'mimic',
-            user = conn_info[0],
-            password = conn_info[1],
-            host = conn_info[2],
-            port = conn_info[3])
+        connpool = ConnectionPool.ConnectionPool(conn_info, setting_info['PoolMin'], 
+            setting_info['PoolMax'], setting_info['PoolRetries'])
+        con = connpool.getconn()
     except:
         print("Could not connect to Mimic III. Please make sure the database is accessible and try again.\n")
         exit(0)
@@ -118,11 +307,30 @@ if __name__ == '__main__':
     # Use a dictionary cursor to interact with database.
     cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-    # Create patient dataset in parallel; pass in UN and PW for threaded database connections
-    ptp = PatientThreadPool.PatientThreadPool(conn_info)
+    # Only summarize the cohort on the server if asked to.
+    if('--stats' in flags):
+        print('\nBeginning the statistics report\n')
+        statsGen(cur, spec_file)
+        connpool.putconn(con)
+        connpool.closeall()
+        exit(0)
+
+    # Only estimate the run if asked to.
+    if('--plan' in flags):
+        print('\nBeginning the run estimates\n')
+        icu_info, param_info, patient_info, registry = spec_parser.getSpecifications(spec_file)
+        run_plan.planRun(icu_info, param_info, patient_info, setting_info, registry, cur, connpool)
+        connpool.putconn(con)
+        connpool.closeall()
+        exit(0)
+
+    # Create patient dataset in parallel; threads take their connections from the pool
+    ptp = PatientThreadPool.PatientThreadPool(connpool, setting_info['Scheduler'], setting_info['MinChunk'])
 
     # Create patient dataset
     print('\nBeginning patient dataset generation\n')
     dataGen(cur, ptp, spec_file)
+    connpool.putconn(con)
+    connpool.closeall()
 
 
@@ -0,0 +1,180 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: Extraction Cache
+-- Description: This module contains the class that keeps the raw measurement rows of
+-- patients on disk between runs, so that a run only obtains the measurement IDs and
+-- patients that earlier runs have not.
+--
+-- Each patient, identified by (subject_id, hadm_id), has one cache file holding the
+-- rows of every measurement ID obtained for it, along with the ICU intime and hours
+-- window the rows were obtained for.  The least recently used files are removed once
+-- the cache grows beyond its size limit.
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import os
+import sys
+import pickle
+import threading
+
+# Related 3rd party imports
+# ...
+
+# Local application imports
+# ...
+
+# The version of the cached rows.  Entries of other versions are ignored.
+CACHE_VERSION = 1
+
+class ExtractionCache:
+
+    # This function initializes the extraction cache.
+    # directory:    The directory the cache files are kept in.
+    # maxsize:      The size in megabytes that the cache is limited to.
+    def __init__ (self, directory, maxsize):
+        self.directory = directory
+        self.maxbytes = maxsize * 1024 * 1024
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if(not os.path.isdir(directory)):
+            os.makedirs(directory)
+        return
+
+
+    # This function returns the cached rows of a patient's measurement IDs and the set of
+    # measurement IDs that are not cached.  Rows outside of the hours window are left out.
+    # patient:      The patient, with the subject_id, hadm_id and intime at 0, 2 and 5
+    # m_ids:        The measurement IDs wanted
+    # hours:        The total number of hours from an ICU stay that are desired.
+    def lookup(self, patient, m_ids, hours):
+        entry = self.readEntry(patient, hours)
+        if(entry is None):
+            self.misses += 1
+            return [], set(m_ids)
+
+        rows = []
+        missing = set()
+        for m in set(m_ids):
+            if(m not in entry['items']):
+                missing.add(m)
+            elif(hours == -1):
+                rows += entry['items'][m]
+            else:
+                rows += [row for row in entry['items'][m] if row[4] < hours * 60]
+
+        if(len(missing) == 0):
+            self.hits += 1
+        else:
+            self.misses += 1
+        return rows, missing
+
+
+    # This function stores the rows of a patient's measurement IDs in its cache file.  The
+    # other measurement IDs of the file are kept if they were cached for the same hours 
+    # window.
+    # patient:      The patient, with the subject_id, hadm_id and intime at 0, 2 and 5
+    # m_ids:        The measurement IDs the rows were obtained for
+    # hours:        The hours window the rows were obtained for
+    # rows:         All rows of the measurement IDs
+    def store(self, patient, m_ids, hours, rows):
+        entry = self.readEntry(patient, hours)
+        if(entry is None or entry['hours'] != hours):
+            entry = {'version': CACHE_VERSION, 'intime': patient[5], 'hours': hours, 'items': {}}
+
+        for m in m_ids:
+            entry['items'][m] = []
+        for row in rows:
+            entry['items'].setdefault(row[2], []).append(tuple(row[:5]))
+
+        with open(self.getPath(patient), 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        return
+
+
+    # This function removes the least recently used cache files until the cache is
+    # within its size limit.
+    def evict(self):
+        self.lock.acquire()
+        try:
+            files = []
+            total = 0
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+            removed = 0
+            for mtime, size, path in sorted(files):
+                if(total <= self.maxbytes):
+                    break
+                os.remove(path)
+                total -= size
+                removed += 1
+        finally:
+            self.lock.release()
+
+        if(removed > 0):
+            print("Removed {} patients from the extraction cache.".format(removed))
+        return
+
+
+    # This function removes every cache file.
+    def clear(self):
+        self.lock.acquire()
+        try:
+            for name in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, name))
+        finally:
+            self.lock.release()
+        return
+
+
+    # This function reads the cache file of a patient.  Files that were obtained for a
+    # different intime, a smaller hours window or another cache version are ignored.
+    # patient:      The patient, with the subject_id, hadm_id and intime at 0, 2 and 5
+    # hours:        The total number of hours from an ICU stay that are desired.
+    def readEntry(self, patient, hours):
+        path = self.getPath(patient)
+        if(not os.path.isfile(path)):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except Exception:
+            return None
+
+        if(entry['version'] != CACHE_VERSION or entry['intime'] != patient[5]):
+            return None
+        if(entry['hours'] != -1 and (hours == -1 or entry['hours'] < hours)):
+            return None
+
+        # Mark the file as recently used.
+        os.utime(path, None)
+        return entry
+
+
+    # This function returns the path of a patient's cache file.
+    # patient:      The patient, with the subject_id and hadm_id at 0 and 2
+    def getPath(self, patient):
+        return os.path.join(self.directory, '{}_{}.pickle'.format(patient[0], patient[2]))
+
+
+if __name__ == '__main__':
+
+    # Ensure that we have the correct number of commandline arguments.
+    if(len(sys.argv) != 2):
+        print("Insufficient command line arguments given.  Expected: 'python extraction_cache.py [cachedir]' to clear the cache.")
+        exit(0)
+
+    # Test if the provided path is a valid directory. If so, clear it.
+    if(not os.path.isdir(sys.argv[1])):
+        print("The given path \'{}\' is not a directory.".format(sys.argv[1]))
+        exit(0)
+    ExtractionCache(sys.argv[1], 0).clear()
+    print("Cleared the extraction cache.")
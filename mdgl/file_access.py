@@ -0,0 +1,447 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: File Accessor
+-- Description: This module obtains the same patient and measurement information as
+-- data_access.py, but reads it from the MIMIC-III CSV files instead of the database.
+--
+-- The event tables are large, so the first run streams them once and stores the rows
+-- of the needed measurement IDs in a columnar store partitioned by subject.  Later runs
+-- only read the partitions of the cohort, and only convert measurement IDs that are
+-- not in the store yet.  The store manifest records the chunk files of each partition
+-- once a table has been completely converted; chunks written by a conversion that was
+-- interrupted are removed before the table is converted again.
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import os
+import sys
+import csv
+import gzip
+import time
+import pickle
+import calendar
+import datetime
+
+# Related 3rd party imports
+import numpy as np
+
+# Local application imports
+import data_access
+
+# The number of partitions rows are divided into, by subject_id.
+NUM_PARTITIONS = 64
+
+# The number of converted rows buffered before they are written to the store.
+CHUNK_ROWS = 1000000
+
+# The event tables of the store, and the CSV file each is converted from.
+EVENT_TABLES = (('labevents', 'LABEVENTS'), ('chartevents', 'CHARTEVENTS'), ('outputevents', 'OUTPUTEVENTS'))
+
+# The chart event IDs used for the weight and height of patients.
+WEIGHT_IDS = (762, 763, 3723, 3580, 3581, 3582)
+HEIGHT_IDS = (920, 1394, 4187, 3486, 3485, 4188, 226707, 226730)
+
+# The reference time that chart times are stored relative to.
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+# The function below takes the specification information and reads the dataset from the
+# MIMIC-III CSV files.  It returns the same (patient, measurements) tuples as
+# data_access.obtainData.
+# ICUInfo:     a list of True/False values that determine which ICUs to use.
+# ParamInfo:   a dictionary of measurement parameters to obtain from the files
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+# ptp:         an instance of PatientThreadPool for parallel functions
+def obtainData(icu_info, param_info, patient_info, setting_info, ptp):
+    source_dir = setting_info['SourceDir']
+    store_dir = setting_info['StoreDir']
+    m_ids = data_access.getMeasurementIds(param_info)
+
+    # Make sure that the store holds all of the needed measurement IDs.
+    atime = time.time()
+    updateStore(source_dir, store_dir, set(m_ids) | set(WEIGHT_IDS) | set(HEIGHT_IDS))
+    print('Updated the measurement store: {:10.2f} seconds.\n'.format(time.time() - atime))
+
+    # Obtain the patients and group them by partition.
+    atime = time.time()
+    patients = obtainPatients(icu_info, patient_info, source_dir)
+    partitions = {}
+    for patient in patients:
+        partitions.setdefault(patient[0] % NUM_PARTITIONS, []).append(patient)
+
+    # Obtain the weight, height and measurements of the patients of each partition.
+    ptp.executeFunc(
+        func=obtainPartitions,
+        args=[store_dir, m_ids, patient_info['Hours']['limit']],
+        splitargs=[sorted(partitions.items())])
+    patientlist = ptp.getResults()
+    print('Obtained measurements from files: {:10.2f} seconds.\n'.format(time.time() - atime))
+
+    # Return the patient measurement information gathered.
+    return patientlist
+
+
+
+# This function reads the patients from the ICUSTAYS and PATIENTS files, applying the same
+# selection as the patient query of data_access.makeQueries.  Each patient has the columns
+# subject_id, icustay_id, hadm_id, los, first_careunit, intime, dob, gender and lasttime.
+# ICUInfo:     a list of True/False values that determine which ICUs to use.
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# source_dir:  the directory containing the MIMIC-III CSV files
+def obtainPatients(icu_info, patient_info, source_dir):
+    if(len(icu_info) == 0):
+        sys.stderr.write("Specifications.txt Error: At least one ICU type must be included")
+        exit(0)
+
+    # Obtain the date of birth and gender of every subject.
+    subjects = {}
+    for row in readTable(source_dir, 'PATIENTS'):
+        subjects[int(row['subject_id'])] = (parseDateTime(row['dob']), row['gender'])
+
+    # Keep only the last ICU stay of every subject.
+    stays = {}
+    for row in readTable(source_dir, 'ICUSTAYS'):
+        subject_id = int(row['subject_id'])
+        intime = parseDateTime(row['intime'])
+        if(subject_id not in stays or intime > stays[subject_id][5]):
+            stays[subject_id] = [subject_id, int(row['icustay_id']), int(row['hadm_id']),
+                None if row['los'] == '' else float(row['los']), row['first_careunit'], intime]
+
+    # Apply the patient selection of the specifications.
+    sexes = ('M', 'F') if patient_info['Sex'] == 'Both' else (patient_info['Sex'],)
+    patients = []
+    for subject_id in sorted(stays.keys()):
+        stay = stays[subject_id]
+        dob, gender = subjects[subject_id]
+        if(patient_info['Hours']['req'] == 1 and
+                (stay[3] is None or stay[3] < patient_info['Hours']['limit'] / 24)):
+            continue
+        if(stay[5] <= addYears(dob, patient_info['Age']['min']) or
+                stay[5] >= addYears(dob, patient_info['Age']['max'])):
+            continue
+        if(gender not in sexes or stay[4] not in icu_info):
+            continue
+        patients.append(stay + [dob, gender, 1])
+    return patients
+
+
+
+# The worker thread to be used for accessing the weight, height and measurements of the
+# patients of partitions of the store.
+# store_dir:    The directory of the measurement store
+# m_ids:        The list of measurement IDs to extract
+# hours:        The total number of hours from an ICU stay that are desired.
+# partitions:   The list of (partition, patients) tuples to extract measurements for
+# ptp:          The thread pool class instance.  Used to synchronize returned results.
+# cur:          Unused; the thread pool's database connection.
+def obtainPartitions(args):
+    store_dir   = args[0]
+    m_ids       = np.array(sorted(set(args[1])), dtype=np.int32)
+    hours       = args[2]
+    partitions  = args[3]
+    ptp         = args[4]
+
+    print("Thread starting - {} partitions to process...".format(len(partitions)))
+
+    patientlist = []
+    for partition, patients in partitions:
+        events = dict((table, loadPartition(store_dir, table, partition)) for table, name in EVENT_TABLES)
+        for patient in patients:
+            intime = toSeconds(patient[5])
+
+            # Obtain the weight and height.
+            height, weight = findWeightandHeight(events['chartevents'], patient, intime)
+            patient = patient + [height, weight]
+
+            # Obtain the measurements of every table in chart time order.
+            selected = []
+            for table, name in EVENT_TABLES:
+                cols = selectRows(events[table], patient[0])
+                mask = (cols['hadm_id'] == patient[2]) & np.isin(cols['itemid'], m_ids)
+                mask &= cols['charttime'] >= intime
+                if(hours != -1):
+                    mask &= cols['charttime'] < intime + hours * 3600
+                selected.append(dict((key, cols[key][mask]) for key in ('charttime', 'itemid', 'value')))
+            charttimes = np.concatenate([cols['charttime'] for cols in selected])
+            itemids = np.concatenate([cols['itemid'] for cols in selected])
+            values = np.concatenate([cols['value'] for cols in selected])
+            order = np.argsort(charttimes, kind='mergesort')
+
+            mlist = []
+            for i in order:
+                t = int(charttimes[i])
+                mlist.append([patient[0], EPOCH + datetime.timedelta(seconds=t), int(itemids[i]),
+                    str(values[i]), (t - intime) // 60])
+            patientlist.append((patient, mlist))
+
+    # Update the patient results before returning
+    ptp.lock.acquire()
+    try:
+        ptp.results += patientlist
+    finally:
+        ptp.lock.release()
+    print("Thread finishing...")
+    return
+
+
+
+# This function finds a patient's weight and height in the same way as the queries of
+# data_access.obtainWeightandHeight: the most recent weight and the first height recorded
+# in the hospital admission up to the ICU intime, or -1 if there is none.
+# chartevents:  the chart event columns of the patient's partition
+# patient:      the patient
+# intime:       the ICU intime of the patient, in seconds
+def findWeightandHeight(chartevents, patient, intime):
+    cols = selectRows(chartevents, patient[0])
+    mask = (cols['hadm_id'] == patient[2]) & (cols['charttime'] <= intime) & ~np.isnan(cols['valuenum'])
+
+    weight = -1.0
+    wrows = np.nonzero(mask & np.isin(cols['itemid'], WEIGHT_IDS))[0]
+    if(len(wrows) > 0):
+        i = wrows[-1]
+        weight = float(cols['valuenum'][i])
+        if(cols['itemid'][i] == 3581):
+            weight *= 0.45359
+        elif(cols['itemid'][i] == 3582):
+            weight *= 0.028349
+
+    height = -1.0
+    hrows = np.nonzero(mask & np.isin(cols['itemid'], HEIGHT_IDS))[0]
+    if(len(hrows) > 0):
+        i = hrows[0]
+        height = float(cols['valuenum'][i])
+        if(cols['itemid'][i] in (920, 1394, 4187, 3486, 226707)):
+            height *= 2.54
+    return height, weight
+
+
+
+# This function returns the columns of the rows of a subject.  The columns of a partition
+# are sorted by subject and chart time.
+# cols:         the columns of a partition
+# subject_id:   the subject to select
+def selectRows(cols, subject_id):
+    start = np.searchsorted(cols['subject_id'], subject_id, side='left')
+    end = np.searchsorted(cols['subject_id'], subject_id, side='right')
+    return dict((key, cols[key][start:end]) for key in cols.keys())
+
+
+
+# This function loads the columns of a partition of an event table, sorted by subject and
+# chart time.
+# store_dir:    The directory of the measurement store
+# table:        The event table
+# partition:    The partition number
+def loadPartition(store_dir, table, partition):
+    directory = os.path.join(store_dir, table, '{:03}'.format(partition))
+    parts = []
+    if(os.path.isdir(directory)):
+        for f in sorted(os.listdir(directory)):
+            with np.load(os.path.join(directory, f)) as data:
+                parts.append(dict((key, data[key]) for key in data.files))
+
+    if(len(parts) == 0):
+        return makeColumns([])
+    cols = dict((key, np.concatenate([part[key] for part in parts])) for key in parts[0].keys())
+    order = np.lexsort((cols['charttime'], cols['subject_id']))
+    return dict((key, cols[key][order]) for key in cols.keys())
+
+
+
+# This function converts the event tables into the store for every measurement ID that is
+# not in the store yet.  The IDs converted for each table, and the number of chunk files of
+# each of its partitions, are kept in the store manifest.
+# source_dir:   the directory containing the MIMIC-III CSV files
+# store_dir:    The directory of the measurement store
+# m_ids:        The set of measurement IDs needed
+def updateStore(source_dir, store_dir, m_ids):
+    manifest_file = os.path.join(store_dir, 'manifest.pickle')
+    manifest = dict((table, set()) for table, name in EVENT_TABLES)
+    manifest['chunks'] = dict((table, {}) for table, name in EVENT_TABLES)
+    if(os.path.isfile(manifest_file)):
+        with open(manifest_file, 'rb') as f:
+            manifest = pickle.load(f)
+
+        # Stores made before chunks were recorded are taken to be complete.
+        if('chunks' not in manifest):
+            manifest['chunks'] = dict((table, countChunks(store_dir, table)) for table, name in EVENT_TABLES)
+
+    for table, name in EVENT_TABLES:
+        removeChunks(store_dir, table, manifest['chunks'][table])
+        missing = set(m_ids) - manifest[table]
+        if(len(missing) > 0):
+            print("Converting {} measurement IDs from {}...".format(len(missing), name))
+            convertTable(source_dir, store_dir, table, name, missing)
+
+            # Record the conversion only once the table has been completely converted.
+            manifest[table] |= missing
+            manifest['chunks'][table] = countChunks(store_dir, table)
+            if(not os.path.isdir(store_dir)):
+                os.makedirs(store_dir)
+            with open(manifest_file + '.tmp', 'wb') as f:
+                pickle.dump(manifest, f)
+            os.rename(manifest_file + '.tmp', manifest_file)
+    return
+
+
+
+# This function returns the number of chunk files in each partition of an event table.
+# store_dir:    The directory of the measurement store
+# table:        The event table
+def countChunks(store_dir, table):
+    directory = os.path.join(store_dir, table)
+    if(not os.path.isdir(directory)):
+        return {}
+    return dict((partition, len(os.listdir(os.path.join(directory, partition))))
+        for partition in os.listdir(directory))
+
+
+
+# This function removes the chunk files of an event table that are not recorded in the
+# manifest, which are left behind when a conversion is interrupted.  Chunk files are
+# numbered in the order they are written, so those past the recorded count are removed.
+# store_dir:    The directory of the measurement store
+# table:        The event table
+# chunks:       The recorded number of chunk files of each partition
+def removeChunks(store_dir, table, chunks):
+    for partition, count in countChunks(store_dir, table).items():
+        directory = os.path.join(store_dir, table, partition)
+        for f in sorted(os.listdir(directory))[chunks.get(partition, 0):]:
+            os.remove(os.path.join(directory, f))
+    return
+
+
+
+# This function streams an event table file and writes the rows of the given measurement
+# IDs to the store, applying the same value filters and conversions as the measurement
+# queries of data_access.
+# source_dir:   the directory containing the MIMIC-III CSV files
+# store_dir:    The directory of the measurement store
+# table:        The event table
+# name:         The name of the event table file
+# m_ids:        The set of measurement IDs to convert
+def convertTable(source_dir, store_dir, table, name, m_ids):
+    buffers = {}
+    numrows = 0
+    for row in readTable(source_dir, name):
+        itemid = int(row['itemid'])
+        if(itemid not in m_ids or row['charttime'] == '' or row['value'] == ''):
+            continue
+
+        # Interpret mechanical ventilation in the same way as the chart events query.
+        value = row['value']
+        if(table == 'chartevents' and itemid in (467, 468, 720, 722)):
+            if((itemid in (467, 468) and value == 'None') or
+                    (itemid in (720, 722) and row['stopped'] == "D/C'd")):
+                value = '2.0'
+            else:
+                value = '1.0'
+
+        subject_id = int(row['subject_id'])
+        buffers.setdefault(subject_id % NUM_PARTITIONS, []).append((
+            subject_id,
+            -1 if row['hadm_id'] == '' else int(row['hadm_id']),
+            itemid,
+            parseSeconds(row['charttime']),
+            value,
+            np.nan if row.get('valuenum', '') == '' else float(row['valuenum'])))
+
+        # Write out the buffered rows once there are enough of them.
+        numrows += 1
+        if(numrows >= CHUNK_ROWS):
+            writeChunk(store_dir, table, buffers)
+            buffers = {}
+            numrows = 0
+    writeChunk(store_dir, table, buffers)
+    return
+
+
+
+# This function writes buffered rows to the store as one new file per partition.
+# store_dir:    The directory of the measurement store
+# table:        The event table
+# buffers:      A dictionary of the rows of each partition
+def writeChunk(store_dir, table, buffers):
+    for partition, rows in buffers.items():
+        directory = os.path.join(store_dir, table, '{:03}'.format(partition))
+        if(not os.path.isdir(directory)):
+            os.makedirs(directory)
+        path = os.path.join(directory, '{:06}.npz'.format(len(os.listdir(directory))))
+        np.savez(path, **makeColumns(rows))
+    return
+
+
+
+# This function converts rows of (subject_id, hadm_id, itemid, charttime, value, valuenum)
+# into the columns of the store.
+# rows:         The rows to convert
+def makeColumns(rows):
+    cols = list(zip(*rows)) if len(rows) > 0 else [[]] * 6
+    return {
+        'subject_id':   np.array(cols[0], dtype=np.int32),
+        'hadm_id':      np.array(cols[1], dtype=np.int32),
+        'itemid':       np.array(cols[2], dtype=np.int32),
+        'charttime':    np.array(cols[3], dtype=np.int64),
+        'value':        np.array(cols[4], dtype=np.str_),
+        'valuenum':     np.array(cols[5], dtype=np.float64),
+    }
+
+
+
+# This generator yields the rows of a MIMIC-III CSV file as dictionaries keyed by the lower
+# case column names.  The file may be compressed with gzip.
+# source_dir:   the directory containing the MIMIC-III CSV files
+# name:         the name of the file, without extension
+def readTable(source_dir, name):
+    path = os.path.join(source_dir, name + '.csv')
+    if(os.path.isfile(path)):
+        f = open(path, 'rb') if sys.version_info[0] < 3 else open(path, 'r', newline='')
+    elif(os.path.isfile(path + '.gz')):
+        f = gzip.open(path + '.gz', 'rb') if sys.version_info[0] < 3 else gzip.open(path + '.gz', 'rt', newline='')
+    else:
+        sys.stderr.write("Error: the MIMIC-III file {} was not found in '{}'.\n".format(name, source_dir))
+        exit(0)
+
+    try:
+        reader = csv.reader(f)
+        header = [column.strip().lower() for column in next(reader)]
+        for row in reader:
+            yield dict(zip(header, row))
+    finally:
+        f.close()
+    return
+
+
+
+# This function converts a MIMIC-III time stamp into seconds since EPOCH.
+# text:         the time stamp, formatted as 'YYYY-MM-DD HH:MM:SS'
+def parseSeconds(text):
+    return calendar.timegm((int(text[0:4]), int(text[5:7]), int(text[8:10]),
+        int(text[11:13] or 0), int(text[14:16] or 0), int(text[17:19] or 0)))
+
+# This function converts a MIMIC-III time stamp into a datetime.
+# text:         the time stamp, formatted as 'YYYY-MM-DD HH:MM:SS'
+def parseDateTime(text):
+    return EPOCH + datetime.timedelta(seconds=parseSeconds(text))
+
+# This function converts a datetime into seconds since EPOCH.
+# dt:           the datetime
+def toSeconds(dt):
+    delta = dt - EPOCH
+    return delta.days * 86400 + delta.seconds
+
+# This function adds a number of years to a datetime in the same way as adding an
+# interval in years does in Postgres: February 29th becomes February 28th when needed.
+# dt:           the datetime
+# years:        the number of years to add
+def addYears(dt, years):
+    if(dt.year + years > datetime.MAXYEAR):
+        return datetime.datetime.max
+    try:
+        return dt.replace(year=dt.year + years)
+    except ValueError:
+        return dt.replace(year=dt.year + years, day=28)
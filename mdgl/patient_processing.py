@@ -9,96 +9,65 @@ from __future__ import division
 '''
 
 # Standard library imports
-# ...
+import re
+import datetime
+import operator
+import threading
 
 # Related 3rd party imports
-# ...
+import numpy as np
 
 # Local application imports
-# ...
+import patient_series
 
 
-# This function takes in patient information and patient measurement information  
+# The item IDs of mechanical ventilation measurements.
+MECHVENT_IDS = (467, 468, 720, 722)
+
+# The patterns of censored values, reported as below or above a threshold.
+CENSORED_BELOW = re.compile('<|LESS')
+CENSORED_ABOVE = re.compile('>|GREATER')
+
+# The reference time that chart times are sent to worker processes relative to.
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# The hours and parameter registry of a worker process, set once by initProcess.
+process_info = {}
+
+# The number of values of each measurement ID that could not be interpreted, and its lock.
+invalid_counts = {}
+invalid_lock = threading.Lock()
+
+
+# This function takes in patient information and patient measurement information and
+# adds a PatientSeries of each patient to the results.
 # hours:        This is the total number of hours from an ICU stay that are desired.
-# paraminfo:    This is the parameter information gathered from Specifications.txt
+# registry:     The parameter registry from spec_parser.getSpecifications
+# evaluation:   The way measurements are evaluated, 'loop' or 'numpy' (see EVALUATORS)
 # data:         This tuple contains the patient and measurement data needed to create
-#               the patient information files.
+#               the patient information files.  It may also be a generator of tuples.
 # ptp:          The thread pool class instance.  Used to synchronize returned results.
 def evaluatePatients(args):
     hours       = args[0]
-    paraminfo   = args[1]
-    data        = args[2]
-    ptp         = args[3]
+    registry    = args[1]
+    evaluate    = EVALUATORS[args[2]]
+    data        = args[3]
+    ptp         = args[4]
 
     patient_info = []
-    ICUs = ['CCU', 'SICU', 'MICU', 'NICU', 'CSRU', 'TSICU']
+    invalid = {}
 
-    print("Thread starting - {} patients to process...".format(len(data)))
+    if(hasattr(data, '__len__')):
+        print("Thread starting - {} patients to process...".format(len(data)))
 
     # Process each patient and their measurements
     for patient, measurements in data:
-        pmeasurements = []
-        invalidmeasurements = []
-
-        # Store static measurements for the patient
-        pmeasurements.append(['00:00','RecordID', '-1', patient[0]])
-        pmeasurements.append(['00:00','Age', '-1', (patient[5]-patient[6]).days // 365])
-        pmeasurements.append(['00:00','Gender', '-1', 0 if patient[7] == 'F' else 1])
-        pmeasurements.append(['00:00','Height', '-1', patient[9]])
-        pmeasurements.append(['00:00','ICUType', '-1', ICUs.index(patient[4])])
-        pmeasurements.append(['00:00','Weight', '-1', patient[10]])
-
-        # Be able to handle mechanical ventilation interpretation
-        lastvent = None
-
-        # Process all measurements for this patient
-        for mim in measurements:
-            timediff = mim[1] - patient[5]
-            elapsedhours = timediff.days * 24 + timediff.seconds // 3600
-            elapsedminutes = (timediff.seconds % 3600) // 60
-            if(elapsedhours >= 0 and elapsedminutes >= 0):
-
-                # Stop once measurements exceed desired number of hours
-                if(hours != -1 and (elapsedhours >= hours and elapsedminutes >= 0)):
-                    break
-
-                # Choose the proper label for the measurement
-                label = filter(lambda param: mim[2] in param['ids'], paraminfo.values())[0]['abbr']
-
-                # Store dynamic measurements for the patient
-                try:
-                    val = 0.0
-
-                    ####################################################
-                    #   Apply custom filters to interpret data.
-                    ####################################################
-
-                    # Handle the value of mechanical ventilation measurements.
-                    if(mim[2] in (467,468,720,722)):
-                        val, lastvent = handleMechVent(mim, lastvent)
-                    
-                    # Handle the value of troponin measurements.
-                    elif(mim[2] in (51002, 51003, 227429)):
-                        val = handleTroponin(mim)
-
-                    ####################################################
-                    #   Otherwise no specific handling needed.
-                    ####################################################
-
-                    # Handle the value of measurements that aren't examined in a special way.
-                    else:
-                        val = float(mim[3])
-
-                    # Store this measurement for the current patient.
-                    pmeasurements.append(['{:02}:{:02}'.format(elapsedhours,elapsedminutes),label,mim[2],val])
-                except:
-                    invalidmeasurements.append(
-                        'PatientID - {}, Time - {:02}:{:02}, Measurement - {}, \
-                        MeasurementID - {}, Value - {}'.format(patient[0], elapsedhours, 
-                        elapsedminutes, label, mim[2], mim[3]))
-
-        # Add the current patient's measurements to the patient_info list
-        patient_info.append(pmeasurements)
+
+        # Evaluate the dynamic measurements and store them with the static measurements
+        # of the patient.
+        minutes, itemids, values = evaluate(measurements, hours, registry, invalid)
+        patient_info.append(patient_series.makeSeries(
+            [m[3] for m in getStaticMeasurements(patient)], minutes, itemids, values, registry))
 
     # Update the patient results before returning 
     ptp.lock.acquire()
@@ -106,15 +75,245 @@ def evaluatePatients(args):
         ptp.results += patient_info
     finally:
         ptp.lock.release()
+    addInvalid(invalid)
     print("Thread finishing...")
     return 
 
 
 
+# This function returns the static measurements of a patient.
+# patient:      The patient information obtained from the database
+def getStaticMeasurements(patient):
+    ICUs = ['CCU', 'SICU', 'MICU', 'NICU', 'CSRU', 'TSICU']
+    pmeasurements = []
+    pmeasurements.append(['00:00','RecordID', '-1', patient[0]])
+    pmeasurements.append(['00:00','Age', '-1', (patient[5]-patient[6]).days // 365])
+    pmeasurements.append(['00:00','Gender', '-1', 0 if patient[7] == 'F' else 1])
+    pmeasurements.append(['00:00','Height', '-1', patient[9]])
+    pmeasurements.append(['00:00','ICUType', '-1', ICUs.index(patient[4])])
+    pmeasurements.append(['00:00','Weight', '-1', patient[10]])
+    return pmeasurements
+
+
+
+# This function interprets a patient's measurements and returns the valid ones as 
+# [elapsed minutes, label, measurement ID, value] lists.
+# measurements: The patient's measurement rows, ordered by chart time
+# hours:        This is the total number of hours from an ICU stay that are desired.
+# registry:     The parameter registry from spec_parser.getSpecifications
+# invalid:      The number of invalid values of each measurement ID, updated here
+def evaluateMeasurements(measurements, hours, registry, invalid):
+    pmeasurements = []
+
+    # Be able to handle mechanical ventilation interpretation
+    state = {'lastvent': None}
+
+    # Process all measurements for this patient
+    for mim in measurements:
+        # The minutes elapsed since the ICU intime are computed by the database.
+        elapsedhours = mim[4] // 60
+        elapsedminutes = mim[4] % 60
+        if(elapsedhours >= 0 and elapsedminutes >= 0):
+
+            # Stop once measurements exceed desired number of hours
+            if(hours != -1 and (elapsedhours >= hours and elapsedminutes >= 0)):
+                break
+
+            # Choose the proper label and the handler of the measurement
+            label, code, handler = registry[mim[2]]
+
+            # Store dynamic measurements for the patient
+            try:
+                # Apply the custom filter of the measurement ID to interpret the data
+                # (see HANDLERS).
+                val = handler(mim, state)
+
+                # Store this measurement for the current patient.
+                pmeasurements.append([mim[4],label,mim[2],val])
+            except:
+                invalid[mim[2]] = invalid.get(mim[2], 0) + 1
+
+    return pmeasurements
+
+
+
+# This function evaluates a patient's measurements one at a time with evaluateMeasurements,
+# and returns the elapsed minutes, measurement IDs and values as arrays like evaluateArrays.
+# measurements: The patient's measurement rows, ordered by chart time
+# hours:        This is the total number of hours from an ICU stay that are desired.
+# registry:     The parameter registry from spec_parser.getSpecifications
+# invalid:      The number of invalid values of each measurement ID, updated here
+def evaluateLoop(measurements, hours, registry, invalid):
+    evaluated = evaluateMeasurements(measurements, hours, registry, invalid)
+    return (np.array([m[0] for m in evaluated], dtype=np.int64),
+        np.array([m[2] for m in evaluated], dtype=np.int32),
+        np.array([m[3] for m in evaluated], dtype=np.float64))
+
+
+
+# This function evaluates a patient's measurements working on arrays of the whole 
+# measurement stream instead of one measurement at a time, and returns the elapsed minutes,
+# measurement IDs and values of the valid measurements as arrays.  The hours window is 
+# found with a binary search and the values of measurements without a special handler are
+# converted to numbers together.  Values that are not plain numbers are given to their
+# handler, if any, and the measurements with a stateful handler, such as mechanical
+# ventilation, are interpreted one at a time, in order.
+# measurements: The patient's measurement rows, ordered by chart time
+# hours:        This is the total number of hours from an ICU stay that are desired.
+# registry:     The parameter registry from spec_parser.getSpecifications
+# invalid:      The number of invalid values of each measurement ID, updated here
+def evaluateArrays(measurements, hours, registry, invalid):
+    minutes = np.array(list(map(operator.itemgetter(4), measurements)), dtype=np.int64)
+
+    # Measurements are ordered by chart time, so the measurements before the ICU intime 
+    # come first and the measurements stop at the first one beyond the desired hours.
+    start = np.searchsorted(minutes, 0, 'left')
+    end = len(minutes) if hours == -1 else max(start, np.searchsorted(minutes, hours * 60, 'left'))
+    minutes = minutes[start:end]
+    itemids = np.array(list(map(operator.itemgetter(2), measurements[start:end])), dtype=np.int32)
+    values = list(map(operator.itemgetter(3), measurements[start:end]))
+
+    # Find the measurements with a stateful handler, looking up each distinct ID once.
+    ids, inverse = np.unique(itemids, return_inverse=True)
+    handlers = [registry[m][2] for m in ids.tolist()]
+    stateful = np.array([handler in STATEFUL_HANDLERS for handler in handlers], dtype=bool)[inverse]
+    if(not stateful.any()):
+        numbers, valid = parseValues(values)
+    else:
+        numbers = np.zeros(len(minutes), dtype=np.float64)
+        valid = np.zeros(len(minutes), dtype=bool)
+        plain = np.flatnonzero(~stateful)
+        numbers[plain], valid[plain] = parseValues([values[i] for i in plain.tolist()])
+
+    # Interpret the values that are not plain numbers, then the stateful measurements in order.
+    for i in np.flatnonzero(~valid & ~stateful).tolist():
+        handler = handlers[inverse[i]]
+        if(handler is not handleValue):
+            try:
+                numbers[i] = handler(measurements[start + i], None)
+                valid[i] = True
+            except:
+                pass
+    state = {'lastvent': None}
+    for i in np.flatnonzero(stateful).tolist():
+        try:
+            numbers[i] = handlers[inverse[i]](measurements[start + i], state)
+            valid[i] = True
+        except:
+            pass
+
+    if(valid.all()):
+        return minutes, itemids, numbers
+    for m in itemids[~valid].tolist():
+        invalid[m] = invalid.get(m, 0) + 1
+    return minutes[valid], itemids[valid], numbers[valid]
+
+
+
+# This function converts measurement values to numbers, returning the numbers and whether
+# each value could be converted.  The values are converted in one pass, and only if one 
+# of them cannot be converted are they converted one at a time.
+# values:       The measurement values
+def parseValues(values):
+    try:
+        return np.array(list(map(float, values)), dtype=np.float64), np.ones(len(values), dtype=bool)
+    except:
+        pass
+
+    numbers = np.zeros(len(values), dtype=np.float64)
+    valid = np.ones(len(values), dtype=bool)
+    for i, val in enumerate(values):
+        try:
+            numbers[i] = float(val)
+        except:
+            valid[i] = False
+    return numbers, valid
+
+
+
+# This function initializes a worker process of the process pool with the information
+# shared by all patients, so that it is only sent to each process once.
+# hours:        This is the total number of hours from an ICU stay that are desired.
+# registry:     The parameter registry from spec_parser.getSpecifications
+# evaluation:   The way measurements are evaluated, 'loop' or 'numpy' (see EVALUATORS)
+def initProcess(hours, registry, evaluation):
+    process_info['hours'] = hours
+    process_info['registry'] = registry
+    process_info['evaluate'] = EVALUATORS[evaluation]
+    return
+
+
+
+# This function packs (patient, measurements) tuples into a compact form for sending to 
+# worker processes: the static measurement values, the chart times in seconds (needed 
+# only for mechanical ventilation), the measurement IDs and elapsed minutes as arrays, and
+# the values joined into one string.
+# data:         The (patient, measurements) tuples to pack
+def packPatients(data):
+    packed = []
+    for patient, measurements in data:
+        seconds = np.zeros(len(measurements), dtype=np.int64)
+        for i, mim in enumerate(measurements):
+            if(mim[2] in MECHVENT_IDS):
+                delta = mim[1] - EPOCH
+                seconds[i] = delta.days * 86400 + delta.seconds
+        packed.append((
+            [m[3] for m in getStaticMeasurements(patient)],
+            seconds,
+            np.array([mim[2] for mim in measurements], dtype=np.int32),
+            np.array([mim[4] for mim in measurements], dtype=np.int32),
+            '\x00'.join(mim[3] for mim in measurements)))
+    return packed
+
+
+
+# The worker process function used to evaluate packed patients.  The PatientSeries of 
+# each patient is returned along with its invalid value counts.
+# packed:       The packed patients, from packPatients
+def evaluatePacked(packed):
+    results = []
+    for statics, seconds, itemids, minutes, values in packed:
+        values = values.split('\x00') if len(itemids) > 0 else []
+        measurements = [[statics[0],
+            EPOCH + datetime.timedelta(seconds=int(seconds[i])) if itemids[i] in MECHVENT_IDS else None,
+            int(itemids[i]), values[i], int(minutes[i])] for i in range(len(itemids))]
+
+        invalid = {}
+        minutes, itemids, values = process_info['evaluate'](measurements, 
+            process_info['hours'], process_info['registry'], invalid)
+        results.append((patient_series.makeSeries(statics, minutes, itemids, values, 
+            process_info['registry']), invalid))
+    return results
+
+
+
+# This function converts the results of evaluatePacked into the PatientSeries returned by
+# evaluatePatients, adding up the invalid value counts.
+# results:      The evaluated patients, from evaluatePacked
+def unpackPatients(results):
+    patient_info = []
+    for series, invalid in results:
+        addInvalid(invalid)
+        patient_info.append(series)
+    return patient_info
+
+
+
+# This function reads the value of measurements that aren't examined in a special way.
+# mim:        the measurement
+# state:      the interpretation state of the patient (unused)
+def handleValue(mim, state):
+    return float(mim[3])
+
+
+
 # This function interprets mechanical ventilation measurements  
 # mim:        the measurement value for mechanical ventilation.
-# lastvent: the time of the last mechanical ventilation
-def handleMechVent(mim, lastvent):
+# state:      the interpretation state of the patient, holding the time of the last 
+#             mechanical ventilation as 'lastvent'
+def handleMechVent(mim, state):
+    lastvent = state['lastvent']
+
     # Assign the appropriate mech vent value:
     # 0.0 - Mechanical ventilation not in use
     # 1.0 - Mechanical ventilation in use
@@ -136,88 +335,91 @@ def handleMechVent(mim, lastvent):
             val = 2.0
     elif(mim[3] == "2.0"):
         val = 0.0
-    return val, lastvent
+    state['lastvent'] = lastvent
+    return val
 
 
 
-# This function interprets Troponin measurements that are not direclty associated
-# with a numerical value. If they are represented by an inequality, the value will
-# be denoted as one one-thousandth above or below the threshold.
-#   
+# This function interprets measurements whose values may be censored, that is reported 
+# as below or above a threshold ('<0.01', 'GREATER THAN 50') rather than as a number.  
+# Plain numbers are converted directly; censored values are given the value of the
+# measurement ID's censoring rule, one one-thousandth below or above the threshold.  The
+# rules come from the '#Censoring' section of the specifications (see spec_parser).
+#
 # Troponin T can be represented as <0.01 or a distinct value greater than or 
 # equal to 0.01.
 #
 # Troponin I can be represented as <0.03, >50.0 or a distinct value greater than or
 # equal to 0.04 and less than or equal to 50.0.  
 #
-# mim:    the troponin measurement value
-def handleTroponin(mim):
-
-    # Handle Troponin T
-    if(mim[2] in (51003, 227429)):
-        if('<' in mim[3] or "LESS" in mim[3]):          # <0.01
-            val = 0.009
-        elif('>' in mim[3] or "GREATER" in mim[3]):
-            val = 25.001
-        else:
-            val = float(mim[3])
-
-    # Handle Troponin I
-    elif(mim[2] in (51002,)):
-        if('<' in mim[3] or "LESS" in mim[3]):          # <0.04
-            val = 0.029
-        elif('>' in mim[3] or "GREATER" in mim[3]):     # >50.0
-            val = 50.001
-        else:
-            val = float(mim[3])
-
-    # Default option.
-    else:
-        val = float(mim[3])
-    return val
-
+# Other censored values seen in Mimic III, which have no rule by default:
+#   K 50971: '>' or GREATER than 10          Lactate 50813: '>' or GREATER than 30
+#   Glucose 50809: '>' or GREATER than 500/999
+#   WBC 1542, 51301: '<' 0.1                 Na 50983: '>' or GREATER than 180
+#   HCO3 50882: '>' or GREATER than 50       HCO3 50862: '<' or LESS than 5
+#   Platelets 828, 51265: '<' or LESS than 5 ALT: '<' or LESS than 4
+#   Albumin: '<' or LESS than 1              Bilirubin 50885: '<' or LESS than 2
+#   Creatinine: '<' or LESS than 0.7
+#
+# rules:  the values of censored measurements, by '<' and '>'
+# mim:    the measurement
+# state:  the interpretation state of the patient (unused)
+def handleCensored(rules, mim, state):
+    try:
+        return float(mim[3])
+    except (TypeError, ValueError):
+        pass
+    if(CENSORED_BELOW.search(mim[3])):
+        return rules['<']
+    elif(CENSORED_ABOVE.search(mim[3])):
+        return rules['>']
+    raise ValueError("Invalid measurement value '{}'".format(mim[3]))
 
-# K 50971: '>' or GREATER than 10
-def handlePotassium():
-    return
 
-#Lactate 50813: '>' or GREATER than 30
-def handleLactate():
-    return
 
-#Glucose 50809: '>' or GREATER than 500/999
-def handleGlucose():
+# This function adds the invalid value counts of some patients to the counts of the run.
+# invalid:      The number of invalid values of each measurement ID
+def addInvalid(invalid):
+    invalid_lock.acquire()
+    try:
+        for m, count in invalid.items():
+            invalid_counts[m] = invalid_counts.get(m, 0) + count
+    finally:
+        invalid_lock.release()
     return
 
-#WBC 1542, 51301: '<' 0.1
-def handleWBC():
-    return
 
-#HCO3 50882: '>' or GREATER than 50
-#HCO3 50862: '<' or LESS than 5
-def handleHCO3():
-    return
 
-#Na 50983: '>' or GREATER than 180
-def handleSodium():
+# This function prints the number of invalid values of each measurement ID found since the
+# last report, and resets the counts.
+# registry:     The parameter registry from spec_parser.getSpecifications
+def reportInvalid(registry):
+    invalid_lock.acquire()
+    try:
+        if(len(invalid_counts) > 0):
+            print("Invalid measurement values: {}".format(sum(invalid_counts.values())))
+            for m in sorted(invalid_counts.keys()):
+                print("    {:8} {:8} {:10}".format(registry[m][0], m, invalid_counts[m]))
+        invalid_counts.clear()
+    finally:
+        invalid_lock.release()
     return
 
-#Platelets 828, 51265: '<' or LESS than 5
-def handlePlatelets():
-    return
 
-#ALT: '<' or LESS than 4
-def handleALT():
-    return
 
-#Albumin: '<' or LESS than 1
-def handleAlbumin():
-    return
+# The functions that interpret the measurement IDs which need special handling, used by
+# spec_parser to build the parameter registry.  Measurements with a censoring rule are
+# read with handleCensored and every other measurement with handleValue.  A handler is
+# called with the measurement and the patient's state, and raises an exception for values
+# that cannot be interpreted.
+HANDLERS = {}
+HANDLERS.update((m, handleMechVent) for m in MECHVENT_IDS)
 
-#Bilirubin 50885: '<' or LESS than 2
-def handleBilirubin():
-    return
+# The handlers that depend on the earlier measurements of the patient.
+STATEFUL_HANDLERS = (handleMechVent,)
 
-#Creatinine: '<' or LESS than 0.7
-def handleCreateine():
-    return
\ No newline at end of file
+# The functions that evaluate a patient's measurements, by the 'Evaluation' setting.
+EVALUATORS = {
+    'loop':     evaluateLoop,
+    'numpy':    evaluateArrays,
+}
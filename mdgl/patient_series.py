@@ -0,0 +1,101 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: Patient Series
+-- Description: This module contains the class that holds the processed data of one
+-- patient.  The static measurements are kept as attributes and the measurements over
+-- time as typed arrays, instead of a list of [time, label, id, value] lists per
+-- measurement:
+--
+--   minutes:  int32 minutes elapsed since the ICU intime
+--   codes:    uint16 parameter codes, the position of the label among the sorted
+--             parameter labels (see spec_parser.getLabels)
+--   itemids:  int32 measurement IDs
+--   values:   float32 measurement values
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+# ...
+
+# Related 3rd party imports
+import numpy as np
+
+# Local application imports
+# ...
+
+# The static measurements of a patient, in the order they are written out, and the
+# attribute each is kept in.
+STATIC_PARAMS = ['RecordID', 'Age', 'Gender', 'Height', 'ICUType', 'Weight']
+STATIC_FIELDS = ('recordid', 'age', 'gender', 'height', 'icutype', 'weight')
+
+# The header line of a patient CSV file (see data_gen.writePatient).
+FILE_HEADER = "Time,Parameter,Id,Value"
+
+class PatientSeries(object):
+
+    __slots__ = STATIC_FIELDS + ('minutes', 'codes', 'itemids', 'values')
+
+    # Initialize the patient's data
+    # statics:      The static measurement values, in the order of STATIC_PARAMS
+    # minutes:      The minutes elapsed since the ICU intime of each measurement
+    # codes:        The parameter code of each measurement
+    # itemids:      The measurement ID of each measurement
+    # values:       The value of each measurement
+    def __init__ (self, statics, minutes, codes, itemids, values):
+        for name, val in zip(STATIC_FIELDS, statics):
+            setattr(self, name, val)
+        self.minutes = np.asarray(minutes, dtype=np.int32)
+        self.codes = np.asarray(codes, dtype=np.uint16)
+        self.itemids = np.asarray(itemids, dtype=np.int32)
+        self.values = np.asarray(values, dtype=np.float32)
+        return
+
+
+    # The number of measurements over time.
+    def __len__ (self):
+        return len(self.minutes)
+
+
+    # Classes with __slots__ have no __dict__ to be pickled, so the attributes are pickled
+    # as a tuple.
+    def __getstate__ (self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+    def __setstate__ (self, state):
+        for name, val in zip(self.__slots__, state):
+            setattr(self, name, val)
+        return
+
+
+    # This function returns the static measurement values, in the order of STATIC_PARAMS.
+    def getStatics(self):
+        return [getattr(self, name) for name in STATIC_FIELDS]
+
+
+    # This function returns the patient's measurements as [time, label, id, value] rows,
+    # starting with the static measurements at '00:00' with the id '-1'.  The time is
+    # formatted as hours and minutes since the ICU intime.
+    # labels:       The parameter labels, by parameter code
+    def getRows(self, labels):
+        rows = [['00:00', name, '-1', val] for name, val in zip(STATIC_PARAMS, self.getStatics())]
+        for minutes, code, itemid, val in zip(self.minutes.tolist(), self.codes.tolist(),
+                self.itemids.tolist(), self.values.tolist()):
+            rows.append(['{:02}:{:02}'.format(minutes // 60, minutes % 60), labels[code], itemid, val])
+        return rows
+
+
+
+# This function creates the series of a patient from the arrays of its evaluated
+# measurements, looking up the parameter code of each measurement ID in the registry.
+# statics:      The static measurement values, in the order of STATIC_PARAMS
+# minutes:      The minutes elapsed since the ICU intime of each measurement
+# itemids:      The measurement ID of each measurement
+# values:       The value of each measurement
+# registry:     The parameter registry from spec_parser.getSpecifications
+def makeSeries(statics, minutes, itemids, values, registry):
+    ids, inverse = np.unique(np.asarray(itemids, dtype=np.int32), return_inverse=True)
+    codes = np.array([registry[m][1] for m in ids.tolist()], dtype=np.uint16)[inverse]
+    return PatientSeries(statics, minutes, codes, itemids, values)
@@ -0,0 +1,240 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: Patient Pipeline
+-- Description: This module generates the patient dataset with the fetch, process and
+-- write stages running at the same time instead of one after another.  The cohort is
+-- split into batches of 'BatchSize' patients which flow through the stages:
+--
+--   fetch:    one thread per pooled connection obtains the weight, height and
+--             measurements of a batch
+--   process:  one thread per virtual core evaluates the measurements of a batch, in
+--             worker processes if 'Executor' is 'process'
+--   write:    one thread writes the patient files of a batch
+--
+-- The stages are connected by queues holding at most 'QueueSize' batches.  A stage that
+-- runs ahead of the next one waits for room in its queue, so only a few batches are held
+-- in memory at a time.  If any stage fails, the remaining batches are passed through
+-- without work and the error is raised once every stage has stopped.
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import sys
+import time
+import threading
+import multiprocessing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Related 3rd party imports
+# ...
+
+# Local application imports
+import data_access
+import patient_processing
+
+# Marks the end of the batches in a queue.
+DONE = None
+
+
+# This class stands in for the thread pool when a worker function is called on a single
+# batch, collecting the results of the batch.
+class BatchResults:
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.results = []
+        return
+
+
+# This class keeps the state shared by the threads of the pipeline.
+class Pipeline:
+
+    # Initialize the pipeline
+    # ptp:          an instance of PatientThreadPool, whose connection pool is used
+    # queuesize:    the number of batches each queue between stages can hold
+    def __init__ (self, ptp, queuesize):
+        self.ptp = ptp
+        self.fetched = queue.Queue(queuesize)
+        self.processed = queue.Queue(queuesize)
+        self.lock = threading.Lock()
+        self.remaining = {}
+        self.error = None
+        return
+
+
+    # This function records the first error raised by a stage.
+    def fail(self):
+        self.lock.acquire()
+        try:
+            if(self.error is None):
+                self.error = sys.exc_info()
+        finally:
+            self.lock.release()
+        return
+
+
+    # This function is called when a thread of a stage has no batches left.  The last
+    # thread of the stage tells each thread of the next stage that no more batches follow.
+    # stage:        the name of the stage
+    # out:          the queue the stage puts its batches in
+    # consumers:    the number of threads taking batches from the queue
+    def finish(self, stage, out, consumers):
+        self.lock.acquire()
+        try:
+            self.remaining[stage] -= 1
+            last = self.remaining[stage] == 0
+        finally:
+            self.lock.release()
+        if(last):
+            for i in range(consumers):
+                out.put(DONE)
+        return
+
+
+    # This function runs the fetch stage on one thread, obtaining the batches in turn.
+    # i:            the thread number, used for the thread timings
+    # batches:      the queue of patient batches to fetch
+    # fetchfuncs:   the worker functions and their arguments, applied one after another
+    # consumers:    the number of process stage threads
+    def fetch(self, i, batches, fetchfuncs, consumers):
+        while(True):
+            try:
+                batch = batches.get_nowait()
+            except queue.Empty:
+                break
+            if(self.error is not None):
+                continue
+            try:
+                for func, args in fetchfuncs:
+                    results = BatchResults()
+                    self.ptp.runTimed(i, func, args + [batch, results], len(batch), True)
+                    batch = results.results
+                self.fetched.put(batch)
+            except:
+                self.fail()
+        self.finish('fetch', self.fetched, consumers)
+        return
+
+
+    # This function runs the process stage on one thread.
+    # i:            the thread number, used for the thread timings
+    # hours:        the total number of hours from an ICU stay that are desired.
+    # registry:     the parameter registry from spec_parser.getSpecifications
+    # evaluation:   the way measurements are evaluated, 'loop' or 'numpy'
+    # processes:    a pool of worker processes to evaluate the batches in, or None to
+    #               evaluate them on this thread
+    def process(self, i, hours, registry, evaluation, processes):
+        while(True):
+            batch = self.fetched.get()
+            if(batch is DONE):
+                break
+            if(self.error is not None):
+                continue
+            try:
+                atime = time.time()
+                if(processes is None):
+                    results = BatchResults()
+                    patient_processing.evaluatePatients([hours, registry, evaluation, batch, results])
+                    batch = results.results
+                else:
+                    batch = patient_processing.unpackPatients(
+                        processes.apply(patient_processing.evaluatePacked, (patient_processing.packPatients(batch),)))
+                self.ptp.timings[i][0] += time.time() - atime
+                self.ptp.timings[i][1] += 1
+                self.ptp.timings[i][2] += len(batch)
+                self.processed.put(batch)
+            except:
+                self.fail()
+        self.finish('process', self.processed, 1)
+        return
+
+
+    # This function runs the write stage, which is a single thread.
+    # writer:       the function that writes out one patient's measurements
+    # patientdata:  the list the written patients are added to
+    def write(self, writer, patientdata):
+        while(True):
+            batch = self.processed.get()
+            if(batch is DONE):
+                break
+            if(self.error is not None):
+                continue
+            try:
+                for patient in batch:
+                    writer(patient)
+                patientdata += batch
+            except:
+                self.fail()
+        return
+
+
+
+# The function below obtains the patients from the database and runs them through the
+# pipeline, returning the processed patients in the order they were written.
+# ICUInfo:     a list of True/False values that determine which ICUs to use.
+# ParamInfo:   a dictionary of measurement parameters to obtain from the database
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+# registry:    the parameter registry from spec_parser.getSpecifications
+# writer:      the function that writes out one patient's measurements
+def runPipeline(icu_info, param_info, patient_info, setting_info, registry, cur, ptp, writer):
+    atime = time.time()
+
+    # Obtain the patients and split them into batches.
+    routes = data_access.obtainRoutes(param_info, setting_info, cur)
+    patientquery, measurementquery = data_access.makeQueries(icu_info, patient_info, routes)
+    cur.execute(patientquery)
+    patients = cur.fetchall()
+    batchsize = setting_info['BatchSize']
+    batches = queue.Queue()
+    for start in range(0, len(patients), batchsize):
+        batches.put(patients[start:start+batchsize])
+    print("Pipelining {} patients in {} batches...".format(len(patients), batches.qsize()))
+
+    # The worker functions that fetch a batch.
+    if(setting_info['Extraction'] == 'patient'):
+        fetchfuncs = [(data_access.obtainWeightandHeight, []),
+            (data_access.obtainMeasurements, [data_access.makeRouteStrings(routes), measurementquery])]
+    else:
+        fetchfuncs = [(data_access.obtainWeightandHeightBulk, [batchsize]),
+            (data_access.obtainMeasurementsBatched, [data_access.makeRouteParams(routes),
+                data_access.makeBatchQuery(patient_info, routes), batchsize])]
+
+    hours = patient_info['Hours']['limit']
+    processes = None
+    if(setting_info['Executor'] == 'process'):
+        processes = multiprocessing.Pool(ptp.cpus, patient_processing.initProcess, 
+            (hours, registry, setting_info['Evaluation']))
+
+    # Start every stage.
+    fetchers = ptp.connpool.workers()
+    processors = ptp.cpus
+    pipe = Pipeline(ptp, setting_info['QueueSize'])
+    pipe.remaining = {'fetch': fetchers, 'process': processors}
+    ptp.timings = [[0.0, 0, 0] for i in range(fetchers + processors)]
+    patientdata = []
+    threads = []
+    for i in range(fetchers):
+        threads.append(threading.Thread(target=pipe.fetch, args=(i, batches, fetchfuncs, processors)))
+    for i in range(processors):
+        threads.append(threading.Thread(target=pipe.process, args=(fetchers + i, hours, registry, setting_info['Evaluation'], processes)))
+    threads.append(threading.Thread(target=pipe.write, args=(writer, patientdata)))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if(processes is not None):
+        processes.close()
+        processes.join()
+
+    print("Fetch threads 0-{}, process threads {}-{}:".format(fetchers - 1, fetchers, fetchers + processors - 1))
+    ptp.reportTimings()
+    if(pipe.error is not None):
+        raise pipe.error[1]
+    print('Fetched, processed and wrote patients: {:10.2f} seconds.\n'.format(time.time() - atime))
+    return patientdata
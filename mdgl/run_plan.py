@@ -0,0 +1,133 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: Run Planner
+-- Description: This module estimates the size and duration of a run before it is made,
+-- for the '--plan' flag of data_gen.py.  The patient query is run to find the cohort, and
+-- two cheap estimates are made of the measurements of the cohort:
+--
+--   per table:      the planner's estimate of the rows of each measurement table, from
+--                   EXPLAIN of the measurement query of the whole cohort; nothing is read
+--   per parameter:  the rows, patients and value lengths of each measurement ID, counted
+--                   on the server for a sample of 'PlanSample' patients and scaled up to
+--                   the cohort
+--
+-- The timed sample query also gives the wall time of the extraction, assuming the
+-- measurement queries of the run are spread over as many connections as the run would
+-- use at once.  Item IDs that return nothing for the sample, or that make up much of the
+-- rows, are flagged.
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import json
+import time
+import random
+
+# Related 3rd party imports
+# ...
+
+# Local application imports
+import data_access
+
+# Bytes held for a measurement row besides its value: the subject_id, charttime, itemid,
+# minutes and patient index.
+ROW_BYTES = 32
+# Bytes of a row of a patient file besides the label and value: the time, commas and newline.
+LINE_BYTES = 8
+# Share of the estimated rows above which a measurement ID is flagged as expensive.
+EXPENSIVE_SHARE = 0.25
+
+
+# This function prints the estimates of the run.
+# ICUInfo:     a list of ICUs to select patients from
+# ParamInfo:   a dictionary of parameter information containing all Mimic III ids
+# PatientInfo: a dictionary of patient information specifying the types of patients to analyze
+# SettingInfo: a dictionary of run settings from the '#Settings' section
+# registry:    the parameter registry from spec_parser.getSpecifications
+# cur:         a connection to the MimicIII database
+# connpool:    the ConnectionPool the run would take its connections from
+def planRun(icu_info, param_info, patient_info, setting_info, registry, cur, connpool):
+    routes = data_access.obtainRoutes(param_info, setting_info, cur)
+    patientquery, measurementquery = data_access.makeQueries(icu_info, patient_info, routes)
+
+    print("Running the patient query...")
+    cur.execute(patientquery)
+    patients = cur.fetchall()
+    print("Number of patients in the cohort: {}".format(len(patients)))
+    if(len(patients) == 0):
+        return
+
+    # The planner's estimate of the rows of each table, without reading them.
+    print("\nEstimated measurement rows per table (query planner)")
+    cohort = data_access.makeQueryCohort(patientquery)
+    for table, alias in data_access.MEASUREMENT_TABLES:
+        if(len(routes[table]) == 0):
+            continue
+        tableroutes = dict((t, routes[t] if t == table else []) for t, a in data_access.MEASUREMENT_TABLES)
+        cur.execute("EXPLAIN (FORMAT JSON) " + cohort + data_access.makeCohortBranches(patient_info, tableroutes),
+            data_access.makeRouteParams(tableroutes))
+        plan = cur.fetchone()[0]
+        if(not isinstance(plan, list)):
+            plan = json.loads(plan)
+        print("{:>20}: {:14,}".format(table, int(plan[0]['Plan']['Plan Rows'])))
+
+    # Count the measurements of a sample of the cohort, and time it.
+    sample = random.Random(0).sample(patients, min(setting_info['PlanSample'], len(patients)))
+    params = data_access.makeCohortParams(sample)
+    params.update(data_access.makeRouteParams(routes))
+    starttime = time.time()
+    cur.execute(data_access.BATCH_COHORT + ", measured(subject_id, charttime, itemid, value, minutes, pidx) AS( "
+        + data_access.makeCohortBranches(patient_info, routes) + ") "
+        "SELECT itemid, count(*), count(DISTINCT pidx), sum(length(value)) FROM measured GROUP BY itemid;", params)
+    counted = dict((row[0], row[1:]) for row in cur.fetchall())
+    seconds = time.time() - starttime
+    scale = len(patients) / len(sample)
+
+    # Scale the counts of each measurement ID up to the cohort.
+    estimates = {}
+    for m in sorted(registry.keys()):
+        rows, numpatients, length = counted.get(m, (0, 0, 0))
+        estimates[m] = (rows * scale, numpatients / len(sample), (length or 0) * scale)
+    totalrows = sum(e[0] for e in estimates.values())
+
+    print("\nEstimated measurements per parameter ({} of {} patients sampled)".format(len(sample), len(patients)))
+    print("{:>12} {:>8} {:>14} {:>10} {:>12}  {}".format('Parameter', 'ItemID', 'Rows', 'Patients', 'Bytes', 'Note'))
+    totalbytes = 0
+    outputbytes = 0
+    for m in sorted(registry.keys(), key=lambda m: (registry[m][1], m)):
+        rows, coverage, length = estimates[m]
+        label = registry[m][0]
+        totalbytes += length + rows * ROW_BYTES
+        outputbytes += length + rows * (len(label) + LINE_BYTES)
+        note = ''
+        if(rows == 0):
+            note = 'returns nothing for the sample'
+        elif(rows > EXPENSIVE_SHARE * totalrows):
+            note = 'expensive: {:.0%} of the rows'.format(rows / totalrows)
+        print("{:>12} {:>8} {:>14,} {:>10.1%} {:>12}  {}".format(label, m, int(rows), coverage,
+            formatBytes(length + rows * ROW_BYTES), note))
+
+    # The thread engine runs a query per database worker of executeFunc, and the async
+    # engine up to 'InFlight' queries on the free connections of the pool.
+    workers = connpool.workers()
+    if(setting_info['Engine'] == 'async' and setting_info['Pipeline'] == 0):
+        workers = max(1, min(setting_info['InFlight'], connpool.available()))
+    print("\nEstimated totals")
+    print("{:>20}: {:,}".format('Measurement rows', int(totalrows)))
+    print("{:>20}: {}".format('Bytes fetched', formatBytes(totalbytes)))
+    print("{:>20}: {}".format('Patient files', formatBytes(outputbytes)))
+    print("{:>20}: {:.0f} sec ({:.2f} sec for the sample, {} connections)".format('Extraction time',
+        seconds * scale / workers, seconds, workers))
+    return
+
+
+# This function returns a number of bytes in readable units.
+# size:        the number of bytes
+def formatBytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if(size < 1024):
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} TB".format(size)
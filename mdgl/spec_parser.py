@@ -9,22 +9,103 @@
 # Standard library imports
 import re
 import sys
+import functools
 
 # Related 3rd party imports
 # ...
 
 # Local application imports
-# ...
+import patient_processing
+
+# Default values for the run settings that may be given in the optional '#Settings'
+# section of the specifications file.
+SETTING_DEFAULTS = {
+    'Extraction':   'patient',      # patient: one query per patient, batch: bulk queries,
+                                    # stream: bulk queries read through server-side cursors
+    'BatchSize':    500,            # Number of patients per weight/height and measurement query
+    'IterSize':     2000,           # Number of rows fetched at a time when streaming
+    'Routing':      0,              # 1: only search each table for the item ids it can contain
+    'RouteCache':   'itemroutes.pickle',    # File caching the table of each item id
+    'Source':       'database',     # database: query Mimic III, files: read the CSV files
+    'SourceDir':    'mimic-iii',    # Directory containing the Mimic III CSV files
+    'StoreDir':     'mimic-store',  # Directory of the columnar store made from the CSV files
+    'CacheDir':     '',             # Directory of the extraction cache; empty to disable it
+    'CacheSize':    4096,           # Size limit of the extraction cache in megabytes
+    'Scheduler':    'static',       # static: equal slices per thread, dynamic: shared work queue
+    'MinChunk':     16,             # Smallest number of patients a thread takes from the queue
+    'Executor':     'thread',       # thread or process: how patient processing is run in parallel
+    'PoolMin':      1,              # Number of database connections opened up front
+    'PoolMax':      0,              # Most database connections open at once, at least 2 as the run
+                                    # holds one throughout; 0 for one per core
+    'PoolRetries':  3,              # Times a failed connection or query is retried
+    'Engine':       'thread',       # thread: a blocking query per thread, async: measurement
+                                    # queries run from one thread on asynchronous connections
+    'InFlight':     8,              # Number of measurement queries running at once when async,
+                                    # on connections of the pool (at most PoolMax - 1)
+    'Pipeline':     0,              # 1: fetch, process and write batches of patients at the same
+                                    # time (database only; the extraction cache and Engine are not used)
+    'QueueSize':    4,              # Number of batches held between pipeline stages
+    'Evaluation':   'loop',         # loop: one measurement at a time, numpy: whole patients as arrays
+    'Tensor':       0,              # 1: also write the patients binned into arrays (see tensor_export)
+    'BinWidth':     60,             # Width of a tensor time bin in minutes
+    'BinAgg':       'last',         # last, mean, min or max: how values in a tensor bin are combined
+    'Output':       'csv',          # csv: one file per patient, columnar: partitioned column files
+                                    # with a patient index (see columnar_output), both: write both
+    'PartitionSize': 4096,          # Number of patients per columnar partition file
+    'Resume':       0,              # 1: write to a directory named after the specifications and
+                                    # checkpoint patients as they are done, so a run that is
+                                    # stopped carries on where it left off (database only)
+    'CheckpointSize': 1000,         # Number of patients obtained and processed per checkpoint
+    'Stats':        'exact',        # exact: keep every value for the report, sketch: keep running
+                                    # statistics and quantile sketches (see stat_sketch)
+    'StatsError':   0.01,           # Rank error allowed in the report quartiles when sketched
+    'Groups':       '',             # Groupings of the grouped report, e.g. 'ICUType, Gender*Age,
+                                    # ICUType*Hours' (see stat_report); empty to skip the report
+    'AgeBand':      10,             # Width of the Age groups in years
+    'HourBand':     24,             # Width of the Hours groups in hours
+    'Coverage':     0,              # 1: save which patients have which parameters (see coverage)
+    'CoverageHours': 0,             # Width in hours of the bands of the binned coverage; 0 for none
+    'PlanSample':   200,            # Number of patients whose measurements are counted by '--plan'
+}
+
+# The accepted values for settings that choose between modes.
+SETTING_CHOICES = {
+    'Extraction':   ('patient', 'batch', 'stream'),
+    'Routing':      (0, 1),
+    'Source':       ('database', 'files'),
+    'Scheduler':    ('static', 'dynamic'),
+    'Executor':     ('thread', 'process'),
+    'Engine':       ('thread', 'async'),
+    'Pipeline':     (0, 1),
+    'Evaluation':   ('loop', 'numpy'),
+    'Tensor':       (0, 1),
+    'BinAgg':       ('last', 'mean', 'min', 'max'),
+    'Output':       ('csv', 'columnar', 'both'),
+    'Resume':       (0, 1),
+    'Stats':        ('exact', 'sketch'),
+    'Coverage':     (0, 1),
+}
+
+# The censoring rules used when the specifications file has no '#Censoring' section: the
+# values given to troponin measurements reported below ('<') or above ('>') a threshold.
+DEFAULT_CENSORING = {
+    51002:  {'<': 0.029, '>': 50.001},      # Troponin I: <0.03, >50.0
+    51003:  {'<': 0.009, '>': 25.001},      # Troponin T: <0.01
+    227429: {'<': 0.009, '>': 25.001},      # Troponin T
+}
 
 def getSpecifications(spec_file):
     ParamInfo = {}
     PatientInfo = {}
+    CensorInfo = {}
     ICUs = []
 
     # Use a boolean value to keep track of which section the parser is in.
     check_icu = False
     check_pat = False
     check_mea = False
+    check_cen = False
+    found_cen = False
 
     f = open(spec_file)
     
@@ -41,16 +122,32 @@ def getSpecifications(spec_file):
                 check_icu = True
                 check_pat = False
                 check_mea = False
+                check_cen = False
 
             elif(line == '#Patients'):
                 check_icu = False
                 check_pat = True
                 check_mea = False
+                check_cen = False
             
             elif(line == '#Parameters'):
                 check_icu = False
                 check_pat = False
                 check_mea = True
+                check_cen = False
+
+            elif(line == '#Censoring'):
+                check_icu = False
+                check_pat = False
+                check_mea = False
+                check_cen = True
+                found_cen = True
+
+            elif(line == '#Settings'):
+                check_icu = False
+                check_pat = False
+                check_mea = False
+                check_cen = False
 
             elif(line == '#End'):
                 break
@@ -109,4 +206,96 @@ def getSpecifications(spec_file):
                     'ids': ids
                 }
 
-    return ICUs, ParamInfo, PatientInfo
+            # Obtain censoring rules: 'itemid; < or >; value'
+            elif(check_cen == True):
+                elements = [e.strip() for e in line.split(';')]
+                try:
+                    if(len(elements) != 3 or elements[1] not in ('<', '>')):
+                        raise ValueError(line)
+                    CensorInfo.setdefault(int(elements[0]), {})[elements[1]] = float(elements[2])
+                except ValueError:
+                    sys.stderr.write("Error: Specifications.txt - 'Censoring' line '{}' is invalid.\n".format(line))
+                    exit(0)
+
+    if(not found_cen):
+        CensorInfo = DEFAULT_CENSORING
+    return ICUs, ParamInfo, PatientInfo, compileRegistry(ParamInfo, CensorInfo)
+
+
+# This function returns the parameter labels in the order of their codes.
+# ParamInfo:    The parameter information from getSpecifications.
+def getLabels(param_info):
+    return sorted(param_info.keys())
+
+
+# This function compiles the parameter registry used to interpret measurements.  The
+# registry maps each measurement ID to the (label, code, handler) of the first parameter
+# that includes it, where the code is the position of the label among the sorted
+# parameter labels and the handler is the function that interprets its values.
+# ParamInfo:    The parameter information from getSpecifications.
+# CensorInfo:   The censoring rules of measurement IDs, from getSpecifications.
+def compileRegistry(param_info, censor_info):
+    codes = dict((abbr, code) for code, abbr in enumerate(getLabels(param_info)))
+    registry = {}
+    for param in param_info.values():
+        for m in param['ids']:
+            if(m not in registry):
+                if(m in patient_processing.HANDLERS):
+                    handler = patient_processing.HANDLERS[m]
+                elif(m in censor_info):
+                    handler = functools.partial(patient_processing.handleCensored, censor_info[m])
+                else:
+                    handler = patient_processing.handleValue
+                registry[m] = (param['abbr'], codes[param['abbr']], handler)
+    return registry
+
+
+# This function obtains the run settings from the '#Settings' section of the 
+# specifications file.  Each line has the form 'Name; value'.  Settings that are
+# not given keep the values in SETTING_DEFAULTS.
+# spec_file:    The specifications file to read the settings from.
+def getSettings(spec_file):
+    SettingInfo = dict(SETTING_DEFAULTS)
+
+    # Use a boolean value to keep track of whether the parser is in the section.
+    check_set = False
+
+    f = open(spec_file)
+
+    for line in f.readlines():
+        line = line.strip()
+        if(line == ''):
+            continue
+
+        # Enter or leave the settings section.
+        if(line == '#End'):
+            break
+        elif(line.startswith('#')):
+            check_set = (line == '#Settings')
+
+        # Obtain setting information
+        elif(check_set == True):
+            elements = [e.strip() for e in line.split(';')]
+            name = elements[0]
+            if(name not in SETTING_DEFAULTS or len(elements) != 2):
+                sys.stderr.write("Error: Specifications.txt - '{}' setting is invalid.\n".format(name))
+                exit(0)
+
+            # Convert the value to the type of the default value.
+            try:
+                value = type(SETTING_DEFAULTS[name])(elements[1])
+            except ValueError:
+                sys.stderr.write("Error: Specifications.txt - '{}' setting value is invalid.\n".format(name))
+                exit(0)
+            if(name in SETTING_CHOICES and value not in SETTING_CHOICES[name]):
+                sys.stderr.write("Error: Specifications.txt - '{}' setting must be one of: {}.\n".format(
+                    name, ', '.join(str(c) for c in SETTING_CHOICES[name])))
+                exit(0)
+            SettingInfo[name] = value
+
+    # The run holds one connection throughout, so the threads need at least one more.
+    if(SettingInfo['PoolMax'] != 0 and SettingInfo['PoolMax'] < 2):
+        sys.stderr.write("Error: Specifications.txt - 'PoolMax' setting must be 0 or at least 2.\n")
+        exit(0)
+
+    return SettingInfo
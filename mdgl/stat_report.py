@@ -19,79 +19,390 @@ Things to implement:
 # Standard library imports
 import os
 import sys
+import time
 import datetime
+import functools
+import multiprocessing
 
 # Related 3rd party imports
 import numpy as np
 
 # Local application imports
 import spec_parser 
+import patient_series
+import columnar_output
+import stat_sketch
 
 class StatReportGenerator:
 
     # This function initializes the statistics report generator.  
     # ParamInfo:    Obtained from spec_parser.getSpecifications()
-    def __init__ (self, param_info):
+    # mode:         'exact' to keep every value, or 'sketch' to keep running statistics
+    #               and quantile sketches (see stat_sketch)
+    # error:        The rank error allowed in the quartiles in 'sketch' mode
+    def __init__ (self, param_info, mode='exact', error=0.01):
         self.numpatients = 0        # Total number of patients
         self.measurements = {}      # To keep track of measurement stats
+        self.leftout = []           # Measurements that could not be summarized
+        self.labels = spec_parser.getLabels(param_info)
+        self.param_info = param_info
+        self.mode = mode
+        self.error = error
 
         # Initialize the measurement dictionary
         for param in param_info.keys():
-            self.measurements[param] = { 'vals': [], 'numpatients': 0 }
+            if(mode == 'sketch'):
+                vals = stat_sketch.ValueSketch(error)
+            else:
+                vals = stat_sketch.ValueList()
+            self.measurements[param] = { 'vals': vals, 'numpatients': 0 }
 
         return
 
 
+    # This function adds the values of each measurement of the patients to the summaries.
+    # patientdata:  The PatientSeries of the patients
+    def addPatients(self, patientdata):
+        for patient in patientdata:
+
+            # Update data on each measurement the patient has, along with the number of
+            # patients that a measurement applies to.  The values are grouped by code with
+            # one stable sort instead of a comparison per code.
+            order = np.argsort(patient.codes, kind='mergesort')
+            codes, starts = np.unique(patient.codes[order], return_index=True)
+            for code, vals in zip(codes.tolist(), np.split(patient.values[order], starts[1:])):
+                m = self.labels[code]
+                self.measurements[m]['vals'].update(vals)
+                self.measurements[m]['numpatients'] += 1
+        self.numpatients += len(patientdata)
+        return
+
+
+    # This function adds the summaries of another generator made with the same mode.
+    # other:        The StatReportGenerator to merge
+    def merge(self, other):
+        for m in self.measurements.keys():
+            self.measurements[m]['vals'].merge(other.measurements[m]['vals'])
+            self.measurements[m]['numpatients'] += other.measurements[m]['numpatients']
+        self.numpatients += other.numpatients
+        return
+
+
     # This function is used to generate a statistics report.
-    # patientdata:  The patient measurement data
+    # patientdata:  The PatientSeries of the patients
     # dirname:      The directory where the report should be created.
     #               This will be the same directory as where the patient
     #               data files are located.
-    def createReport(self, patientdata, directory):
+    # ptp:          An instance of PatientThreadPool.  In 'sketch' mode, each thread
+    #               summarizes a share of the patients and the summaries are merged.
+    def createReport(self, patientdata, directory, ptp=None):
         print('Generating a report...')
 
         # Update the measurement information for each patient
-        for patient in patientdata:
-            mrec = []       # to keep track of which measurements this patient has
+        if(ptp is None or self.mode != 'sketch'):
+            self.addPatients(patientdata)
+        else:
+            ptp.executeFunc(
+                func=summarizePatients,
+                args=[self.param_info, self.mode, self.error],
+                splitargs=[patientdata],
+                database=False)
+            for other in ptp.getResults():
+                self.merge(other)
+        self.writeReport(directory)
+        return
 
-            # Update data on each measurement
-            for m in patient[6:]:
-                if(m[1] not in mrec):
-                    mrec.append(m[1])
-                self.measurements[m[1]]['vals'].append(float(m[3]))
 
-            # Update the number of patients that a measurement applies to. 
-            for m in mrec:
-                self.measurements[m]['numpatients'] += 1
+    # This function sets the summaries from statistics computed elsewhere, such as those
+    # computed on the server by data_access.obtainStats.
+    # numpatients:  The total number of patients
+    # rows:         A row per measurement: its label, the number of patients with it, the
+    #               number of values, and their minimum, quartiles, mean and maximum in the
+    #               order of the report
+    # leftout:      The labels of the measurements that could not be summarized, which are
+    #               listed in the report instead
+    def addAggregates(self, numpatients, rows, leftout=()):
+        self.numpatients += numpatients
+        for label in leftout:
+            del self.measurements[label]
+            self.leftout.append(label)
+        for row in rows:
+            self.measurements[row[0]]['vals'] = stat_sketch.ValueAggregate(row[2], row[3:])
+            self.measurements[row[0]]['numpatients'] = row[1]
+        return
+
 
-        # Write the statistics report file.
+    # This function writes the statistics report file.
+    # directory:    The directory where the report should be created.
+    def writeReport(self, directory):
+        cwd = os.getcwd()
         os.chdir(directory)
         with open('StatisticsReport.txt', 'w') as f:
             f.write("Statistics Report\n")
             f.write("Generated on {} for the patient dataset located at: {}\n".format(
                 datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), directory))
-            f.write("Total number of patients: {}\n\n".format(len(patientdata)))
+            f.write("Total number of patients: {}\n\n".format(self.numpatients))
+            if(len(self.leftout) > 0):
+                f.write("Not summarized, as their values are interpreted in order for each patient: {}\n\n".format(
+                    ', '.join(self.leftout)))
             
             for m in sorted(self.measurements.keys()):
                 f.write("Measurement: {}\n".format(m))
                 f.write("Number of patients with {} recorded: {}\n".format(m, self.measurements[m]['numpatients']))
-                f.write("Number of values recorded: {}\n".format(len(self.measurements[m]['vals'])))
-
-                try:
-                    f.write("Minimum: {:13.3f}\n".format( np.min(self.measurements[m]['vals']) ))
-                    f.write("First Q: {:13.3f}\n".format( np.percentile(self.measurements[m]['vals'], 25) ))
-                    f.write("Median : {:13.3f}\n".format( np.median(self.measurements[m]['vals']) ))
-                    f.write("Mean   : {:13.3f}\n".format( np.mean(self.measurements[m]['vals']) ))
-                    f.write("Third Q: {:13.3f}\n".format( np.percentile(self.measurements[m]['vals'], 75) ))
-                    f.write("Maximum: {:13.3f}\n\n".format( np.max(self.measurements[m]['vals']) ))
-                except Exception as e:
+                f.write("Number of values recorded: {}\n".format(self.measurements[m]['vals'].count()))
+
+                if(self.measurements[m]['vals'].count() == 0):
                     f.write('\n\n')
-        os.chdir('..')
+                    continue
+                stats = self.measurements[m]['vals'].describe()
+                f.write("Minimum: {:13.3f}\n".format(stats[0]))
+                f.write("First Q: {:13.3f}\n".format(stats[1]))
+                f.write("Median : {:13.3f}\n".format(stats[2]))
+                f.write("Mean   : {:13.3f}\n".format(stats[3]))
+                f.write("Third Q: {:13.3f}\n".format(stats[4]))
+                f.write("Maximum: {:13.3f}\n\n".format(stats[5]))
+        os.chdir(cwd)
         print("Finished generating the report.")
+        return
+
+
+# The keys the grouped report can group measurements by: the static measurements
+# ICUType and Gender, the Age in bands of 'AgeBand' years, and the Hours since the ICU
+# intime in bands of 'HourBand' hours.
+GROUP_KEYS = ('ICUType', 'Gender', 'Age', 'Hours')
+
+# The quantiles of the grouped report.
+GROUP_QUANTILES = (0.25, 0.5, 0.75)
+
+class GroupedReportGenerator:
+
+    # This function initializes the grouped report generator.
+    # ParamInfo:    Obtained from spec_parser.getSpecifications()
+    # groupings:    The groupings to report, each a tuple of keys from GROUP_KEYS (see
+    #               parseGroupings)
+    # ageband:      The width of the age bands in years
+    # hourband:     The width of the time bands in hours
+    def __init__ (self, param_info, groupings, ageband, hourband):
+        self.labels = spec_parser.getLabels(param_info)
+        self.groupings = groupings
+        self.ageband = ageband
+        self.hourband = hourband
+        return
+
+
+    # This function writes the statistics of every measurement in every group of every
+    # grouping to one CSV file, reports/GroupedStatistics.csv, kept apart from the patient
+    # files of the dataset.  Each row gives the number of patients with the measurement in
+    # the group, the number of patients in the group and the fraction of those that had it
+    # (the coverage; the Hours key is left out when counting the patients of a group), the
+    # number of values and their minimum, quartiles, mean and maximum.
+    # patientdata:  The PatientSeries of the patients
+    # directory:    The directory of the dataset
+    def createReport(self, patientdata, directory):
+        print('Generating the grouped report...')
+
+        # Join the measurements of every patient once; every grouping works on the same
+        # arrays.
+        numpatients = len(patientdata)
+        patient = np.repeat(np.arange(numpatients), [len(p) for p in patientdata])
+        joined = columnar_output.packColumns(patientdata) if numpatients > 0 else \
+            dict((name, np.empty(0)) for name in columnar_output.COLUMNS)
+        codes = joined['codes'].astype(np.int64)
+        values = joined['values'].astype(np.float64)
+        statics = np.array([p.getStatics() for p in patientdata], dtype=np.float64).reshape(
+            numpatients, len(patient_series.STATIC_PARAMS))
+
+        # The key of each patient for the static keys, and of each measurement for all keys.
+        patientkeys = {
+            'ICUType':  statics[:, patient_series.STATIC_PARAMS.index('ICUType')],
+            'Gender':   statics[:, patient_series.STATIC_PARAMS.index('Gender')],
+            'Age':      statics[:, patient_series.STATIC_PARAMS.index('Age')] // self.ageband * self.ageband,
+        }
+        keys = dict((key, patientkeys[key][patient]) for key in patientkeys.keys())
+        keys['Hours'] = joined['minutes'] // (60 * self.hourband) * self.hourband
+
+        rows = []
+        for grouping in self.groupings:
+            rows += self.summarize(grouping, keys, patientkeys, patient, codes, values, numpatients)
 
+        path = os.path.join(directory, 'reports')
+        if(not os.path.isdir(path)):
+            os.makedirs(path)
+        with open(os.path.join(path, 'GroupedStatistics.csv'), 'w') as f:
+            f.write("Grouping,Group,Measurement,Patients,GroupPatients,Coverage,Values,"
+                "Minimum,FirstQ,Median,Mean,ThirdQ,Maximum\n")
+            for row in rows:
+                f.write("{},{},{},{},{},{:.3f},{},{:.3f},{:.3f},{:.3f},{:.3f},{:.3f},{:.3f}\n".format(*row))
+        print("Finished generating the grouped report.")
         return
 
 
+    # This function computes the rows of the grouped report for one grouping.  The
+    # measurements are sorted once by group, code and value, so every statistic of every
+    # group and measurement is read off the sorted arrays at the boundaries between them.
+    # grouping:     The tuple of keys to group by
+    # keys:         The key of each measurement, by key name
+    # patientkeys:  The key of each patient, by static key name
+    # patient:      The patient index of each measurement
+    # codes:        The parameter code of each measurement
+    # values:       The value of each measurement
+    # numpatients:  The number of patients
+    def summarize(self, grouping, keys, patientkeys, patient, codes, values, numpatients):
+        if(len(values) == 0):
+            return []
+
+        # Number the groups and sort the measurements.
+        groups, group = np.unique(np.stack([keys[key] for key in grouping], axis=1), axis=0, return_inverse=True)
+        segment = group.reshape(-1) * len(self.labels) + codes
+        order = np.lexsort((values, segment))
+        segment, vals = segment[order], values[order]
+        starts = np.flatnonzero(np.concatenate(([True], segment[1:] != segment[:-1])))
+        ends = np.append(starts[1:], len(vals))
+        counts = ends - starts
+
+        # The quantiles, interpolated between the closest values like np.percentile.
+        quantiles = []
+        for q in GROUP_QUANTILES:
+            pos = starts + q * (counts - 1)
+            low = np.floor(pos).astype(np.int64)
+            high = np.minimum(low + 1, ends - 1)
+            quantiles.append(vals[low] + (vals[high] - vals[low]) * (pos - low))
+        means = np.add.reduceat(vals, starts) / counts
+
+        # The number of patients with each measurement in each group.
+        withpatients = np.unique(segment * numpatients + patient[order])
+        found, havecounts = np.unique(withpatients // numpatients, return_counts=True)
+        having = havecounts[np.searchsorted(found, segment[starts])]
+
+        # The number of patients in each group, by its static keys.
+        static = [i for i, key in enumerate(grouping) if key in patientkeys]
+        sizes = {}
+        if(len(static) > 0):
+            combos, sizes = np.unique(np.stack([patientkeys[grouping[i]] for i in static], axis=1), 
+                axis=0, return_counts=True)
+            sizes = dict(zip([tuple(c) for c in combos.tolist()], sizes.tolist()))
+
+        rows = []
+        for i, start in enumerate(starts.tolist()):
+            g, code = divmod(int(segment[start]), len(self.labels))
+            name = ';'.join('{}={:g}'.format(key, val) for key, val in zip(grouping, groups[g].tolist()))
+            size = sizes.get(tuple(groups[g][static].tolist()), 0) if len(static) > 0 else numpatients
+            rows.append(['*'.join(grouping), name, self.labels[code], int(having[i]), size, 
+                having[i] / max(size, 1), int(counts[i]), vals[start], quantiles[0][i], quantiles[1][i], 
+                means[i], quantiles[2][i], vals[ends[i] - 1]])
+        return rows
+
+
+
+# This function reads the groupings of the 'Groups' setting: a comma separated list of
+# groupings, each one key or several joined by '*', e.g. 'ICUType, Gender, ICUType*Hours'.
+# text:         The value of the 'Groups' setting
+def parseGroupings(text):
+    groupings = []
+    for grouping in text.split(','):
+        keys = tuple(key.strip() for key in grouping.split('*'))
+        if(keys == ('',)):
+            continue
+        for key in keys:
+            if(key not in GROUP_KEYS):
+                sys.stderr.write("Error: Specifications.txt - '{}' is not a group key; use one of: {}.\n".format(
+                    key, ', '.join(GROUP_KEYS)))
+                exit(0)
+        groupings.append(keys)
+    return groupings
+
+
+
+# The worker thread that summarizes a share of the patients for the report.
+# ParamInfo:    Obtained from spec_parser.getSpecifications()
+# mode:         'exact' or 'sketch', as for StatReportGenerator
+# error:        The rank error allowed in the quartiles in 'sketch' mode
+# patientdata:  The PatientSeries of the patients to summarize
+# ptp:          The thread pool class instance.  Used to synchronize returned results.
+def summarizePatients(args):
+    reportgen = StatReportGenerator(args[0], args[1], args[2])
+    reportgen.addPatients(args[3])
+    ptp = args[4]
+    ptp.lock.acquire()
+    try:
+        ptp.results.append(reportgen)
+    finally:
+        ptp.lock.release()
+    return
+
+
+
+# This function loads the patients of a dataset directory: from its columnar dataset if
+# it has one, or else from its patient CSV files, which are read by worker processes.
+# directory:    The directory of the dataset
+# labels:       The parameter labels of the specifications, by parameter code
+def loadPatients(directory, labels):
+    codes = dict((label, code) for code, label in enumerate(labels))
+    if(columnar_output.isColumnar(directory)):
+        # Read the columnar dataset, mapping its parameter codes onto the specification's.
+        filelabels, patients = columnar_output.readDataset(directory)
+        remap = np.array([codes[label] for label in filelabels], dtype=np.uint16)
+        patientdata = []
+        for patient in patients:
+            patient.codes = remap[patient.codes]
+            patientdata.append(patient)
+        return patientdata
+
+    files = [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.endswith('.csv')]
+    files = [f for f in files if isPatientFile(f)]
+    processes = multiprocessing.Pool()
+    try:
+        patientdata = processes.map(functools.partial(readPatientFile, codes), files, 
+            max(1, len(files) // (8 * multiprocessing.cpu_count())))
+    finally:
+        processes.close()
+        processes.join()
+    return patientdata
+
+
+
+# This function returns whether a file is a patient CSV file, by its header, so that
+# reports written next to the patient files are not read as patients.
+# path:         The path of the file
+def isPatientFile(path):
+    if(not os.path.isfile(path)):
+        return False
+    with open(path, 'r') as f:
+        return f.readline().strip() == patient_series.FILE_HEADER
+
+
+
+# This function reads a patient CSV file written by data_gen.writePatient into a
+# PatientSeries.  The columns are found by the names in the header, and the static
+# measurements are the rows with the Id -1, whatever their position.
+# codes:        A dictionary of the parameter code of each label
+# path:         The path of the patient file
+def readPatientFile(codes, path):
+    with open(path, 'r') as f:
+        header = f.readline().strip().split(',')
+        text = f.read().strip()
+    fields = text.replace('\n', ',').split(',') if len(text) > 0 else []
+    columns = dict((name, fields[i::len(header)]) for i, name in enumerate(header))
+
+    params = np.array(columns['Parameter'])
+    ids = np.array(columns['Id'], dtype=np.float64).astype(np.int32)
+    values = np.array(columns['Value'], dtype=np.float64)
+    static = ids == -1
+    found = dict(zip(params[static].tolist(), values[static].tolist()))
+    statics = [found.get(name) for name in patient_series.STATIC_PARAMS]
+
+    # Convert the 'HH:MM' times to minutes and the labels to parameter codes.
+    dynamic = ~static
+    times = np.array(columns['Time'])[dynamic].tolist()
+    times = np.array(':'.join(times).split(':') if len(times) > 0 else [], dtype=np.float64)
+    times = times.astype(np.int32).reshape(-1, 2)
+    labels, inverse = np.unique(params[dynamic], return_inverse=True)
+    lookup = np.array([codes[label] for label in labels.tolist()], dtype=np.uint16)
+    return patient_series.PatientSeries(statics, times[:, 0] * 60 + times[:, 1], lookup[inverse], 
+        ids[dynamic], values[dynamic])
+
+
+
 if __name__ == '__main__':
 
     # Ensure that we have the correct number of commandline arguments.
@@ -99,38 +410,32 @@ if __name__ == '__main__':
         print("Insufficient command line arguments given.  Expected: 'python stat_report.py [directory] [specfile]'.")
         exit(0)
 
-    # Test if the provided path is a valid directory. If so, move to it.
-    if(not os.path.isdir(sys.argv[1])):
-        print("The given path \'{}\' is not a directory.".format(sys.argv[1]))
+    # Test if the provided path is a valid directory.
+    directory = sys.argv[1]
+    if(not os.path.isdir(directory)):
+        print("The given path \'{}\' is not a directory.".format(directory))
         exit(0)
-    os.chdir(sys.argv[1])
 
     # Obtain the specifications file name and make sure that it exists.
-    spec_file = sys.argv[2]
+    spec_file = os.path.join(directory, sys.argv[2])
     if(not os.path.isfile(spec_file)):
-        print("Provided specifications file \'"+spec_file+"\' does not exist in the directory \'"+sys.argv[1]+"\'.")
+        print("Provided specifications file \'"+sys.argv[2]+"\' does not exist in the directory \'"+directory+"\'.")
         exit(0)
 
     # Obtain the data specifications from Specifications.txt
-    icu_info, param_info, patient_info = spec_parser.getSpecifications(spec_file)
+    icu_info, param_info, patient_info, registry = spec_parser.getSpecifications(spec_file)
+    setting_info = spec_parser.getSettings(spec_file)
 
     # Obtain the patient data from the specified patient directory
+    atime = time.time()
     print("Loading patient data from specified directory...")
-    patientdata = []
-    for f in filter(lambda f : os.path.isfile(f) and f.endswith('.csv'), os.listdir('.')):
-        patient = []
-        with open(f, 'r') as fopen:
-            for line in fopen.readlines()[1:]:
-                measurement = line.strip().split(',')
-                patient.append(measurement)
-        patientdata.append(patient)
-    os.chdir('..')
-    print("Finished loading patient data.")
+    patientdata = loadPatients(directory, spec_parser.getLabels(param_info))
+    print("Finished loading {} patients: {:10.2f} seconds.".format(len(patientdata), time.time() - atime))
 
     # Create the report
-    srg = StatReportGenerator(param_info)
-    srg.createReport(patientdata, sys.argv[1])
-
-
-
-    
\ No newline at end of file
+    srg = StatReportGenerator(param_info, setting_info['Stats'], setting_info['StatsError'])
+    srg.createReport(patientdata, directory)
+    if(setting_info['Groups'] != ''):
+        groupgen = GroupedReportGenerator(param_info, parseGroupings(setting_info['Groups']),
+            setting_info['AgeBand'], setting_info['HourBand'])
+        groupgen.createReport(patientdata, directory)
@@ -0,0 +1,202 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: Statistics Summaries
+-- Description: This module contains the summaries the statistics report keeps of the
+-- values of each measurement.  ValueList and ValueSketch take the values in batches, can
+-- be merged with another summary of the same kind, and describe the values by their minimum,
+-- first quartile, median, mean, third quartile and maximum:
+--
+--   ValueList:    keeps every value, and describes them exactly
+--   ValueAggregate: holds statistics computed elsewhere, such as on the database server
+--   ValueSketch:  keeps the count, mean, variance, minimum and maximum as running
+--                 values, and the quartiles in a KLL quantile sketch.  The sketch holds
+--                 a few thousand values at most, however many are added, and the rank
+--                 of a quartile it reports is within about 'error' of the true rank.
+--                 Until the sketch first compacts it holds every value, and the
+--                 quartiles are exact.
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import math
+import random
+
+# Related 3rd party imports
+import numpy as np
+
+# Local application imports
+# ...
+
+# The quantiles of the report after the minimum, in the order they are written.
+QUARTILES = (0.25, 0.5, 0.75)
+
+
+class ValueList:
+
+    def __init__ (self):
+        self.arrays = []
+        return
+
+
+    # This function adds a batch of values.
+    # values:       The values to add
+    def update(self, values):
+        self.arrays.append(values)
+        return
+
+
+    # This function adds the values of another ValueList.
+    def merge(self, other):
+        self.arrays += other.arrays
+        return
+
+
+    # The number of values added.
+    def count(self):
+        return sum(len(values) for values in self.arrays)
+
+
+    # This function returns the minimum, first quartile, median, mean, third quartile and
+    # maximum of the values, converting them to one array only once.
+    def describe(self):
+        vals = np.concatenate(self.arrays).astype(np.float64)
+        first, median, third = np.percentile(vals, [100 * q for q in QUARTILES])
+        return [np.min(vals), first, median, np.mean(vals), third, np.max(vals)]
+
+
+
+class ValueAggregate:
+
+    # Initialize the summary
+    # count:        The number of values
+    # stats:        The minimum, first quartile, median, mean, third quartile and maximum
+    def __init__ (self, count, stats):
+        self.n = count
+        self.stats = [float(stat) for stat in stats]
+        return
+
+
+    # The number of values summarized.
+    def count(self):
+        return self.n
+
+
+    # This function returns the minimum, first quartile, median, mean, third quartile and
+    # maximum of the values.
+    def describe(self):
+        return self.stats
+
+
+
+class ValueSketch:
+
+    # Initialize an empty sketch
+    # error:        The rank error allowed in the quartiles, as a fraction of the count
+    def __init__ (self, error):
+        self.k = max(8, int(math.ceil(2 / error)))
+        self.levels = [np.empty(0)]     # the values kept at each level; a value at level
+                                        # h stands for 2 ** h of the values added
+        self.random = random.Random(0)
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        return
+
+
+    # This function adds a batch of values.
+    # values:       The values to add
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if(len(values) == 0):
+            return
+        mean = values.mean()
+        self.combine(len(values), mean, ((values - mean) ** 2).sum(), values.min(), values.max())
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self.compress()
+        return
+
+
+    # This function adds the values of another ValueSketch.
+    def merge(self, other):
+        if(other.n == 0):
+            return
+        self.combine(other.n, other.mean, other.m2, other.min, other.max)
+        while(len(self.levels) < len(other.levels)):
+            self.levels.append(np.empty(0))
+        for h in range(len(other.levels)):
+            self.levels[h] = np.concatenate((self.levels[h], other.levels[h]))
+        self.compress()
+        return
+
+
+    # This function combines the running values with those of a batch of values, using
+    # the pairwise update of Chan et al. for the mean and sum of squared differences.
+    # n, mean, m2:  The count, mean and sum of squared differences from the mean of the batch
+    # low, high:    The minimum and maximum of the batch
+    def combine(self, n, mean, m2, low, high):
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.n * n / total
+        self.n = total
+        self.min = min(self.min, low)
+        self.max = max(self.max, high)
+        return
+
+
+    # This function returns the number of values a level can hold before it is compacted.
+    # The top level holds k values and each level below it two thirds of the one above.
+    # h:            The level
+    def capacity(self, h):
+        return max(2, int(math.ceil(self.k * (2 / 3) ** (len(self.levels) - h - 1))))
+
+
+    # This function compacts every level that holds more values than it can: the values
+    # are sorted and every other one, starting from the first or second at random, is
+    # promoted to the level above with twice the weight.
+    def compress(self):
+        h = 0
+        while(h < len(self.levels)):
+            if(len(self.levels[h]) > self.capacity(h)):
+                if(h + 1 == len(self.levels)):
+                    self.levels.append(np.empty(0))
+                vals = np.sort(self.levels[h])
+                keep = len(vals) % 2
+                promoted = vals[keep + self.random.randint(0, 1)::2]
+                self.levels[h + 1] = np.concatenate((self.levels[h + 1], promoted))
+                self.levels[h] = vals[:keep]
+            h += 1
+        return
+
+
+    # The number of values added.
+    def count(self):
+        return self.n
+
+
+    # The sample variance of the values added.
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+
+    # This function returns the value at the given fraction of the ordered values.
+    # q:            The fraction, from 0 to 1
+    def quantile(self, q):
+        if(len(self.levels) == 1):
+            return np.percentile(self.levels[0], 100 * q)
+        vals = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(vals, kind='mergesort')
+        ranks = np.cumsum(weights[order])
+        return vals[order][min(np.searchsorted(ranks, q * ranks[-1]), len(vals) - 1)]
+
+
+    # This function returns the minimum, first quartile, median, mean, third quartile and
+    # maximum of the values.
+    def describe(self):
+        first, median, third = [self.quantile(q) for q in QUARTILES]
+        return [self.min, first, median, self.mean, third, self.max]
@@ -0,0 +1,120 @@
+from __future__ import division
+
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: Tensor Export
+-- Description: This module writes the processed patients as dense arrays binned onto a
+-- regular time grid, so that they can be used for training without reading the patient
+-- files.  The arrays are written to the 'tensor' directory of the dataset as .npy files,
+-- through memory maps, one patient at a time:
+--
+--   values.npy:   float32 [patients, bins, parameters], the aggregated value of each
+--                 parameter in each time bin, NaN where nothing was recorded
+--   mask.npy:     uint8 [patients, bins, parameters], 1 where a value was recorded
+--   statics.npy:  float32 [patients, statics], the static measurements (RecordID, Age,
+--                 Gender, Height, ICUType, Weight)
+--   meta.json:    the parameter labels, the static measurement names, the bin width in
+--                 minutes and the aggregation used
+--
+-- The arrays can be opened without parsing with np.load(path, mmap_mode='r').  Bin i
+-- holds the measurements made from i * binwidth up to (i + 1) * binwidth minutes after
+-- the ICU intime.  When a parameter has several values in a bin they are aggregated by
+-- taking the last, mean, minimum or maximum value.
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import os
+import json
+
+# Related 3rd party imports
+import numpy as np
+
+# Local application imports
+import patient_series
+
+# The ways values in the same bin can be aggregated.
+AGGREGATIONS = ('last', 'mean', 'min', 'max')
+
+class TensorWriter:
+
+    # This function creates the arrays of the tensor.
+    # directory:    The directory of the dataset; the arrays are written in its 'tensor'
+    #               directory
+    # labels:       The parameter labels, by parameter code
+    # numpatients:  The number of patients that will be added
+    # hours:        The total number of hours from an ICU stay that are desired.
+    # binwidth:     The width of a time bin in minutes
+    # aggregation:  How values in the same bin are combined: 'last', 'mean', 'min' or 'max'
+    def __init__ (self, directory, labels, numpatients, hours, binwidth, aggregation):
+        self.directory = os.path.join(directory, 'tensor')
+        self.labels = labels
+        self.binwidth = binwidth
+        self.aggregation = aggregation
+        self.numbins = -(-hours * 60 // binwidth)
+        self.count = 0
+
+        if(not os.path.isdir(self.directory)):
+            os.makedirs(self.directory)
+        shape = (numpatients, self.numbins, len(labels))
+        self.values = np.lib.format.open_memmap(os.path.join(self.directory, 'values.npy'),
+            mode='w+', dtype=np.float32, shape=shape)
+        self.mask = np.lib.format.open_memmap(os.path.join(self.directory, 'mask.npy'),
+            mode='w+', dtype=np.uint8, shape=shape)
+        self.statics = np.lib.format.open_memmap(os.path.join(self.directory, 'statics.npy'),
+            mode='w+', dtype=np.float32, shape=(numpatients, len(patient_series.STATIC_PARAMS)))
+        return
+
+
+    # This function bins the measurements of a patient and writes them as the next row of
+    # the arrays.
+    # patient:      The PatientSeries of the patient
+    def add(self, patient):
+        size = self.numbins * len(self.labels)
+
+        # Find the position of each measurement in the patient's [bins, parameters] grid.
+        bins = patient.minutes // self.binwidth
+        inside = bins < self.numbins
+        cells = bins[inside].astype(np.int64) * len(self.labels) + patient.codes[inside]
+        vals = patient.values[inside].astype(np.float64)
+        counts = np.bincount(cells, minlength=size)
+
+        if(self.aggregation == 'mean'):
+            grid = np.bincount(cells, weights=vals, minlength=size) / np.maximum(counts, 1)
+        elif(self.aggregation == 'min'):
+            grid = np.full(size, np.inf)
+            np.minimum.at(grid, cells, vals)
+        elif(self.aggregation == 'max'):
+            grid = np.full(size, -np.inf)
+            np.maximum.at(grid, cells, vals)
+        else:
+            # Measurements are in time order, so the last value of a cell is the first
+            # one found when searching from the end.
+            grid = np.zeros(size)
+            found, index = np.unique(cells[::-1], return_index=True)
+            grid[found] = vals[::-1][index]
+
+        grid[counts == 0] = np.nan
+        self.values[self.count] = grid.reshape(self.numbins, len(self.labels))
+        self.mask[self.count] = (counts > 0).reshape(self.numbins, len(self.labels))
+        self.statics[self.count] = patient.getStatics()
+        self.count += 1
+        return
+
+
+    # This function finishes writing the arrays and describes them in meta.json.
+    def close(self):
+        for array in (self.values, self.mask, self.statics):
+            array.flush()
+        del self.values, self.mask, self.statics
+
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+            json.dump({
+                'patients':     self.count,
+                'parameters':   self.labels,
+                'statics':      patient_series.STATIC_PARAMS,
+                'bins':         self.numbins,
+                'binwidth':     self.binwidth,
+                'aggregation':  self.aggregation,
+            }, f, indent=4)
+        return
@@ -0,0 +1,147 @@
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: ConnectionPool Tests
+-- Description: These tests run the stages of a run, on worker threads and on async
+-- connections, one after the other on the same ConnectionPool, with the connections
+-- to the database replaced by stand-ins.
+--
+--   python -m pytest tests
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import os
+import sys
+import time
+import threading
+import unittest
+
+# Related 3rd party imports
+# ...
+
+# Local application imports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mdgl'))
+import ConnectionPool
+import PatientThreadPool
+
+# The number of seconds a stage may take before it is taken to be waiting forever.
+TIMEOUT = 5
+
+
+# A stand-in for a connection to the Mimic database.
+class FakeConnection:
+
+    def __init__(self, async_):
+        self.async_ = async_
+        self.closed = False
+
+
+    def cursor(self, **kwargs):
+        return self
+
+
+    def rollback(self):
+        return
+
+
+    def close(self):
+        self.closed = True
+        return
+
+
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connect = ConnectionPool.ConnectionPool.connect
+        ConnectionPool.ConnectionPool.connect = lambda pool, async_=0: FakeConnection(async_)
+        return
+
+
+    def tearDown(self):
+        ConnectionPool.ConnectionPool.connect = self.connect
+        return
+
+
+    # This function runs func on a thread and returns its result, failing the test if it
+    # does not finish in time.
+    def runStage(self, func, *args):
+        result = []
+        t = threading.Thread(target=lambda: result.append(func(*args)))
+        t.daemon = True
+        t.start()
+        t.join(TIMEOUT)
+        self.assertFalse(t.is_alive(), "the stage is waiting for a connection")
+        return result[0]
+
+
+    # This function runs a thread stage of the given number of patients, as executeFunc
+    # does for the weight and height of the cohort.  Every worker thread holds a
+    # connection at the same time.
+    def runThreadStage(self, pool, patients):
+        ptp = PatientThreadPool.PatientThreadPool(pool, 'static', 1)
+        def work(args):
+            time.sleep(0.1)
+            ptp = args[-2]
+            with ptp.lock:
+                ptp.results += args[-3]
+        self.runStage(ptp.executeFunc, work, [], [list(range(patients))])
+        self.assertEqual(sorted(ptp.getResults()), list(range(patients)))
+        return
+
+
+    def test_thread_then_async(self):
+        pool = ConnectionPool.ConnectionPool(None, 1, 5, 0)
+        held = pool.getconn()
+        self.runThreadStage(pool, 20)
+        self.assertEqual(pool.size, pool.maxconn)
+
+        # The idle blocking connections are closed to make room for the async ones.
+        conns = self.runStage(pool.getasync, 4)
+        self.assertEqual(len(conns), 4)
+        self.assertTrue(all(conn.async_ for conn in conns))
+        self.assertEqual(pool.size, pool.maxconn)
+        self.assertEqual(pool.available(), 0)
+        pool.putasync(conns)
+        pool.putconn(held)
+        self.assertEqual(pool.available(), pool.maxconn)
+        return
+
+
+    def test_async_then_thread(self):
+        pool = ConnectionPool.ConnectionPool(None, 1, 5, 0)
+        held = pool.getconn()
+        pool.putasync(self.runStage(pool.getasync, 4))
+        self.assertEqual(pool.workers(), 4)
+
+        # The idle async connections are closed to make room for the blocking ones.
+        self.runThreadStage(pool, 20)
+        self.assertTrue(pool.size <= pool.maxconn)
+        conns = self.runStage(pool.getasync, 4)
+        self.assertEqual(len(conns), 4)
+        pool.putasync(conns)
+        pool.putconn(held)
+        return
+
+
+    def test_full_pool_waits(self):
+        pool = ConnectionPool.ConnectionPool(None, 0, 2, 0)
+        conns = pool.getasync(2)
+        self.assertEqual(pool.available(), 0)
+
+        # A connection in use is not closed; the next caller waits for it to be returned.
+        waiter = threading.Thread(target=lambda: pool.putconn(pool.getconn()))
+        waiter.daemon = True
+        waiter.start()
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+        pool.putasync(conns)
+        waiter.join(TIMEOUT)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(pool.size, 2)
+        return
+
+
+
+if __name__ == '__main__':
+    unittest.main()
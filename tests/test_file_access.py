@@ -0,0 +1,121 @@
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: File Accessor Tests
+-- Description: These tests convert the small MIMIC-III CSV files in fixtures/mimic-iii
+-- into a measurement store and read the rows back, including after a conversion that
+-- was interrupted part way.
+--
+--   python -m pytest tests
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# Related 3rd party imports
+# ...
+
+# Local application imports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mdgl'))
+import file_access
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'mimic-iii')
+
+# The chart events, lab events and output events IDs of the fixtures.
+CHART_IDS = set([211, 3581, 920, 720, 467])
+OTHER_IDS = set([51002, 50971, 40055])
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        return
+
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+        return
+
+
+    # This function returns the (hadm_id, itemid, charttime, value) rows of a subject in the
+    # store, in the order they are read.
+    def storedRows(self, table, subject_id):
+        cols = file_access.selectRows(file_access.loadPartition(self.store_dir, table,
+            subject_id % file_access.NUM_PARTITIONS), subject_id)
+        return [(int(h), int(i), int(t), str(v)) for h, i, t, v in
+            zip(cols['hadm_id'], cols['itemid'], cols['charttime'], cols['value'])]
+
+
+    def test_roundtrip(self):
+        file_access.updateStore(SOURCE_DIR, self.store_dir, CHART_IDS | OTHER_IDS)
+
+        seconds = file_access.parseSeconds
+        self.assertEqual(self.storedRows('chartevents', 10), [
+            (101, 920, seconds('2100-02-01 08:00:00'), '70'),
+            (101, 3581, seconds('2100-02-01 09:00:00'), '150'),
+            (101, 211, seconds('2100-02-01 10:30:00'), '80'),
+            (100, 211, seconds('2100-02-01 10:30:00'), '99'),
+            (101, 467, seconds('2100-02-01 10:45:00'), '1.0'),
+            (101, 720, seconds('2100-02-01 11:00:00'), '2.0'),
+            (101, 211, seconds('2100-02-04 10:30:00'), '81'),
+        ])
+        self.assertEqual(sorted(self.storedRows('labevents', 10)), [
+            (-1, 50971, seconds('2100-02-01 10:30:00'), '4.1'),
+            (101, 50971, seconds('2100-02-01 10:30:00'), '4.1'),
+            (101, 51002, seconds('2100-02-01 12:00:00'), '<0.03'),
+        ])
+        self.assertEqual(self.storedRows('outputevents', 10), [
+            (101, 40055, seconds('2100-02-01 13:00:00'), '200'),
+        ])
+        self.assertEqual(self.storedRows('chartevents', 11), [])
+        return
+
+
+    def test_incremental(self):
+        file_access.updateStore(SOURCE_DIR, self.store_dir, set([211]))
+        self.assertEqual(len(self.storedRows('chartevents', 10)), 3)
+
+        # Only the IDs that are not in the store yet are converted.
+        file_access.updateStore(SOURCE_DIR, self.store_dir, CHART_IDS)
+        file_access.updateStore(SOURCE_DIR, self.store_dir, CHART_IDS)
+        self.assertEqual(len(self.storedRows('chartevents', 10)), 7)
+        return
+
+
+    def test_interrupted_conversion(self):
+        file_access.updateStore(SOURCE_DIR, self.store_dir, set([211]))
+
+        # A conversion that writes its chunks but stops before the manifest is updated.
+        file_access.convertTable(SOURCE_DIR, self.store_dir, 'chartevents', 'CHARTEVENTS', CHART_IDS - set([211]))
+        file_access.updateStore(SOURCE_DIR, self.store_dir, CHART_IDS)
+        self.assertEqual(len(self.storedRows('chartevents', 10)), 7)
+        return
+
+
+    def test_interrupted_first_conversion(self):
+        file_access.convertTable(SOURCE_DIR, self.store_dir, 'chartevents', 'CHARTEVENTS', CHART_IDS)
+        file_access.updateStore(SOURCE_DIR, self.store_dir, CHART_IDS)
+        self.assertEqual(len(self.storedRows('chartevents', 10)), 7)
+        return
+
+
+
+class PatientsTest(unittest.TestCase):
+
+    def test_selection(self):
+        patient_info = {'Age': {'min': 15, 'max': 200}, 'Sex': 'Both', 'Hours': {'limit': 48, 'req': 1}}
+        patients = file_access.obtainPatients(['MICU', 'CCU', 'SICU'], patient_info, SOURCE_DIR)
+
+        # Subject 10 keeps its last stay, 11 stayed too briefly and 12 is too young.
+        self.assertEqual([p[:3] for p in patients], [[10, 1001, 101]])
+        return
+
+
+
+if __name__ == '__main__':
+    unittest.main()
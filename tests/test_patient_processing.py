@@ -0,0 +1,138 @@
+'''
+-- ------------------------------------------------------------------------------------
+-- Title: Patient Processing Tests
+-- Description: These tests check that the 'numpy' evaluation of a patient's measurement
+-- stream (evaluateArrays) gives the same measurements and invalid value counts as the
+-- 'loop' evaluation (evaluateLoop), on streams with mechanical ventilation, censored and
+-- invalid values, and measurements before the ICU intime and at the hours cutoff.
+--
+--   python -m pytest tests
+-- ------------------------------------------------------------------------------------
+'''
+
+# Standard library imports
+import os
+import sys
+import random
+import datetime
+import unittest
+
+# Related 3rd party imports
+# ...
+
+# Local application imports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mdgl'))
+import spec_parser
+import patient_processing
+
+# The parameters of the tests: heart rate, mechanical ventilation and a censored troponin.
+PARAM_INFO = {
+    'HR':       {'abbr': 'HR', 'ids': [211, 220045]},
+    'MechVent': {'abbr': 'MechVent', 'ids': [467, 720]},
+    'TropI':    {'abbr': 'TropI', 'ids': [51002]},
+}
+CENSOR_INFO = {51002: {'<': 0.029, '>': 50.001}}
+
+# The values each measurement ID is given in the random streams.
+VALUES = {
+    211:    ['80', '95.5', '0', 'abc', ''],
+    220045: ['72', '101'],
+    467:    ['1.0', '2.0', '0.0'],
+    720:    ['1.0', '2.0'],
+    51002:  ['0.04', '<0.03', 'LESS THAN 0.03', '>50', 'GREATER THAN 50', 'ERROR'],
+}
+
+INTIME = datetime.datetime(2100, 2, 1, 8, 0, 0)
+HOURS = 48
+
+
+# This function returns a measurement row of the stream, as the database returns it.
+# itemid:       The measurement ID
+# value:        The measurement value
+# minutes:      The minutes elapsed since the ICU intime
+def makeRow(itemid, value, minutes):
+    return [10, INTIME + datetime.timedelta(minutes=minutes), itemid, value, minutes]
+
+
+
+class EvaluationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = spec_parser.compileRegistry(PARAM_INFO, CENSOR_INFO)
+        return
+
+
+    # This function evaluates a stream both ways and checks that the results are the same.
+    # measurements: The measurement rows, ordered by chart time
+    # hours:        The number of hours of the stay to evaluate, or -1 for all of them
+    def assertSameEvaluation(self, measurements, hours):
+        loopinvalid = {}
+        arrayinvalid = {}
+        expected = patient_processing.evaluateLoop(measurements, hours, self.registry, loopinvalid)
+        actual = patient_processing.evaluateArrays(measurements, hours, self.registry, arrayinvalid)
+        for e, a in zip(expected, actual):
+            self.assertEqual(e.dtype, a.dtype)
+            self.assertEqual(e.tolist(), a.tolist())
+        self.assertEqual(loopinvalid, arrayinvalid)
+        return expected
+
+
+    def test_stream(self):
+        cutoff = HOURS * 60
+        measurements = [
+            makeRow(211, '70', -90),
+            makeRow(720, '1.0', -30),
+            makeRow(211, '75', 0),
+            makeRow(720, '1.0', 10),
+            makeRow(211, 'abc', 20),
+            makeRow(51002, '<0.03', 30),
+            makeRow(720, '1.0', 100),
+            makeRow(51002, 'GREATER THAN 50', 120),
+            makeRow(467, '1.0', 700),
+            makeRow(467, '2.0', 710),
+            makeRow(467, '0.0', 720),
+            makeRow(51002, 'ERROR', 800),
+            makeRow(720, '1.0', 900),
+            makeRow(720, '2.0', 1000),
+            makeRow(211, '88', cutoff - 1),
+            makeRow(211, '90', cutoff),
+            makeRow(720, '1.0', cutoff),
+            makeRow(211, '91', cutoff + 60),
+        ]
+        minutes, itemids, values = self.assertSameEvaluation(measurements, HOURS)
+        self.assertEqual(minutes.tolist(), [0, 10, 30, 100, 120, 700, 710, 900, 1000, cutoff - 1])
+        self.assertEqual(values.tolist(), [75.0, 1.0, 0.029, 1.0, 50.001, 2.0, 0.0, 1.0, 2.0, 88.0])
+
+        # Without an hours limit the measurements after the cutoff are kept.
+        minutes, itemids, values = self.assertSameEvaluation(measurements, -1)
+        self.assertEqual(minutes.tolist()[-4:], [cutoff - 1, cutoff, cutoff, cutoff + 60])
+        return
+
+
+    def test_plain_stream(self):
+        # Streams without stateful measurements, all valid or not, take the bulk paths.
+        self.assertSameEvaluation([makeRow(211, '80', m) for m in range(-10, HOURS * 60 + 10, 7)], HOURS)
+        self.assertSameEvaluation([makeRow(211, 'abc', 5), makeRow(51002, '<0.03', 6)], HOURS)
+        self.assertSameEvaluation([makeRow(211, '80', -5)], HOURS)
+        self.assertSameEvaluation([], HOURS)
+        return
+
+
+    def test_random_streams(self):
+        rand = random.Random(0)
+        cutoff = HOURS * 60
+        for i in range(200):
+            itemids = rand.sample(sorted(VALUES.keys()), rand.randint(1, len(VALUES)))
+            minutes = sorted(rand.choice([rand.randint(-180, cutoff + 180), 0, cutoff - 1, cutoff])
+                for j in range(rand.randint(0, 60)))
+            measurements = []
+            for m in minutes:
+                itemid = rand.choice(itemids)
+                measurements.append(makeRow(itemid, rand.choice(VALUES[itemid]), m))
+            self.assertSameEvaluation(measurements, rand.choice([HOURS, 1, -1]))
+        return
+
+
+
+if __name__ == '__main__':
+    unittest.main()